@@ -3,7 +3,7 @@
 # This script installs the project on a Mac. It has been tested on macOS 10.13, 10.14, and 10.15.
 
 # The pip dependencies. If you get a pip error, you might want to add version numbers to these.
-PIP_DEPENDENCIES="scikit-image numpy matplotlib scipy networkx pyqt5 Pillow"
+PIP_DEPENDENCIES="scikit-image numpy matplotlib scipy networkx pyqt5 Pillow tifffile"
 SHORTCUT_PATH=~/Desktop/GNNAT # they probably don't already have something named GNNAT on their desktop...
 
 # If homebrew isn't installed, then install it.
@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
-from sys import path
-path.append("src")
+""" Run this with no arguments to open the GUI, or run `./run.py process <image or directory>` to process images
+    without it. (`./run.py --help` has the details.) """
+import sys
+sys.path.append("src")
 
-from main_window import MainWindow
-from PyQt5.QtWidgets import QApplication
+# Batch processing starts worker processes that import this file, and they shouldn't open windows.
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # Headless, so we never import Qt.
+        from cli import main
+        sys.exit(main(sys.argv[1:]))
 
-app = QApplication([])
-mainwindow = MainWindow()
-mainwindow.show()
-app.exec_()
+    from main_window import MainWindow
+    from PyQt5.QtWidgets import QApplication
+
+    app = QApplication([])
+    mainwindow = MainWindow()
+    mainwindow.show()
+    app.exec_()
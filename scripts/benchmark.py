@@ -0,0 +1,195 @@
+# This script times each stage of the pipeline after detection on synthetic micrographs, for a range of image sizes and
+# object counts, and saves the times as JSON so runs from different versions can be compared.
+# The synthetic images come with exact detections for every cell and nanowire, so darknet never runs.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from skimage.draw import ellipse, line
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(REPO_DIR, "src"))
+from bio_object import BioObject
+from edge_detection import compute_cell_contact, compute_nanowire_edges
+from post_processing import PostProcessingManager
+from program_manager import ProgramManager
+from segmentation_executor import SegmentationExecutor, DEFAULT_WORKERS
+
+IMAGE_SIZES = ((1024, 768), (2048, 1536), (4096, 3072))
+CELL_COUNTS = (100, 400, 1600)
+# What fraction of the cells are in touching pairs, and how many nanowires there are per cell.
+CLUSTER_FRACTION = 0.3
+NANOWIRES_PER_CELL = 0.25
+REPEATS = 3
+OUTPUT_FILENAME = "benchmark.json"
+
+BACKGROUND = 0.2
+CELL_BRIGHTNESS = 0.8
+NANOWIRE_BRIGHTNESS = 0.7
+NOISE = 0.02
+# Half the length and half the width of a cell, in px.
+CELL_LENGTH_RANGE = (12, 20)
+CELL_WIDTH_RANGE = (5, 8)
+# Darknet's boxes are usually a little bigger than the object.
+BBOX_PADDING = 2 # px
+MAX_NANOWIRE_LENGTH = 150 # px
+
+STAGES = ("compute_bbox_overlaps_and_cell_centers", "compute_cell_contact", "compute_nanowire_edges",
+          "PostProcessingManager", "export_to_gexf")
+
+
+def pixel_bbox(rows, cols, width, height):
+    return (max(0, int(cols.min()) - BBOX_PADDING), max(0, int(rows.min()) - BBOX_PADDING),
+            min(width, int(cols.max()) + 1 + BBOX_PADDING), min(height, int(rows.max()) + 1 + BBOX_PADDING))
+
+def draw_cell(image, center, rotation, rng):
+    """ Draws a rod-shaped cell on image and returns its bounding box. """
+    height, width = image.shape
+    length, cell_width = rng.integers(*CELL_LENGTH_RANGE), rng.integers(*CELL_WIDTH_RANGE)
+    rows, cols = ellipse(center[0], center[1], cell_width, length, shape=image.shape, rotation=rotation)
+    image[rows, cols] = CELL_BRIGHTNESS
+    return pixel_bbox(rows, cols, width, height)
+
+def make_synthetic_micrograph(width, height, num_cells, num_nanowires, cluster_fraction=CLUSTER_FRACTION, seed=0):
+    """ Returns a grayscale image (floats in [0, 1], like ProgramManager.image) of rod-shaped cells, some of them in
+        touching pairs, with thin nanowires between some of them, and (bbox, classification) for each object in it. """
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width), BACKGROUND)
+    margin = CELL_LENGTH_RANGE[1] * 2
+    detections = []
+    centers = []
+
+    num_clustered = int(num_cells * cluster_fraction) // 2 * 2
+    while len(centers) < num_cells:
+        center = np.array([rng.integers(margin, height - margin), rng.integers(margin, width - margin)])
+        rotation = rng.uniform(0, np.pi)
+        detections.append((draw_cell(image, center, rotation, rng), "cell"))
+        centers.append(center)
+        if len(centers) <= num_clustered:
+            # The second cell of the pair lies alongside the first one, just touching it.
+            offset = (CELL_WIDTH_RANGE[1] * 2 - 1) * np.array([np.cos(rotation), np.sin(rotation)])
+            neighbour = np.clip(center + offset.round().astype(int), margin, [height - margin, width - margin])
+            detections.append((draw_cell(image, neighbour, rotation, rng), "cell"))
+            centers.append(neighbour)
+
+    centers = np.array(centers)
+    for _ in range(num_nanowires):
+        # Each nanowire goes from a cell to another cell nearby, or out onto the surface if there isn't one.
+        start = centers[rng.integers(len(centers))]
+        distances = np.hypot(*(centers - start).T)
+        nearby = np.flatnonzero((distances > CELL_LENGTH_RANGE[1] * 2) & (distances < MAX_NANOWIRE_LENGTH))
+        if len(nearby) > 0:
+            end = centers[rng.choice(nearby)]
+        else:
+            angle = rng.uniform(0, 2 * np.pi)
+            end = np.clip(start + (MAX_NANOWIRE_LENGTH / 2 * np.array([np.sin(angle), np.cos(angle)])).astype(int), 0, [height - 1, width - 1])
+        rows, cols = line(*start, *end)
+        image[rows, cols] = NANOWIRE_BRIGHTNESS
+        detections.append((pixel_bbox(rows, cols, width, height), "nanowire"))
+
+    image = np.clip(image + rng.normal(0, NOISE, image.shape), 0, 1)
+    return image, detections
+
+def make_program_manager(image, detections, segmentation_executor):
+    """ Returns a ProgramManager that's ready for compute_bbox_overlaps_and_cell_centers, as if darknet had found detections. """
+    program_manager = ProgramManager(segmentation_executor=segmentation_executor)
+    program_manager.image = image
+    program_manager.original_image = image
+    height, width = image.shape
+    program_manager.bio_objs = [BioObject(0, 0, width, height, 0, "surface", store=program_manager.store)]
+    for bbox, classification in detections:
+        program_manager.bio_objs.append(BioObject(*bbox, len(program_manager.bio_objs), classification, 1.0, program_manager.store))
+    return program_manager
+
+def time_stages(image, detections, segmentation_executor, export_path):
+    """ Runs every stage once on fresh objects, and returns {stage: seconds} and the number of edges in the graph. """
+    program_manager = make_program_manager(image, detections, segmentation_executor)
+    seconds = {}
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds[stage] = time.perf_counter() - start
+        return result
+
+    timed("compute_bbox_overlaps_and_cell_centers", program_manager.compute_bbox_overlaps_and_cell_centers)
+    timed("compute_cell_contact", compute_cell_contact, program_manager.bio_objs, image, None,
+          program_manager.known_contacts, segmentation_executor)
+    timed("compute_nanowire_edges", compute_nanowire_edges, program_manager.bio_objs, image, None, segmentation_executor)
+    post_processing_manager = timed("PostProcessingManager", PostProcessingManager, program_manager.bio_objs)
+    timed("export_to_gexf", post_processing_manager.export_to_gexf, export_path)
+    return seconds, post_processing_manager.graph.number_of_edges()
+
+def run_case(width, height, num_cells, repeats, segmentation_executor, seed):
+    num_nanowires = int(num_cells * NANOWIRES_PER_CELL)
+    image, detections = make_synthetic_micrograph(width, height, num_cells, num_nanowires, seed=seed)
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(repeats):
+            seconds, num_edges = time_stages(image, detections, segmentation_executor, os.path.join(directory, "benchmark.gexf"))
+            runs.append(seconds)
+
+    return {"width": width, "height": height, "num_cells": sum(classification == "cell" for _, classification in detections),
+            "num_nanowires": num_nanowires, "num_edges": num_edges,
+            "seconds": {stage: {"min": min(run[stage] for run in runs), "median": statistics.median(run[stage] for run in runs)}
+                        for stage in STAGES},
+            "total_seconds": min(sum(run.values()) for run in runs)}
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_size(size):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Times each stage after detection on synthetic micrographs.")
+    parser.add_argument("-o", "--output", default=OUTPUT_FILENAME, help="Where to save the times, as JSON.")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=IMAGE_SIZES, metavar="WIDTHxHEIGHT",
+                        help="Image sizes to try. Defaults to " + " ".join(f"{w}x{h}" for w, h in IMAGE_SIZES) + ".")
+    parser.add_argument("--cells", nargs="+", type=int, default=CELL_COUNTS, help="Numbers of cells to try.")
+    parser.add_argument("-r", "--repeats", type=int, default=REPEATS, help="How many times to time each case.")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="How many threads segmentation gets.")
+    parser.add_argument("--processes", action="store_true", help="Segment on -w processes instead of threads.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = []
+    with SegmentationExecutor(args.workers, args.processes) as segmentation_executor:
+        for width, height in args.sizes:
+            for num_cells in args.cells:
+                result = run_case(width, height, num_cells, args.repeats, segmentation_executor, args.seed)
+                results.append(result)
+                print(f"{width}x{height}, {result['num_cells']} cells, {result['num_nanowires']} nanowires: "
+                      + ", ".join(f"{stage} {result['seconds'][stage]['min']:.3f} s" for stage in STAGES), flush=True)
+
+    with open(args.output, "w") as output_file:
+        json.dump({"revision": git_revision(),
+                   "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "cpu_count": os.cpu_count(),
+                   "workers": args.workers,
+                   "processes": args.processes,
+                   "repeats": args.repeats,
+                   "seed": args.seed,
+                   "results": results}, output_file, indent=4)
+    print(f"Saved {len(results)} results to {args.output}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
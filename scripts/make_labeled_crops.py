@@ -2,13 +2,18 @@
 # with 50% vertical and horizontal overlap, preserving the labels.
 
 import sys
+import numpy as np
 from PIL import Image
 from copy import deepcopy
-from os import listdir
+from os import listdir, path
+
+# The GUI's tiling lives in src.
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "..", "src"))
+import crop_processing
 
 TILE_OVERLAP = 2 # 2 -> 50% overlap, 3 -> 33% overlap, etc.
-TILE_SIZE = 416
-IMAGE_EXTENSIONS = (".tiff", ".tif", ".png", ".jpg", ".jpeg", ".gif", ".bmp")
+TILE_SIZE = crop_processing.TILE_SIZE
+IMAGE_EXTENSIONS = crop_processing.IMAGE_EXTENSIONS
 
 class Box:
     def __init__(self, x1, y1, x2, y2):
@@ -114,13 +119,9 @@ def parse_yolo_input(label_file):
     return bounding_boxes
 
 def make_crops(img, filename):
-    tiles = []
-    for r in range(0, img.height, TILE_SIZE // TILE_OVERLAP):
-        for c in range(0, img.width, TILE_SIZE // TILE_OVERLAP):
-            x1, y1, x2, y2 = (r, c, r + TILE_SIZE, c + TILE_SIZE)
-            tiles.append(Tile(img.crop((x1, y1, x2, y2)), x1, y1, x2, y2, filename))
-
-    return tiles
+    """ Tiles img (a PIL Image) the same way the GUI does, minus the information bar, but with our overlap. """
+    return [Tile(Image.fromarray(tile.padded_img()), tile.x1, tile.y1, tile.x2, tile.y2, filename)
+            for tile in crop_processing.tile_image(np.asarray(img), filename, TILE_SIZE, TILE_SIZE // TILE_OVERLAP)]
 
 def make_labeled_crops(input_dir, output_dir):
     """ input_dir:  Directory containing uncropped images and associated labels
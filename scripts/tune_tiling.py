@@ -0,0 +1,149 @@
+# This script tries out different tile sizes, overlaps and reunify modes on full-size images with YOLO labels
+# (like the ones make_labeled_crops.py reads), and saves the cheapest tiling that finds about as many of the labeled
+# objects as the best one did. ProgramManager picks it up from crop_processing.TILING_CONFIG_PATH.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(REPO_DIR, "src"))
+from crop_processing import TilingConfig, IMAGE_EXTENSIONS, REUNIFY_BY_CONFIDENCE_REGION, REUNIFY_BY_FUSION, TILING_CONFIG_PATH, \
+                            MIN_TILE_FOREGROUND, box_intersection, box_area
+from program_manager import ProgramManager
+from yolo import DetectorSession, NAMES_PATH
+from detector_backend import DarknetBackend
+
+TILE_SIZES = (320, 416, 512, 608)
+TILE_OVERLAPS = (2, 3, 4)
+FUSION_OVERLAPS_PX = (32, 64, 128)
+# A detection finds a labeled object if they have the same class and their boxes overlap at least this much (IoU).
+MATCH_IOU = 0.5
+# We'll take a tiling that finds this much less of the labeled objects than the best one, if it's faster.
+RECALL_TOLERANCE = 0.01
+REPORT_FILENAME = "tiling_report.json"
+
+
+def candidate_tilings(min_tile_foreground=MIN_TILE_FOREGROUND):
+    tilings = [TilingConfig(tile_size, tile_overlap=tile_overlap, reunify_mode=REUNIFY_BY_CONFIDENCE_REGION, min_tile_foreground=min_tile_foreground)
+               for tile_size in TILE_SIZES for tile_overlap in TILE_OVERLAPS]
+    tilings += [TilingConfig(tile_size, fusion_overlap_px=overlap_px, reunify_mode=REUNIFY_BY_FUSION, min_tile_foreground=min_tile_foreground)
+                for tile_size in TILE_SIZES for overlap_px in FUSION_OVERLAPS_PX if overlap_px < tile_size]
+    return tilings
+
+def find_labeled_images(directory):
+    """ Returns (image path, label path) for each image in directory that has a label file. """
+    labeled_images = []
+    for filename in sorted(os.listdir(directory)):
+        label_path = os.path.join(directory, filename[:filename.rfind(".")] + ".txt")
+        if filename.lower().endswith(IMAGE_EXTENSIONS) and os.path.exists(label_path):
+            labeled_images.append((os.path.join(directory, filename), label_path))
+    return labeled_images
+
+def read_labels(label_path, width, height, class_names):
+    """ Returns (bbox, classification) for each object in a YOLO label file, with bbox in px. """
+    labels = []
+    with open(label_path) as label_file:
+        for line in label_file:
+            if "#" in line:
+                line = line[:line.index("#")]
+            if line.split() == []:
+                continue
+            class_index, x, y, box_width, box_height = map(float, line.split())
+            bbox = (round((x - box_width / 2) * width), round((y - box_height / 2) * height),
+                    round((x + box_width / 2) * width), round((y + box_height / 2) * height))
+            labels.append((bbox, class_names[int(class_index)]))
+    return labels
+
+def iou(bbox1, bbox2):
+    intersection = box_intersection(bbox1, bbox2)
+    return intersection / max(1, box_area(bbox1) + box_area(bbox2) - intersection)
+
+def count_matches(detections, labels):
+    """ Returns how many of labels are found by detections. Each detection can only find one label. """
+    pairs = sorted(((iou(detection, label), i, j) for i, (detection, detected_class) in enumerate(detections)
+                    for j, (label, label_class) in enumerate(labels) if detected_class == label_class), reverse=True)
+    used_detections, used_labels = set(), set()
+    for overlap, i, j in pairs:
+        if overlap < MATCH_IOU:
+            break
+        if i not in used_detections and j not in used_labels:
+            used_detections.add(i)
+            used_labels.add(j)
+    return len(used_labels)
+
+def evaluate(tiling, labeled_images, detector, class_names):
+    """ Runs darknet on every labeled image with tiling, and returns a dict of how it went. """
+    num_tiles = num_skipped_tiles = num_detections = num_labels = num_found = 0
+    seconds = 0
+    for image_path, label_path in labeled_images:
+        program_manager = ProgramManager(detector, tiling=tiling)
+        program_manager.open_image_file(image_path)
+        start = time.perf_counter()
+        program_manager.compute_bounding_boxes()
+        seconds += time.perf_counter() - start
+
+        height, width = program_manager.original_image.shape[:2]
+        labels = read_labels(label_path, width, height, class_names)
+        detections = [(bio_obj.bbox(), bio_obj.classification) for bio_obj in program_manager.bio_objs[1:]] # bio_objs[0] is the surface
+        num_tiles += len(program_manager.tiles) + len(program_manager.skipped_tiles)
+        num_skipped_tiles += len(program_manager.skipped_tiles)
+        num_detections += len(detections)
+        num_labels += len(labels)
+        num_found += count_matches(detections, labels)
+
+    return {"tiling": tiling.to_dict(),
+            "tiles_per_image": num_tiles / len(labeled_images),
+            "skipped_tiles_per_image": num_skipped_tiles / len(labeled_images),
+            "seconds_per_image": seconds / len(labeled_images),
+            "recall": num_found / max(1, num_labels),
+            "precision": num_found / max(1, num_detections)}
+
+def recommend(results, recall_tolerance=RECALL_TOLERANCE):
+    """ Returns the result with the fastest tiling whose recall is within recall_tolerance of the best one's. """
+    best_recall = max(result["recall"] for result in results)
+    good_enough = [result for result in results if result["recall"] >= best_recall - recall_tolerance]
+    return min(good_enough, key=lambda result: (result["seconds_per_image"], result["tiles_per_image"]))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Finds the cheapest tiling that doesn't lose recall on a set of labeled images.")
+    parser.add_argument("image_directory", help="Full-size images, each with a YOLO label file next to it.")
+    parser.add_argument("-o", "--output", default=os.path.join(REPO_DIR, TILING_CONFIG_PATH),
+                        help="Where to save the recommended tiling. Defaults to where ProgramManager looks for it.")
+    parser.add_argument("--report", default=REPORT_FILENAME, help="Where to save how every tiling did, as JSON.")
+    parser.add_argument("--recall-tolerance", type=float, default=RECALL_TOLERANCE,
+                        help="How much less recall than the best tiling we'll accept for a faster one.")
+    args = parser.parse_args(argv)
+
+    # Everything gets made absolute, since we change directory below.
+    labeled_images = find_labeled_images(os.path.abspath(args.image_directory))
+    if labeled_images == []:
+        print(f"No labeled images in {args.image_directory}.", file=sys.stderr)
+        return 1
+    output_path, report_path = os.path.abspath(args.output), os.path.abspath(args.report)
+
+    # darknet and the model are found relative to the top of the repository.
+    os.chdir(REPO_DIR)
+    with open(NAMES_PATH) as names_file:
+        class_names = [line.strip() for line in names_file if line.strip() != ""]
+
+    results = []
+    with DarknetBackend(DetectorSession()) as detector:
+        for tiling in candidate_tilings():
+            results.append(evaluate(tiling, labeled_images, detector, class_names))
+            result = results[-1]
+            print(f"{tiling}: {result['tiles_per_image']:.1f} tiles/image, {result['seconds_per_image']:.2f} s/image, "
+                  f"recall {result['recall']:.3f}, precision {result['precision']:.3f}", flush=True)
+
+    best = recommend(results, args.recall_tolerance)
+    TilingConfig(**best["tiling"]).save(output_path)
+    with open(report_path, "w") as report_file:
+        json.dump({"recommended": best, "results": results}, report_file, indent=4)
+    print(f"Saved {TilingConfig(**best['tiling'])} to {output_path}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
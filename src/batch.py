@@ -0,0 +1,160 @@
+""" batch.py
+    Runs a batch of images through the whole pipeline on a pool of worker processes.
+    Each worker keeps its own detector (usually a darknet session), and exports a .gexf file next to each image.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.util import Finalize
+
+from program_manager import ProgramManager
+from post_processing import PostProcessingManager
+from detector_backend import make_detector, DARKNET_BACKEND
+from detection_cache import DetectionCache
+from segmentation_executor import SegmentationExecutor
+from crop_processing import load_tiling_config
+import tracing
+
+# How many threads each worker's detector (darknet, through OpenMP) and segmentation get.
+DEFAULT_THREADS_PER_WORKER = 2
+# If a worker dies outright (e.g. gets OOM-killed), every image it had in flight gets this many tries in a fresh pool.
+MAX_POOL_ATTEMPTS = 2
+
+# Each worker process has its own detector, so the model is only loaded once per worker.
+worker_detector = None
+worker_cache = None
+worker_segmentation_executor = None
+worker_tiling = None
+
+
+class BatchResult:
+    def __init__(self, image_path, export_path=None, error=None, num_tiles=0, num_skipped_tiles=0, peak_memory=None):
+        """ image_path:        The image that was processed.
+            export_path:       Where its graph got saved, or None if processing failed.
+            error:             A description of what went wrong, or None if nothing did.
+            num_tiles:         How many tiles the image got split into. 0 if it wasn't tiled.
+            num_skipped_tiles: How many of those were background, so darknet never saw them.
+            peak_memory:       Each stage's peak memory (see tracing.peak_memory), or {} if memory wasn't tracked. """
+        self.image_path = image_path
+        self.export_path = export_path
+        self.error = error
+        self.num_tiles = num_tiles
+        self.num_skipped_tiles = num_skipped_tiles
+        self.peak_memory = peak_memory if peak_memory is not None else {}
+
+    def succeeded(self):
+        return self.error is None
+
+
+def default_worker_count(threads_per_worker):
+    return max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+def gexf_path_for(image_path):
+    """ Returns the path that image_path's graph gets exported to. """
+    return image_path[:image_path.rfind(".")] + ".gexf"
+
+def init_worker(threads_per_worker, use_cache=True, tiling=None, detectors_per_worker=1, backend=DARKNET_BACKEND, segment_on_processes=False):
+    """ Runs once in each worker process, before it gets any images.
+        tiling:               The TilingConfig to tile images with. None means the one in crop_processing.TILING_CONFIG_PATH.
+        detectors_per_worker: How many darknets to split each image's tiles (and threads_per_worker) between.
+        backend:              Which detector backend to use (one of detector_backend.BACKEND_NAMES).
+        segment_on_processes: Whether to segment on threads_per_worker processes instead of threads. """
+    global worker_detector, worker_cache, worker_segmentation_executor, worker_tiling
+    worker_tiling = tiling if tiling is not None else load_tiling_config()
+    worker_cache = DetectionCache(tiling=worker_tiling, backend=backend) if use_cache else None
+    worker_segmentation_executor = SegmentationExecutor(threads_per_worker, segment_on_processes)
+    worker_detector = make_detector(backend, threads_per_worker, detectors_per_worker)
+    # Shut darknet and the segmentation processes down cleanly when the pool shuts this worker down.
+    # The segmentation pool's queues have finalizers of their own (at priority 10), so it has to go before them.
+    Finalize(worker_detector, worker_detector.close, exitpriority=10)
+    Finalize(worker_segmentation_executor, worker_segmentation_executor.close, exitpriority=20)
+
+def process_image(image_path, surface_node_is_enabled=True):
+    """ Runs the whole pipeline on one image and exports its graph. Returns a BatchResult. """
+    with tracing.tracer.collect() as spans, tracing.stage("process_image", is_wrapper=True, image=image_path):
+        program_manager = ProgramManager(worker_detector, worker_cache, worker_segmentation_executor, worker_tiling)
+        program_manager.open_image_file(image_path)
+        program_manager.compute_bounding_boxes_overlaps_and_cell_centers()
+        program_manager.compute_cell_network_edges()
+
+        export_path = gexf_path_for(image_path)
+        with tracing.stage("build_graph"):
+            post_processing_manager = PostProcessingManager(bio_objs=program_manager.bio_objs)
+        post_processing_manager.export_to_gexf(export_path, surface_node_is_enabled)
+    # Don't keep this image in shared memory while the worker waits for its next one.
+    worker_segmentation_executor.release_image()
+    num_skipped_tiles = len(program_manager.skipped_tiles)
+    return BatchResult(image_path, export_path, num_tiles=len(program_manager.tiles) + num_skipped_tiles, num_skipped_tiles=num_skipped_tiles,
+                       peak_memory=tracing.peak_memory(spans))
+
+def run_serially(image_paths, threads_per_worker=DEFAULT_THREADS_PER_WORKER, surface_node_is_enabled=True, report_progress=None, use_cache=True,
+                 tiling=None, detectors_per_worker=1, backend=DARKNET_BACKEND, segment_on_processes=False):
+    """ Does the same thing as run_batch, but one image at a time in this process. """
+    init_worker(threads_per_worker, use_cache, tiling, detectors_per_worker, backend, segment_on_processes)
+
+    results = []
+    try:
+        for image_path in image_paths:
+            try:
+                result = process_image(image_path, surface_node_is_enabled)
+            except Exception as e:
+                result = BatchResult(image_path, error=f"{type(e).__name__}: {e}")
+            results.append(result)
+            if report_progress is not None:
+                report_progress(result, len(results), len(image_paths))
+    finally:
+        worker_detector.close()
+        worker_segmentation_executor.close()
+
+    return results
+
+def run_batch(image_paths, workers=None, threads_per_worker=DEFAULT_THREADS_PER_WORKER, surface_node_is_enabled=True, report_progress=None, use_cache=True,
+              tiling=None, detectors_per_worker=1, backend=DARKNET_BACKEND, segment_on_processes=False):
+    """ image_paths:        The images to process.
+        workers:            How many worker processes to use. Defaults to as many as fit in os.cpu_count().
+        threads_per_worker: How many threads each worker's darknet gets.
+        report_progress:    Called as report_progress(result, num_done, num_images) in this process
+                            each time an image finishes (or fails).
+        use_cache:          Whether to reuse (and save) detections from the detection cache.
+        tiling:             The TilingConfig to tile images with. None means the one in crop_processing.TILING_CONFIG_PATH.
+        detectors_per_worker: How many darknets each worker splits its images' tiles (and its threads) between.
+        backend:            Which detector backend the workers use (one of detector_backend.BACKEND_NAMES).
+        segment_on_processes: Whether each worker segments on threads_per_worker processes of its own instead of threads.
+        Returns a BatchResult for each image, in the same order as image_paths.
+        A failure on one image doesn't stop the others. """
+    if workers is None:
+        workers = default_worker_count(threads_per_worker)
+
+    results = {}
+    attempts = {image_path: 0 for image_path in image_paths}
+    remaining = list(image_paths)
+    # We don't fork, because the GUI process has threads and Qt state that shouldn't be copied into workers.
+    context = multiprocessing.get_context("spawn")
+
+    while remaining:
+        retry = []
+        with ProcessPoolExecutor(max_workers=min(workers, len(remaining)), mp_context=context,
+                                 initializer=init_worker, initargs=(threads_per_worker, use_cache, tiling, detectors_per_worker, backend,
+                                                                                      segment_on_processes)) as executor:
+            futures = {executor.submit(process_image, image_path, surface_node_is_enabled): image_path for image_path in remaining}
+            for future in as_completed(futures):
+                image_path = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    attempts[image_path] += 1
+                    if attempts[image_path] < MAX_POOL_ATTEMPTS:
+                        retry.append(image_path)
+                        continue
+                    result = BatchResult(image_path, error=f"worker process died: {e}")
+                except Exception as e:
+                    result = BatchResult(image_path, error=f"{type(e).__name__}: {e}")
+
+                results[image_path] = result
+                if report_progress is not None:
+                    report_progress(result, len(results), len(image_paths))
+        remaining = retry
+
+    return [results[image_path] for image_path in image_paths]
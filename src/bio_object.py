@@ -1,7 +1,7 @@
-from copy import deepcopy
 import numpy as np
-from skimage import measure, filters, morphology, color
-import matplotlib.pyplot as plt
+from detection_store import DetectionStore, CLASSIFICATIONS, NO_TILE, class_id_for, gather_boxes, gather_rows, \
+                            bbox_overlap_mask, bbox_containment_mask
+from spatial_index import BBoxGrid
 
 # This is the allowable distance betwen objects to count them as overlapping
 # Having it as a hardcoded value is really just asking for trouble, but we're doing it for now.
@@ -9,81 +9,127 @@ OVERLAP_TOLERANCE = 10
 
 def compute_all_cell_bbox_overlaps(bio_objects):
     """ Computes the overlaps of the bounding boxes containing cells. """
-    for i in range(len(bio_objects) - 1):
-        cell1 = bio_objects[i]
-        if not cell1.is_cell():
-            continue
-
-        for j in range(i + 1, len(bio_objects)):
-            cell2 = bio_objects[j]
-            if not cell2.is_cell():
-                continue
-
-            if cell1.bbox_overlaps_with_other_bbox(cell2):
-                cell1.overlapping_bboxes.append(cell2)
-            if cell2.bbox_overlaps_with_other_bbox(cell1):
-                cell2.overlapping_bboxes.append(cell1)
+    cell_grid = BBoxGrid(filter(lambda obj: obj.is_cell(), bio_objects))
+    for cell in cell_grid.bio_objs:
+        cell.overlapping_bboxes += find_cell_bbox_overlaps(cell, cell_grid)
 
 
 def compute_nanowire_to_cell_bbox_overlaps(bio_objects):
     """ Computes the overlaps between nanowires and cells. Stores the overlaps in the nanowire
         objects only. """
-    for nanowire in bio_objects:
-        if not nanowire.is_nanowire():
-            continue
-        for cell in bio_objects:
-            # only looking at nanowire to cell overlaps, skip nanowires
-            if not cell.is_cell():
-                continue
-
-            # want overlaps where nanowire and cell partially overlap or cell completely overlaps nanowire
-            if nanowire.bbox_overlaps_with_other_bbox(cell) or nanowire.bbox_is_contained_in_other_bbox(cell):
-                nanowire.overlapping_bboxes.append(cell)
+    cell_grid = BBoxGrid(filter(lambda obj: obj.is_cell(), bio_objects))
+    for nanowire in filter(lambda obj: obj.is_nanowire(), bio_objects):
+        nanowire.overlapping_bboxes += find_nanowire_bbox_overlaps(nanowire, cell_grid)
+
+
+def find_cell_bbox_overlaps(cell, cell_grid):
+    """ Returns the cells in cell_grid (a BBoxGrid holding only cells) that overlap with cell, in the order they were added. """
+    # The grid only hands back boxes within OVERLAP_TOLERANCE of cell, and those are the only ones that can overlap.
+    candidates = [other for other in cell_grid.near(cell, OVERLAP_TOLERANCE) if other is not cell]
+    overlaps = bbox_overlap_mask(gather_boxes([cell]), gather_boxes(candidates), OVERLAP_TOLERANCE)[0]
+    return [other for other, overlap in zip(candidates, overlaps) if overlap]
+
+
+def find_nanowire_bbox_overlaps(nanowire, cell_grid):
+    """ Returns the cells in cell_grid (a BBoxGrid holding only cells) that overlap with nanowire, in the order they were added. """
+    candidates = cell_grid.near(nanowire, OVERLAP_TOLERANCE)
+    nanowire_box, candidate_boxes = gather_boxes([nanowire]), gather_boxes(candidates)
+    # want overlaps where nanowire and cell partially overlap or cell completely overlaps nanowire
+    overlaps = bbox_overlap_mask(nanowire_box, candidate_boxes, OVERLAP_TOLERANCE)[0] | bbox_containment_mask(nanowire_box, candidate_boxes)[0]
+    return [cell for cell, overlap in zip(candidates, overlaps) if overlap]
+
+
+def copy_bio_objects(bio_objs, store, dx=0, dy=0):
+    """ Copies bio_objs into store, shifted by (dx, dy), and returns views of the copies.
+        Only the detection data gets copied, not contours, overlaps or edges. """
+    source_store, rows = gather_rows(bio_objs)
+    new_rows = store.copy_rows(source_store, rows, dx, dy)
+    return [BioObject.view(store, row, bio_obj.id) for row, bio_obj in zip(new_rows.tolist(), bio_objs)]
+
+
+class Segmentation:
+    def __init__(self, bio_obj, image):
+        """ The thresholded pixels in bio_obj's bounding box, and the regions they make up. Centers, contours and
+            nanowire intersections all start from this, so we only threshold each object once.
+            The labels and regions get computed the first time someone asks for them. """
+        from skimage import filters
+
+        self.bbox = bio_obj.bbox()
+        self.image = image
+        self.is_cell = bio_obj.is_cell()
+
+        x1, y1, x2, y2 = self.bbox
+        # creates an np.array image of just the current bbox
+        subimage = np.asarray(image[y1:y2 + 1, x1:x2 + 1])
+        # makes the image binary using li thresholding method
+        self.threshold = filters.threshold_li(subimage) # we should test if li is actually the best method in all lighting environments
+        self.binary = subimage > self.threshold
+
+        self.binary_labels = None
+        self.binary_regions = None
+        self.labels = None
+        self.regions = None
+
+    def is_for(self, bio_obj, image):
+        return self.image is image and self.bbox == bio_obj.bbox()
+
+    def binary_labels_and_regions(self):
+        """ Returns the labels and regions of the thresholded pixels, as they are. """
+        from skimage import measure
+
+        if self.binary_labels is None:
+            self.binary_labels = measure.label(self.binary, connectivity=2)
+            self.binary_regions = measure.regionprops(self.binary_labels)
+        return self.binary_labels, self.binary_regions
+
+    def labels_and_regions(self):
+        """ Returns the labels and regions that contours come from. For cells, the thresholded pixels get cleaned up first. """
+        from skimage import measure, morphology
+
+        if self.labels is None:
+            if self.is_cell:
+                self.labels = measure.label(morphology.dilation(morphology.erosion(self.binary)), connectivity=2)
+                self.regions = measure.regionprops(self.labels)
+            else:
+                self.labels, self.regions = self.binary_labels_and_regions()
+        return self.labels, self.regions
+
+
+def segment(bio_obj, image):
+    """ Returns the Segmentation of bio_obj in image, reusing the last one unless bio_obj's bounding box has changed. """
+    if bio_obj.segmentation is None or not bio_obj.segmentation.is_for(bio_obj, image):
+        bio_obj.segmentation = Segmentation(bio_obj, image)
+    return bio_obj.segmentation
 
 
 def compute_cell_center(bio_obj, image):
     """ finds some point in the cell"""
-    placeholder_image = np.zeros(image.shape, dtype=np.uint8)
-
-    subimage = np.asarray(image[bio_obj.y1:bio_obj.y2 + 1, bio_obj.x1:bio_obj.x2 + 1])
+    from skimage import measure
 
-    threshold = filters.threshold_li(subimage)
-    subimage = subimage > threshold
-
-    placeholder_image[bio_obj.y1:bio_obj.y2 + 1, bio_obj.x1:bio_obj.x2 + 1] = subimage
+    segmentation = segment(bio_obj, image)
+    x1, y1, _, _ = segmentation.bbox
 
+    # Leave out the pixels that belong to the bounding boxes of other cells, unless that leaves nothing.
+    subimage = segmentation.binary.copy()
     for overlap_box in bio_obj.overlapping_bboxes:
-        placeholder_image[overlap_box.y1:overlap_box.y2 + 1, overlap_box.x1:overlap_box.x2 + 1] = 0
+        subimage[max(0, overlap_box.y1 - y1):max(0, overlap_box.y2 + 1 - y1), max(0, overlap_box.x1 - x1):max(0, overlap_box.x2 + 1 - x1)] = False
 
-    if np.any(placeholder_image[bio_obj.y1:bio_obj.y2 + 1, bio_obj.x1:bio_obj.x2 + 1]):
-        subimage = placeholder_image[bio_obj.y1:bio_obj.y2 + 1, bio_obj.x1:bio_obj.x2 + 1]
+    if bio_obj.overlapping_bboxes != [] and np.any(subimage):
+        # finds connected bright regions (foreground)
+        labels_mask = measure.label(subimage, connectivity=2)
+        # determines quantitative properties of each region of brightness
+        regions = measure.regionprops(labels_mask)
+    else:
+        _, regions = segmentation.binary_labels_and_regions()
 
-    # finds connected bright regions (foreground)
-    labels_mask = measure.label(subimage, connectivity=2)
-    # determines quantitative properties of each region of brightness
-    regions = measure.regionprops(labels_mask)
-    # sorts the regions, largest area to smallest
-    regions.sort(key=lambda x: x.area, reverse=True)
     # take the region with largest area and find its center
-    y, x = map(int, regions[0].centroid) # subimage ils bbox
+    y, x = map(int, max(regions, key=lambda x: x.area).centroid) # subimage ils bbox
     # find cell center in original image
-    bio_obj.cell_center = (bio_obj.x1 + x, bio_obj.y1 + y)
+    bio_obj.cell_center = (x1 + x, y1 + y)
 
 
 def compute_subimage_labels_and_region_data(bio_obj, image):
-    # creates an np.array image of just the current bbox
-    subimage = np.asarray(image[bio_obj.y1:bio_obj.y2 + 1, bio_obj.x1:bio_obj.x2 + 1])
-
-    # makes the image binary using li thresholding method
-    threshold = filters.threshold_li(subimage) # we should test if li is actually the best method in all lighting environments
-    subimage = subimage > threshold
-    if bio_obj.is_cell():
-        subimage = morphology.erosion(subimage)
-        subimage = morphology.dilation(subimage)
-    subimage_labels = measure.label(subimage, connectivity=2)
-    subimage_regions = measure.regionprops(subimage_labels)
-
-    return subimage_labels, subimage_regions
+    return segment(bio_obj, image).labels_and_regions()
 
 
 def compute_contour(bio_obj, image):
@@ -97,31 +143,142 @@ def compute_contour(bio_obj, image):
         bio_obj_region_label = max(subimage_regions, key=lambda x: x.bbox_area).label
     else:
         raise ValueError("What is this BioObject?")
-    subimage_contour = subimage_labels == bio_obj_region_label
-    contour = np.zeros(image.shape, dtype=np.uint8)
-    contour[bio_obj.y1:bio_obj.y2 + 1, bio_obj.x1:bio_obj.x2 + 1] = subimage_contour
-    bio_obj.contour = contour
+    # The contour only covers the bounding box, so it takes memory in proportion to the object and not the image.
+    bio_obj.contour = subimage_labels == bio_obj_region_label
+    bio_obj.contour_offset = (bio_obj.x1, bio_obj.y1)
+
+
+def mask_windows(mask1, offset1, mask2, offset2):
+    """ Returns the parts of mask1 and mask2 that cover the same pixels of the image, as two views of the same shape.
+        offset1, offset2: the (x, y) position in the image of each mask's top left pixel. """
+    x1, y1 = max(offset1[0], offset2[0]), max(offset1[1], offset2[1])
+    x2 = min(offset1[0] + mask1.shape[1], offset2[0] + mask2.shape[1])
+    y2 = min(offset1[1] + mask1.shape[0], offset2[1] + mask2.shape[0])
+    if x2 <= x1 or y2 <= y1:
+        return mask1[:0, :0], mask2[:0, :0]
+    return mask1[y1 - offset1[1]:y2 - offset1[1], x1 - offset1[0]:x2 - offset1[0]], \
+           mask2[y1 - offset2[1]:y2 - offset2[1], x1 - offset2[0]:x2 - offset2[0]]
+
+
+def contours_intersect(bio_obj1, bio_obj2):
+    """ Returns True if the contours of bio_obj1 and bio_obj2 share a pixel. Both contours must already be computed. """
+    window1, window2 = mask_windows(bio_obj1.contour, bio_obj1.contour_offset, bio_obj2.contour, bio_obj2.contour_offset)
+    return np.logical_and(window1, window2).any()
 
 
 class BioObject:
-    def __init__(self, x1, y1, x2, y2, id_no, classification):
+    # There can be thousands of these, so they don't get a __dict__. Their detection data lives in a DetectionStore.
+    __slots__ = ("store", "row", "id", "segmentation", "contour", "contour_offset", "adj_list", "edge_list", "overlapping_bboxes")
+
+    def __init__(self, x1, y1, x2, y2, id_no, classification, confidence=None, store=None, tile_index=NO_TILE):
         """ Represents an object found by YOLO. (and also the electrode)
             x1, y1, x2, y2: px coordinates of xmin xmax ymin ymax of bounding box.
-            classification: the classification of this object. This will eventually have to change. """
+            classification: the classification of this object. This will eventually have to change.
+            confidence:     how sure YOLO was about this object, between 0 and 1. None if YOLO didn't find it.
+            store:          the DetectionStore to keep this object's data in. If this is None, it gets a store of its own.
+            tile_index:     the index of the tile YOLO found this object in, if it came from a tile. """
+        if store is None:
+            store = DetectionStore(capacity=1)
+        self.init_view(store, store.append(x1, y1, x2, y2, classification, confidence, tile_index), id_no)
+
+    @classmethod
+    def view(cls, store, row, id_no):
+        """ Makes a BioObject for a row that's already in store. """
+        bio_obj = cls.__new__(cls)
+        bio_obj.init_view(store, row, id_no)
+        return bio_obj
+
+    def init_view(self, store, row, id_no):
+        self.store = store
+        self.row = row
         self.id = id_no
-        self.x1 = x1
-        self.y1 = y1
-        self.x2 = x2
-        self.y2 = y2
-        self.classification = classification
-        self.cell_center = (0, 0)
+        # The Segmentation of this object's bounding box, once something has needed it.
+        self.segmentation = None
+        # A boolean mask of this object's pixels within its bounding box, and the (x, y) position of its top left pixel.
         self.contour = None
+        self.contour_offset = None
         # list of the adjacent cells in the cells list
         self.adj_list = []
         # list of the edges this cell participates in
         self.edge_list = []
         self.overlapping_bboxes = []
 
+    @property
+    def x1(self):
+        return int(self.store.boxes[self.row, 0])
+
+    @x1.setter
+    def x1(self, value):
+        self.store.boxes[self.row, 0] = value
+        self.invalidate_segmentation()
+
+    @property
+    def y1(self):
+        return int(self.store.boxes[self.row, 1])
+
+    @y1.setter
+    def y1(self, value):
+        self.store.boxes[self.row, 1] = value
+        self.invalidate_segmentation()
+
+    @property
+    def x2(self):
+        return int(self.store.boxes[self.row, 2])
+
+    @x2.setter
+    def x2(self, value):
+        self.store.boxes[self.row, 2] = value
+        self.invalidate_segmentation()
+
+    @property
+    def y2(self):
+        return int(self.store.boxes[self.row, 3])
+
+    @y2.setter
+    def y2(self, value):
+        self.store.boxes[self.row, 3] = value
+        self.invalidate_segmentation()
+
+    @property
+    def classification(self):
+        return CLASSIFICATIONS[self.store.class_ids[self.row]]
+
+    @classification.setter
+    def classification(self, value):
+        self.store.class_ids[self.row] = class_id_for(value)
+        self.invalidate_segmentation()
+
+    @property
+    def confidence(self):
+        confidence = float(self.store.confidences[self.row])
+        return None if np.isnan(confidence) else confidence
+
+    @confidence.setter
+    def confidence(self, value):
+        self.store.confidences[self.row] = np.nan if value is None else value
+
+    @property
+    def cell_center(self):
+        return tuple(self.store.cell_centers[self.row].tolist())
+
+    @cell_center.setter
+    def cell_center(self, value):
+        self.store.cell_centers[self.row] = value
+
+    @property
+    def tile_index(self):
+        return int(self.store.tile_indices[self.row])
+
+    def bbox(self):
+        return tuple(self.store.boxes[self.row].tolist())
+
+    def invalidate_segmentation(self):
+        """ Forgets everything computed from the pixels in this object's bounding box.
+            Setting the coordinates or classification does this for you. """
+        self.segmentation = None
+        self.contour = None
+        self.contour_offset = None
+
     def is_cell(self):
         return self.classification == "cell"
 
@@ -0,0 +1,167 @@
+""" cli.py
+    The command line interface, for running the pipeline without the GUI. This never imports Qt or matplotlib.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from crop_processing import IMAGE_EXTENSIONS, REUNIFY_MODES, TILING_CONFIG_PATH, load_tiling_config
+from batch import run_batch, run_serially, DEFAULT_THREADS_PER_WORKER
+from detection_cache import DetectionCache
+from detector_backend import BACKEND_NAMES, DARKNET_BACKEND, check_backend
+from mosaic import run_mosaics
+import tracing
+
+def find_images(paths):
+    """ Expands directories in paths into the images inside them. """
+    image_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            image_paths += sorted(os.path.join(path, filename) for filename in os.listdir(path)
+                                  if any(filename.lower().endswith(ext) for ext in IMAGE_EXTENSIONS))
+        else:
+            image_paths.append(path)
+    return image_paths
+
+def process(args):
+    image_paths = find_images(args.paths)
+    if image_paths == []:
+        print("No images to process.", file=sys.stderr)
+        return 1
+
+    try:
+        check_backend(args.backend)
+    except ImportError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    if args.tiling_config is not None and not os.path.exists(args.tiling_config):
+        print(f"Can't open {args.tiling_config}: No such file.", file=sys.stderr)
+        return 1
+    tiling = load_tiling_config(args.tiling_config if args.tiling_config is not None else TILING_CONFIG_PATH)
+    if args.min_tile_foreground is not None:
+        tiling.min_tile_foreground = args.min_tile_foreground
+    if args.reunify is not None:
+        tiling.reunify_mode = args.reunify
+
+    # A Chrome trace gets made from the trace log, so we need one even if we weren't asked for it.
+    trace_log_path = args.trace if args.trace is not None else tracing.tracer.log_path
+    log_is_temporary = trace_log_path is None and args.chrome_trace is not None
+    if log_is_temporary:
+        trace_log_fd, trace_log_path = tempfile.mkstemp(prefix="bacteria-networks-trace-", suffix=".jsonl")
+        os.close(trace_log_fd)
+    if trace_log_path is not None:
+        tracing.enable(trace_log_path, args.profile_stage if args.profile_stage is not None else tracing.tracer.profile_stage)
+    if args.trace_memory or args.trace_allocations:
+        tracing.enable_memory_tracking(args.trace_allocations)
+    start = time.time()
+
+    def report_progress(result, num_done, num_images):
+        status = f"wrote {result.export_path}" if result.succeeded() else f"FAILED: {result.error}"
+        if result.num_skipped_tiles != 0:
+            status += f" (skipped {result.num_skipped_tiles} of {result.num_tiles} tiles as background)"
+        if result.peak_memory != {}:
+            status += f" ({tracing.describe_peak_memory(result.peak_memory)})"
+        print(f"[{num_done}/{num_images}] {result.image_path}: {status}", flush=True)
+
+    if args.mosaic:
+        results = run_mosaics(image_paths, args.workers, args.threads_per_worker, not args.no_surface_node, report_progress, tiling, args.backend,
+                              args.segment_on_processes)
+    elif args.workers == 1 or len(image_paths) == 1:
+        # Not worth starting a process pool for.
+        results = run_serially(image_paths, args.threads_per_worker, not args.no_surface_node, report_progress, not args.no_cache, tiling,
+                               args.detectors, args.backend, args.segment_on_processes)
+    else:
+        results = run_batch(image_paths, args.workers, args.threads_per_worker, not args.no_surface_node, report_progress, not args.no_cache, tiling,
+                            args.detectors, args.backend, args.segment_on_processes)
+
+    num_skipped_tiles = sum(result.num_skipped_tiles for result in results)
+    if num_skipped_tiles != 0:
+        print(f"Skipped {num_skipped_tiles} of {sum(result.num_tiles for result in results)} tiles as background.")
+
+    measured = [result for result in results if result.peak_memory != {}]
+    if measured != []:
+        highest = max(measured, key=lambda result: max(peak["peak_rss_bytes"] for peak in result.peak_memory.values()))
+        print(f"Highest {tracing.describe_peak_memory(highest.peak_memory)}, on {highest.image_path}.")
+
+    if trace_log_path is not None and tracing.tracer.track_memory:
+        for record in tracing.unfinished_stages(tracing.read_log(trace_log_path, since=start)):
+            print(f"Process {record['pid']} died in {record['name']} {record['counts']} "
+                  f"with {tracing.format_bytes(record['rss_bytes'] or 0)} resident when it started.", file=sys.stderr)
+
+    if args.chrome_trace is not None:
+        tracing.write_chrome_trace(tracing.read_log(trace_log_path, since=start), args.chrome_trace)
+        if log_is_temporary:
+            os.remove(trace_log_path)
+
+    num_failures = sum(not result.succeeded() for result in results)
+    if num_failures != 0:
+        print(f"{num_failures} of {len(results)} images failed.", file=sys.stderr)
+        return 1
+    return 0
+
+def clear_cache(args):
+    DetectionCache().invalidate()
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="run.py", description="Finds nanowire networks in images of Shewanella oneidensis. "
+                                                                "Run with no arguments to open the GUI.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    process_parser = subparsers.add_parser("process", help="Run the whole pipeline on images and export a .gexf file next to each one.")
+    process_parser.add_argument("paths", nargs="+", help="Images, or directories of images.")
+    process_parser.add_argument("-j", "--workers", type=int, default=None,
+                                help="How many images to process at once. Defaults to as many as fit on this machine's cores.")
+    process_parser.add_argument("-t", "--threads-per-worker", type=int, default=DEFAULT_THREADS_PER_WORKER,
+                                help="How many threads darknet and segmentation get in each worker.")
+    process_parser.add_argument("-d", "--detectors", type=int, default=1,
+                                help="How many darknets each worker splits its tiles and its -t threads between. "
+                                     "Worth raising when there are fewer images than cores, since one darknet doesn't scale to many threads.")
+    process_parser.add_argument("--backend", choices=BACKEND_NAMES, default=DARKNET_BACKEND,
+                                help="What runs the model. darknet runs darknet/darknet on tiles written to files; "
+                                     "opencv runs the model in-process with OpenCV's DNN module (needs opencv-python); "
+                                     "stub finds blobs by thresholding instead, for trying out the rest of the pipeline.")
+    process_parser.add_argument("--segment-on-processes", action="store_true",
+                                help="Segment each worker's objects on -t processes (sharing the image through shared memory) "
+                                     "instead of threads. Processes sidestep the GIL, so this pays off on big, dense images.")
+    process_parser.add_argument("--no-surface-node", action="store_true", help="Leave the surface node out of the exported graphs.")
+    process_parser.add_argument("--no-cache", action="store_true", help="Always run darknet, even on images it has already seen.")
+    process_parser.add_argument("--tiling-config", default=None,
+                                help="A tiling config written by scripts/tune_tiling.py. "
+                                     f"Defaults to {TILING_CONFIG_PATH}, or the built-in tiling if that doesn't exist.")
+    process_parser.add_argument("--min-tile-foreground", type=float, default=None,
+                                help="Tiles with less than this fraction of foreground pixels are skipped as background. "
+                                     "0 runs darknet on every tile. Overrides the tiling config.")
+    process_parser.add_argument("--reunify", choices=REUNIFY_MODES, default=None,
+                                help="How to put the tiles' detections back together. fusion merges the detections from "
+                                     "every tile, so it gets away with fewer tiles. Overrides the tiling config.")
+    process_parser.add_argument("--mosaic", action="store_true",
+                                help="Process each image in overlapping regions, for images too big to process all at once. "
+                                     "The images have to be TIFFs, so each region can be read without decoding the rest. "
+                                     "-j is how many regions to process at once. Doesn't use the cache.")
+    process_parser.add_argument("--trace", default=None, metavar="LOG",
+                                help="Append the wall and CPU time and counts of every stage to LOG, one JSON object per line. "
+                                     f"(Setting {tracing.TRACE_ENV_VAR} does the same thing.) darknet's stderr goes to LOG.darknet.log.")
+    process_parser.add_argument("--chrome-trace", default=None, metavar="PATH",
+                                help="Save this run's stages in Chrome's trace format, for chrome://tracing or Perfetto.")
+    process_parser.add_argument("--profile-stage", default=None, metavar="STAGE",
+                                help="Run every instance of STAGE (e.g. compute_cell_contact) under cProfile, "
+                                     "and save its stats next to the trace log. Needs --trace or --chrome-trace.")
+    process_parser.add_argument("--trace-memory", action="store_true",
+                                help="Track each stage's peak RSS and how much it grew the RSS, and report each image's peak. "
+                                     f"(Setting {tracing.MEMORY_ENV_VAR} does the same thing.)")
+    process_parser.add_argument("--trace-allocations", action="store_true",
+                                help="Do what --trace-memory does, and also run tracemalloc to log each stage's peak traced memory, "
+                                     "and the lines that allocated the most for each image (or mosaic region). This slows processing down a lot. "
+                                     f"(Setting {tracing.ALLOCATIONS_ENV_VAR} does the same thing.)")
+    process_parser.set_defaults(run=process)
+
+    clear_cache_parser = subparsers.add_parser("clear-cache", help="Forget all saved detections.")
+    clear_cache_parser.set_defaults(run=clear_cache)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
@@ -3,20 +3,117 @@
 """
 
 from PIL import Image
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
 
+from bio_object import BioObject, copy_bio_objects
+from detection_store import DetectionStore, CLASSIFICATIONS, gather_boxes, gather_rows, bbox_centers
+from spatial_index import BBoxGrid
+import tracing
+
+# These are the defaults. A TilingConfig (usually loaded from TILING_CONFIG_PATH) can change them.
 TILE_OVERLAP = 3 # 2 -> 50% overlap, 3 -> 33% overlap, etc.
 TILE_SIZE = 416
 CROP_OFFSET = ((TILE_OVERLAP - 1) * TILE_SIZE) // TILE_OVERLAP
+# The tiling that works best for the model, as picked by scripts/tune_tiling.py. It lives with the model it was tuned for.
+TILING_CONFIG_PATH = "models/model_6/tiling.json"
+
+# The ways of putting the tiles' detections back together. (See reunify_tiles.)
+REUNIFY_BY_CONFIDENCE_REGION = "confidence-region"
+REUNIFY_BY_FUSION = "fusion"
+REUNIFY_MODES = (REUNIFY_BY_CONFIDENCE_REGION, REUNIFY_BY_FUSION)
+# Fusion doesn't need an object's center to land in some tile's confidence region, so its tiles can overlap a lot less.
+# They only have to overlap by about the size of a cell, so most cells are whole in some tile.
+FUSION_TILE_OVERLAP_PX = 64
+# Two whole detections from different tiles are the same object if their boxes overlap at least this much (IoU).
+FUSION_MIN_IOU = 0.5
+# A detection cut off by a tile edge is part of a whole one if at least this much of it is inside the whole one.
+FUSION_MIN_CONTAINMENT = 0.8
+# A detection is cut off by a tile edge if it comes this close to it (in px). Image edges don't count.
+TILE_EDGE_MARGIN = 2
+# Two cells cut off on either side of a seam between tiles are one cell if they line up along the seam at least this much.
+SEAM_MIN_ALIGNMENT = 0.5
 
 IMAGE_EXTENSIONS = (".tiff", ".tif", ".png", ".jpg", ".jpeg", ".gif", ".bmp")
+# How many pixels of each row we look at when looking for the information bar.
+INFO_BAR_SAMPLES = 10
+
+# A pixel is foreground if it's at least this much brighter or darker than the image's median (in grayscale, from 0 to 1).
+FOREGROUND_CONTRAST = 0.1
+# Tiles with less than this fraction of foreground pixels are background, so they don't get run through darknet.
+# 0 means every tile gets run.
+MIN_TILE_FOREGROUND = 0.001
+# We only look at every BACKGROUND_SAMPLE_STRIDEth pixel in each direction to find the median.
+BACKGROUND_SAMPLE_STRIDE = 4
+
+# Tiles get handed to darknet through here when it exists, since it's backed by RAM.
+SHM_DIR = "/dev/shm"
+TILE_WRITER_THREADS = 4
+# PNG is lossless, so the compression level only trades file size for speed. 1 is the fastest.
+TILE_PNG_COMPRESSION = 1
+
+
+class TilingConfig:
+    def __init__(self, tile_size=TILE_SIZE, tile_overlap=TILE_OVERLAP, fusion_overlap_px=FUSION_TILE_OVERLAP_PX,
+                 reunify_mode=REUNIFY_BY_CONFIDENCE_REGION, min_tile_foreground=MIN_TILE_FOREGROUND):
+        """ How images get cut into tiles for darknet, and how the tiles' detections get put back together.
+            tile_size:           The side length of each tile, in px.
+            tile_overlap:        2 -> 50% overlap, 3 -> 33% overlap, etc. Used with REUNIFY_BY_CONFIDENCE_REGION.
+            fusion_overlap_px:   How much the tiles overlap, in px. Used with REUNIFY_BY_FUSION.
+            reunify_mode:        One of REUNIFY_MODES. (See reunify_tiles.)
+            min_tile_foreground: Tiles with less than this fraction of foreground pixels don't get run through darknet. """
+        if reunify_mode not in REUNIFY_MODES:
+            raise ValueError(f"Unknown reunify mode {reunify_mode!r}")
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.fusion_overlap_px = fusion_overlap_px
+        self.reunify_mode = reunify_mode
+        self.min_tile_foreground = min_tile_foreground
+
+    def crop_offset(self):
+        """ Returns how far apart the tiles start. """
+        if self.reunify_mode == REUNIFY_BY_FUSION:
+            return self.tile_size - self.fusion_overlap_px
+        return ((self.tile_overlap - 1) * self.tile_size) // self.tile_overlap
+
+    def to_dict(self):
+        return {"tile_size": self.tile_size, "tile_overlap": self.tile_overlap, "fusion_overlap_px": self.fusion_overlap_px,
+                "reunify_mode": self.reunify_mode, "min_tile_foreground": self.min_tile_foreground}
+
+    def key(self):
+        """ Returns a string that's different for every tiling that could give different detections. """
+        return json.dumps(self.to_dict(), sort_keys=True) + f" {FOREGROUND_CONTRAST}"
+
+    def save(self, path=TILING_CONFIG_PATH):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def __str__(self):
+        if self.reunify_mode == REUNIFY_BY_FUSION:
+            return f"{self.tile_size} px tiles, overlapping by {self.fusion_overlap_px} px, fused"
+        return f"{self.tile_size} px tiles, 1/{self.tile_overlap} overlap, by confidence region"
+
+
+def load_tiling_config(path=TILING_CONFIG_PATH):
+    """ Returns the TilingConfig saved at path, or the default one if there isn't one there.
+        Settings missing from the file keep their defaults. """
+    try:
+        with open(path) as f:
+            return TilingConfig(**json.load(f))
+    except FileNotFoundError:
+        return TilingConfig()
 
 
 class Tile:
-    def __init__(self, img, x1, y1, x2, y2, filename_no_ext):
-        """ img:            The cropped PIL Image object.
+    def __init__(self, img, x1, y1, x2, y2, filename_no_ext, store=None):
+        """ img:            The cropped image, as a NumPy array. This is usually a view into the full image.
             x1, y1, x2, y2: The position of this tile in the larger image.
-            filename:       A unique identifier for this tile. (No file extension) """
+            filename:       A unique identifier for this tile. (No file extension)
+            store:          The DetectionStore that objects added with add_cells go into. """
 
         self.img = img
         self.x1 = x1
@@ -28,6 +125,7 @@ class Tile:
         # Their coordinates are relative to this tile.
         # (i.e. if a bounding box starts on the left edge of this tile, its x1 is 0)
         self.bio_objs = []
+        self.store = store if store is not None else DetectionStore()
 
         # This will be used as a unique identifier for this crop.
         self.filename_no_ext = f"{filename_no_ext}_{self.x1}_{self.y1}"
@@ -46,29 +144,124 @@ class Tile:
 
     def add_cell(self, cell):
         """ box: A bounding box with coordinates relative to the untiled image. """
-        cell = deepcopy(cell)
-        cell.x1 = max(cell.x1, self.x1) - self.x1
-        cell.y1 = max(cell.y1, self.y1) - self.y1
-        cell.x2 = min(cell.x2, self.x2) - self.x1
-        cell.y2 = min(cell.y2, self.y2) - self.y1
-        self.bio_objs.append(cell)
+        return self.add_cells([cell])[0]
+
+    def add_cells(self, cells, dx=0, dy=0):
+        """ Adds copies of cells to this tile, all at once, and returns the copies.
+            cells: Bounding boxes with coordinates relative to the untiled image, once they're shifted by (dx, dy). """
+        new_cells = copy_bio_objects(cells, self.store, dx - self.x1, dy - self.y1)
+        if new_cells != []:
+            rows = slice(new_cells[0].row, new_cells[-1].row + 1)
+            self.store.boxes[rows, :2] = np.maximum(self.store.boxes[rows, :2], 0)
+            self.store.boxes[rows, 2:] = np.minimum(self.store.boxes[rows, 2:], (self.width(), self.height()))
+        self.bio_objs += new_cells
+        return new_cells
+
+    def padded_img(self):
+        """ Returns this tile's image, padded with black wherever the tile hangs off the edge of the full image.
+            (This is what PIL's crop used to do for us.) """
+        if self.img.shape[:2] == (self.height(), self.width()):
+            return self.img
+        padded = np.zeros((self.height(), self.width(), *self.img.shape[2:]), dtype=self.img.dtype)
+        padded[:self.img.shape[0], :self.img.shape[1]] = self.img
+        return padded
 
     def save(self, directory="."):
         """ Saves this tile as a cropped image and (potentially) an associated label file.
             Note: This will convert bounding boxes to relative, because that's how YOLO likes it. """
-        self.img.save(f"{directory}/{self.filename_no_ext}.jpg", "JPEG", subsampling=0, quality=100)
+        Image.fromarray(self.padded_img()).save(f"{directory}/{self.filename_no_ext}.jpg", "JPEG", subsampling=0, quality=100)
+
+
+def write_png(img, path):
+    """ Losslessly writes img (a NumPy array) to path, for darknet to read. """
+    Image.fromarray(img).save(path, "PNG", compress_level=TILE_PNG_COMPRESSION)
+    return path
+
+
+class TileHandoff:
+    def __init__(self, images):
+        """ Hands images (usually tiles' padded_img()) to darknet through a fresh directory that only this run uses.
+            Use it in a with statement; it gives back their paths (in the same order as images),
+            and deletes the directory afterwards. """
+        self.images = images
+        self.directory = None
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix="bacteria-networks-", dir=SHM_DIR if os.path.isdir(SHM_DIR) else None)
+        paths = [f"{self.directory}/tile_{i}.png" for i in range(len(self.images))]
+        with tracing.stage("write_tiles", tiles=len(self.images)) as span:
+            with ThreadPoolExecutor(max_workers=TILE_WRITER_THREADS) as executor:
+                list(executor.map(write_png, self.images, paths))
+            if tracing.tracer.is_enabled():
+                span.count(bytes_written=sum(os.path.getsize(path) for path in paths))
+        return paths
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def find_info_bar(img):
+    """ Returns the first row of the information bar at the bottom of img (a NumPy array), or img's height if it doesn't have one.
+        A row counts as part of the information bar if every pixel we sample from it is pure black or pure white
+        (in every channel). """
+    height, width = img.shape[:2]
+    samples = img[:, ::max(1, width // INFO_BAR_SAMPLES)]
+    is_black_or_white = (samples == 0) | (samples == 255)
+    if is_black_or_white.ndim == 3:
+        is_black_or_white = is_black_or_white.all(axis=2)
+    info_bar_rows = np.flatnonzero(is_black_or_white.all(axis=1))
+    return int(info_bar_rows[0]) if len(info_bar_rows) > 0 else height
+
+def make_tiles(img, filename, tile_size=TILE_SIZE, crop_offset=CROP_OFFSET):
+    """ img: A NumPy array to be tiled. The tiles are views into it, not copies.
+        filename: A filename, usually the filename of img without its extension.
+        tile_size, crop_offset: The size of the tiles, and how far apart they start. """
+    height, width = img.shape[:2]
+    # Every tile starts inside the image. The last row and column of tiles hang off its edges,
+    # so the edges of the image are in some tile's confidence region.
+    return [Tile(img[y1:y1 + tile_size, x1:x1 + tile_size], x1, y1, x1 + tile_size, y1 + tile_size, filename)
+            for y1 in range(0, height, crop_offset) for x1 in range(0, width, crop_offset)]
 
+def tile_image(img, filename, tile_size=TILE_SIZE, crop_offset=CROP_OFFSET):
+    """ Cuts the information bar off the bottom of img, and tiles what's left. Returns the tiles. """
+    return make_tiles(img[:find_info_bar(img)], filename, tile_size, crop_offset)
 
-def make_tiles(img, filename):
-    """ img: A PIL.Image to be tiled.
-        filename: A filename, usually the filename of img without its extension. """
-    tiles = []
-    for r in range(0, img.height + CROP_OFFSET, CROP_OFFSET): # We add CROP_OFFSET here to make sure some crop has the edge of the image in its confidence region.
-        for c in range(0, img.width + CROP_OFFSET, CROP_OFFSET):
-            x1, y1, x2, y2 = (r, c, r + TILE_SIZE, c + TILE_SIZE)
-            tiles.append(Tile(img.crop((x1, y1, x2, y2)), x1, y1, x2, y2, filename))
+def tile_foreground_fractions(tiles, gray_image, contrast=FOREGROUND_CONTRAST):
+    """ Returns an array with the fraction of each tile's pixels that are foreground.
+        gray_image: The grayscale version of the image the tiles came from.
+        The parts of a tile that hang off the edge of the image count as background. """
+    tile_boxes = np.array([(tile.x1, tile.y1, tile.x1 + tile.img.shape[1], tile.y1 + tile.img.shape[0]) for tile in tiles]).reshape(-1, 4)
+    if len(tile_boxes) == 0:
+        return np.zeros(0)
+    # The tiles might not cover all of gray_image, like when the information bar got cut off.
+    covered = gray_image[:tile_boxes[:, 3].max(), :tile_boxes[:, 2].max()]
+    background = np.median(covered[::BACKGROUND_SAMPLE_STRIDE, ::BACKGROUND_SAMPLE_STRIDE])
 
-    return tiles
+    # Every tile edge is on one of these lines, so each tile is made of whole cells of the grid they make. The tiles start
+    # crop_offset apart, so there are at most about twice as many lines across (or down) as tiles, and counting each cell's foreground
+    # pixels a strip of rows at a time takes memory for the cells and one strip, not for the whole image.
+    x_edges = np.unique(tile_boxes[:, [0, 2]])
+    y_edges = np.unique(tile_boxes[:, [1, 3]])
+    # A summed-area table of the cells: counts[i, j] is how many foreground pixels are above y_edges[i] and left of x_edges[j].
+    # Then each tile's count only takes four lookups, no matter how big the tiles are.
+    counts = np.zeros((len(y_edges), len(x_edges)), dtype=np.int64)
+    for i, (strip_y1, strip_y2) in enumerate(zip(y_edges[:-1], y_edges[1:])):
+        is_foreground = np.abs(covered[strip_y1:strip_y2] - background) >= contrast
+        counts[i + 1, 1:] = np.add.reduceat(np.count_nonzero(is_foreground, axis=0), x_edges[:-1])
+    np.cumsum(counts, axis=0, out=counts)
+    np.cumsum(counts, axis=1, out=counts)
+
+    x1, y1, x2, y2 = (np.searchsorted(edges, coordinates) for edges, coordinates in zip((x_edges, y_edges) * 2, tile_boxes.T))
+    tile_counts = counts[y2, x2] - counts[y1, x2] - counts[y2, x1] + counts[y1, x1]
+    tile_areas = np.array([tile.width() * tile.height() for tile in tiles])
+    return tile_counts / tile_areas
+
+def skip_empty_tiles(tiles, gray_image, min_foreground=MIN_TILE_FOREGROUND):
+    """ Returns (the tiles worth running darknet on, the tiles that are just background), each in the order of tiles. """
+    if min_foreground <= 0:
+        return tiles, []
+    is_empty = tile_foreground_fractions(tiles, gray_image) < min_foreground
+    return [tile for tile, empty in zip(tiles, is_empty) if not empty], [tile for tile, empty in zip(tiles, is_empty) if empty]
 
 def save_tiles(tiles, output_dir):
     """ tiles: A list of Tile objects. """
@@ -81,26 +274,182 @@ def rebuild_original_image(tiles):
 
     return Image.new(mode="L", size=(full_width, full_height)) # mode "L" is for 8-bit greyscale
 
-def in_confidence_region(pt):
-    return TILE_SIZE // (2 * TILE_OVERLAP) <= pt[0] <= (2 * TILE_OVERLAP - 1) * TILE_SIZE // (2 * TILE_OVERLAP) \
-       and TILE_SIZE // (2 * TILE_OVERLAP) <= pt[1] <= (2 * TILE_OVERLAP - 1) * TILE_SIZE // (2 * TILE_OVERLAP)
+def in_confidence_region(pt, tile_size=TILE_SIZE, tile_overlap=TILE_OVERLAP):
+    return tile_size // (2 * tile_overlap) <= pt[0] <= (2 * tile_overlap - 1) * tile_size // (2 * tile_overlap) \
+       and tile_size // (2 * tile_overlap) <= pt[1] <= (2 * tile_overlap - 1) * tile_size // (2 * tile_overlap)
 
-def reunify_tiles(tiles, full_image):
-    """ Takes all the tiles in tiles, and returns a new Tile object representing the untiled image. """
+def confidence_region_mask(pts, tile_size=TILE_SIZE, tile_overlap=TILE_OVERLAP):
+    """ Does in_confidence_region on each row of an (n, 2) array of points. """
+    return ((tile_size // (2 * tile_overlap) <= pts) & (pts <= (2 * tile_overlap - 1) * tile_size // (2 * tile_overlap))).all(axis=1)
 
+def make_full_tile(full_image, store=None):
+    """ Makes a Tile covering all of full_image, for reunified bounding boxes to go into.
+        store: The DetectionStore the reunified bounding boxes go into. """
     # This is not really a tile, but I want to use Tile's methods.
-    full_tile = Tile(full_image, 0, 0, *full_image.size, "full_image")
+    return Tile(full_image, 0, 0, full_image.shape[1], full_image.shape[0], "full_image", store)
+
+def reunify_tile(tile, full_tile, tile_overlap=TILE_OVERLAP):
+    """ Moves the bounding boxes in tile that belong to it into full_tile. Returns the ones that got added. """
+    # We only keep the bounding boxes whose centers are in the confidence region of this tile
+    is_in_confidence_region = confidence_region_mask(bbox_centers(gather_boxes(tile.bio_objs)), tile.width(), tile_overlap)
+    cells = [cell for cell, keep in zip(tile.bio_objs, is_in_confidence_region) if keep]
+    return full_tile.add_cells(cells, tile.x1, tile.y1)
+
+def reunify_tiles(tiles, full_image, store=None, tiling=None):
+    """ Takes all the tiles in tiles, and returns a new Tile object representing the untiled image.
+        store:  The DetectionStore the reunified bounding boxes go into.
+        tiling: The TilingConfig the tiles were made with. None means the default one.
+                With REUNIFY_BY_CONFIDENCE_REGION, each object comes from the tile that has its center in its confidence region.
+                With REUNIFY_BY_FUSION, each object's detections from every tile that saw it get merged (see fuse_tiles). """
+    tiling = tiling if tiling is not None else TilingConfig()
+    if tiling.reunify_mode == REUNIFY_BY_FUSION:
+        return fuse_tiles(tiles, full_image, store)
+
+    full_tile = make_full_tile(full_image, store)
 
     for tile in tiles:
-        for cell in tile.bio_objs:
-            # If the center of the bounding box is in the confidence region of this tile
-            if in_confidence_region(cell.center()):
-                # Then we add the bounding box to the big image
-                new_cell = deepcopy(cell)
-                new_cell.x1 += tile.x1
-                new_cell.x2 += tile.x1
-                new_cell.y1 += tile.y1
-                new_cell.y2 += tile.y1
-                full_tile.add_cell(new_cell)
+        reunify_tile(tile, full_tile, tiling.tile_overlap)
+
+    return full_tile
+
+
+class DetectionCluster:
+    def __init__(self, index, box, class_id, tile_index):
+        """ The detections (from any tile) of one object. Its box is the box of its first detection, which is its best one.
+            index:      The index of that first detection.
+            tile_index: The index of the tile it came from. """
+        self.x1, self.y1, self.x2, self.y2 = box
+        self.class_id = class_id
+        self.indices = [index]
+        # A tile only sees an object once, so two detections from the same tile are always different objects.
+        self.tile_indices = {tile_index}
+
+    def add(self, index, tile_index):
+        self.indices.append(index)
+        self.tile_indices.add(tile_index)
+
+
+def cut_off_sides(tile, boxes, full_image):
+    """ Returns an (n, 4) boolean array saying whether each of boxes (relative to tile) is cut off by tile's
+        left, top, right and bottom edges. The edges of the image don't cut anything off. """
+    height, width = full_image.shape[:2]
+    edge_is_inside_image = np.array([tile.x1 > 0, tile.y1 > 0,
+                                     tile.img.shape[1] == tile.width() and tile.x2 < width,
+                                     tile.img.shape[0] == tile.height() and tile.y2 < height])
+    comes_near_edge = np.stack((boxes[:, 0] <= TILE_EDGE_MARGIN, boxes[:, 1] <= TILE_EDGE_MARGIN,
+                                boxes[:, 2] >= tile.width() - TILE_EDGE_MARGIN, boxes[:, 3] >= tile.height() - TILE_EDGE_MARGIN), axis=1)
+    return comes_near_edge & edge_is_inside_image
+
+def box_intersection(box1, box2):
+    return max(0, min(box1[2], box2[2]) - max(box1[0], box2[0])) * max(0, min(box1[3], box2[3]) - max(box1[1], box2[1]))
+
+def box_area(box):
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+def duplicate_score(box, cluster_box, is_cut_off):
+    """ Returns how sure we are that box is another detection of the object with cluster_box, or 0 if it isn't one. """
+    intersection = box_intersection(box, cluster_box)
+    iou = intersection / max(1, box_area(box) + box_area(cluster_box) - intersection)
+    if iou >= FUSION_MIN_IOU:
+        return iou
+    # A box cut off by a tile edge is only part of the object, so it can't overlap the whole object's box much.
+    if is_cut_off and intersection / max(1, box_area(box)) >= FUSION_MIN_CONTAINMENT:
+        return intersection / max(1, box_area(box))
+    return 0
+
+def meet_at_seam(box1, cut_off1, box2, cut_off2, is_nanowire):
+    """ Returns True if box1 and box2 look like the two halves of an object that got cut in two by the seam between their tiles. """
+    if box_intersection(box1, box2) == 0:
+        return False
+    # One has to be cut off on the side facing the other. (left/right are columns 0/2, top/bottom are 1/3)
+    across_x = (cut_off1[2] and cut_off2[0]) or (cut_off1[0] and cut_off2[2])
+    across_y = (cut_off1[3] and cut_off2[1]) or (cut_off1[1] and cut_off2[3])
+    if not (across_x or across_y):
+        return False
+    # Nanowires can cross a seam at any angle, but a cell's halves have to line up.
+    if is_nanowire:
+        return True
+    axis = 1 if across_x else 0 # The axis along the seam
+    along = min(box1[axis + 2], box2[axis + 2]) - max(box1[axis], box2[axis])
+    return along >= SEAM_MIN_ALIGNMENT * min(box1[axis + 2] - box1[axis], box2[axis + 2] - box2[axis])
+
+def fuse_tiles(tiles, full_image, store=None):
+    """ Does the same thing as reunify_tiles, but keeps every tile's detections, and merges the ones of the same object.
+        Each object's box is the confidence-weighted average of its detections that weren't cut off by a tile edge.
+        Objects that every tile cut off (like nanowires longer than the tiles overlap) get stitched back together
+        from their pieces on either side of each seam. """
+    full_tile = make_full_tile(full_image, store)
+
+    pieces = [(tile, bio_obj) for tile in tiles for bio_obj in tile.bio_objs]
+    tile_of = [tile_index for tile_index, tile in enumerate(tiles) for _ in tile.bio_objs]
+    if pieces == []:
+        return full_tile
+    boxes = np.concatenate([gather_boxes(tile.bio_objs) + (tile.x1, tile.y1, tile.x1, tile.y1) for tile in tiles if tile.bio_objs != []])
+    cut_off = np.concatenate([cut_off_sides(tile, gather_boxes(tile.bio_objs), full_image) for tile in tiles if tile.bio_objs != []])
+    source_store, rows = gather_rows([bio_obj for _, bio_obj in pieces])
+    class_ids = source_store.class_ids[rows]
+    confidences = np.nan_to_num(source_store.confidences[rows], nan=1.0)
+    ids = np.array([bio_obj.id for _, bio_obj in pieces])
+    is_cut_off = cut_off.any(axis=1)
+
+    # Whole detections come first, most confident first, so each cluster's box starts from its best detection.
+    clusters = []
+    cluster_grid = BBoxGrid()
+    for i in np.lexsort((ids, -confidences, is_cut_off)).tolist():
+        box = boxes[i].tolist()
+        candidates = [cluster for cluster in cluster_grid.query(*box) if tile_of[i] not in cluster.tile_indices]
+        scores = [(duplicate_score(box, (cluster.x1, cluster.y1, cluster.x2, cluster.y2), is_cut_off[i]), cluster)
+                  for cluster in candidates if cluster.class_id == class_ids[i]]
+        best_score, best_cluster = max(scores, key=lambda score: score[0], default=(0, None))
+        if best_score == 0 and is_cut_off[i]:
+            # YOLO can't always tell what a sliver at the edge of a tile is, so it might be part of an object of another class.
+            scores = [(duplicate_score(box, (cluster.x1, cluster.y1, cluster.x2, cluster.y2), True), cluster)
+                      for cluster in candidates if not is_cut_off[cluster.indices[0]]]
+            best_score, best_cluster = max(scores, key=lambda score: score[0], default=(0, None))
+        if best_score > 0:
+            best_cluster.add(i, tile_of[i])
+        else:
+            cluster = DetectionCluster(i, box, class_ids[i], tile_of[i])
+            clusters.append(cluster)
+            cluster_grid.insert(cluster)
+
+    # Stitch the objects that were only ever seen in pieces. parents is a union-find forest over those clusters.
+    cut_clusters = [cluster for cluster in clusters if is_cut_off[cluster.indices].all()]
+    parents = {id(cluster): cluster for cluster in cut_clusters}
+
+    def root(cluster):
+        while parents[id(cluster)] is not cluster:
+            cluster = parents[id(cluster)]
+        return cluster
+
+    cut_grid = BBoxGrid(cut_clusters)
+    for cluster in cut_clusters:
+        i = cluster.indices[0]
+        for other in cut_grid.query(cluster.x1, cluster.y1, cluster.x2, cluster.y2):
+            j = other.indices[0]
+            if other is not cluster and other.class_id == cluster.class_id \
+               and meet_at_seam(boxes[i], cut_off[i], boxes[j], cut_off[j], CLASSIFICATIONS[cluster.class_id] == "nanowire"):
+                parents[id(root(other))] = root(cluster)
+
+    groups = {}
+    for cluster in clusters:
+        key = id(root(cluster)) if id(cluster) in parents else id(cluster)
+        groups.setdefault(key, []).extend(cluster.indices)
+
+    fused_store = DetectionStore(capacity=len(groups))
+    fused = []
+    for indices in groups.values():
+        indices = np.array(indices)
+        whole = indices[~is_cut_off[indices]]
+        if len(whole) > 0:
+            box = np.rint(np.average(boxes[whole], axis=0, weights=np.maximum(confidences[whole], 1e-6))).astype(np.int64)
+        else: # All we have is pieces, so the object is all of them put together.
+            box = np.concatenate((boxes[indices, :2].min(axis=0), boxes[indices, 2:].max(axis=0)))
+        best = indices[np.argmax(confidences[indices])]
+        _, bio_obj = pieces[best]
+        fused.append(BioObject(*box.tolist(), int(ids[indices].min()), bio_obj.classification, bio_obj.confidence, fused_store, bio_obj.tile_index))
 
+    # Keep the objects in the order their first detections came in, like the other mode does.
+    fused.sort(key=lambda bio_obj: bio_obj.id)
+    full_tile.add_cells(fused)
     return full_tile
@@ -0,0 +1,159 @@
+""" detection_cache.py
+    An on-disk cache of YOLO's detections, so we don't have to run darknet again on an image it has already seen.
+    Entries are keyed on the image's bytes, the model files (for backends that use them), the detector backend, and the tiling
+    parameters (including which tiles get skipped), so changing any of those makes the old entries unreachable.
+    The cache has a size limit; the least recently used entries go first.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from bio_object import BioObject
+from detection_store import DetectionStore
+from crop_processing import load_tiling_config
+from detector_backend import DARKNET_BACKEND, STUB_BACKEND
+from yolo import DATA_PATH, CFG_PATH, WEIGHTS_PATH
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "bacteria-networks", "detections")
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+# Bump this whenever the entry format or the way detections are produced changes.
+CACHE_VERSION = 3
+HASH_CHUNK_SIZE = 1024 * 1024
+MODEL_FILES = (DATA_PATH, CFG_PATH, WEIGHTS_PATH)
+# Hashing the weights is slow, so we remember their hash for as long as their size and mtime don't change.
+MODEL_HASHES_FILENAME = "model_hashes.json"
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DetectionCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=MAX_CACHE_BYTES, tiling=None, backend=DARKNET_BACKEND):
+        """ tiling:  The ProgramManager's TilingConfig, since tiling differently gives different detections.
+                     None means the one in crop_processing.TILING_CONFIG_PATH.
+            backend: The name of the ProgramManager's detector backend, since they don't find exactly the same things. """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.tiling = tiling if tiling is not None else load_tiling_config()
+        self.backend = backend
+        self.model_hash = None
+
+    def compute_model_hash(self):
+        """ Returns a hash of all the model files, rehashing only the ones that changed since we last looked. """
+        if self.model_hash is not None:
+            return self.model_hash
+
+        known_hashes_path = os.path.join(self.directory, MODEL_HASHES_FILENAME)
+        try:
+            with open(known_hashes_path) as f:
+                known_hashes = json.load(f)
+        except (OSError, ValueError):
+            known_hashes = {}
+
+        digest = hashlib.sha256()
+        for path in MODEL_FILES:
+            stat = os.stat(path)
+            key = os.path.abspath(path)
+            if known_hashes.get(key, {}).get("stamp") != [stat.st_size, stat.st_mtime_ns]:
+                known_hashes[key] = {"stamp": [stat.st_size, stat.st_mtime_ns], "hash": hash_file(path)}
+            digest.update(known_hashes[key]["hash"].encode())
+
+        self.write_atomically(known_hashes_path, json.dumps(known_hashes))
+        self.model_hash = digest.hexdigest()
+        return self.model_hash
+
+    def key_for(self, image_path):
+        """ Returns the key of image_path's entry, for get, put and invalidate. This reads the whole file, so it should
+            only be done once for each image, when it gets loaded. """
+        digest = hashlib.sha256()
+        # The stub backend doesn't use the model, so it shouldn't need the model files (or wait for the weights to be hashed).
+        model_hash = "no model" if self.backend == STUB_BACKEND else self.compute_model_hash()
+        digest.update(f"{CACHE_VERSION} {self.backend} {self.tiling.key()} {model_hash} ".encode())
+        digest.update(hash_file(image_path).encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key, store=None):
+        """ Returns the cached detections for the image with key (see key_for) as a list of BioObjects, or None if there
+            aren't any.
+            store: The DetectionStore to put them in. """
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Touching the entry marks it as recently used.
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        if store is None:
+            store = DetectionStore(capacity=len(entry))
+        return [BioObject(x1, y1, x2, y2, id_no, classification, confidence, store)
+                for id_no, classification, x1, y1, x2, y2, confidence in entry]
+
+    def put(self, key, bio_objs):
+        """ Caches the detections for the image with key (see key_for). bio_objs should only contain objects YOLO found
+            (not the surface). """
+        entry = [(obj.id, obj.classification, obj.x1, obj.y1, obj.x2, obj.y2, obj.confidence) for obj in bio_objs]
+        self.write_atomically(self.entry_path(key), json.dumps(entry))
+        self.evict()
+
+    def write_atomically(self, path, contents):
+        """ Several processes can share the cache, so we never let anyone see a half-written file. """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+        os.replace(temp_path, path)
+
+    def entries(self):
+        """ Returns (mtime, size, path) for every entry, oldest first. """
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json") or filename == MODEL_HASHES_FILENAME:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except FileNotFoundError: # Someone else evicted it
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, filename)))
+        return sorted(entries)
+
+    def evict(self):
+        """ Deletes the least recently used entries until the cache fits in max_bytes. """
+        entries = self.entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def invalidate(self, key=None):
+        """ Forgets the detections for the image with key (see key_for), or everything if key is None. """
+        if not os.path.isdir(self.directory):
+            return
+        if key is not None:
+            paths = [self.entry_path(key)]
+        else:
+            paths = [path for _, _, path in self.entries()]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,151 @@
+""" detection_store.py
+    Keeps the detections for an image in one set of NumPy arrays, one row per object, instead of spreading them
+    over thousands of Python objects. BioObjects are thin views onto the rows of a DetectionStore.
+    This also has vectorized versions of BioObject's bounding box geometry, for working on many boxes at once.
+"""
+
+import numpy as np
+
+# Each row's class id is an index into this. Classifications we haven't seen before get added on the end.
+CLASSIFICATIONS = ["surface", "cell", "nanowire"]
+# The tile of origin of objects that didn't come from a tile.
+NO_TILE = -1
+INITIAL_CAPACITY = 64
+
+
+def class_id_for(classification):
+    if classification not in CLASSIFICATIONS:
+        CLASSIFICATIONS.append(classification)
+    return CLASSIFICATIONS.index(classification)
+
+
+class DetectionStore:
+    # The names of the per-row arrays. They all have the same number of rows.
+    COLUMNS = ("boxes", "class_ids", "confidences", "cell_centers", "tile_indices")
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        """ An empty store with room for capacity rows. It grows as rows get added, so capacity is only a hint. """
+        self.size = 0
+        # x1, y1, x2, y2 in px
+        self.boxes = np.zeros((capacity, 4), dtype=np.int64)
+        self.class_ids = np.zeros(capacity, dtype=np.int16)
+        # NaN if YOLO didn't find the object
+        self.confidences = np.full(capacity, np.nan)
+        self.cell_centers = np.zeros((capacity, 2), dtype=np.int64)
+        # The index of the tile each object was found in, or NO_TILE.
+        self.tile_indices = np.full(capacity, NO_TILE, dtype=np.int32)
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, num_rows):
+        """ Makes sure there's room for num_rows more rows. """
+        capacity = len(self.class_ids)
+        if self.size + num_rows <= capacity:
+            return
+        capacity = max(capacity, 1)
+        while capacity < self.size + num_rows:
+            capacity *= 2
+        for name in self.COLUMNS:
+            old_column = getattr(self, name)
+            new_column = np.empty((capacity, *old_column.shape[1:]), dtype=old_column.dtype)
+            new_column[:self.size] = old_column[:self.size]
+            setattr(self, name, new_column)
+
+    def append(self, x1, y1, x2, y2, classification, confidence=None, tile_index=NO_TILE):
+        """ Adds one row, and returns its index. """
+        self.reserve(1)
+        row = self.size
+        self.boxes[row] = (x1, y1, x2, y2)
+        self.class_ids[row] = class_id_for(classification)
+        self.confidences[row] = np.nan if confidence is None else confidence
+        self.cell_centers[row] = (0, 0)
+        self.tile_indices[row] = tile_index
+        self.size += 1
+        return row
+
+    def extend(self, boxes, class_ids, confidences, tile_index=NO_TILE):
+        """ Adds a row for each of boxes (an (n, 4) array), with the matching class_ids and confidences.
+            Returns the indices of the new rows. """
+        new_rows = np.arange(self.size, self.size + len(boxes))
+        self.reserve(len(boxes))
+        self.boxes[new_rows] = boxes
+        self.class_ids[new_rows] = class_ids
+        self.confidences[new_rows] = confidences
+        self.cell_centers[new_rows] = (0, 0)
+        self.tile_indices[new_rows] = tile_index
+        self.size += len(boxes)
+        return new_rows
+
+    def copy_rows(self, other, rows, dx=0, dy=0):
+        """ Copies rows of the DetectionStore other into this one, with their boxes shifted by (dx, dy).
+            Returns the indices of the new rows. """
+        new_rows = np.arange(self.size, self.size + len(rows))
+        self.reserve(len(rows))
+        self.boxes[new_rows] = other.boxes[rows] + (dx, dy, dx, dy)
+        self.class_ids[new_rows] = other.class_ids[rows]
+        self.confidences[new_rows] = other.confidences[rows]
+        self.cell_centers[new_rows] = other.cell_centers[rows]
+        self.tile_indices[new_rows] = other.tile_indices[rows]
+        self.size += len(rows)
+        return new_rows
+
+    def active_boxes(self):
+        """ Returns the boxes of every row in use. """
+        return self.boxes[:self.size]
+
+
+def gather_rows(bio_objs):
+    """ Returns (store, rows) such that store's rows hold the data of bio_objs, in order.
+        This is free when bio_objs all live in the same store, which they usually do. """
+    if bio_objs == []:
+        return DetectionStore(capacity=0), np.zeros(0, dtype=np.int64)
+
+    store = bio_objs[0].store
+    if all(bio_obj.store is store for bio_obj in bio_objs):
+        return store, np.fromiter((bio_obj.row for bio_obj in bio_objs), dtype=np.int64, count=len(bio_objs))
+
+    gathered = DetectionStore(capacity=len(bio_objs))
+    for bio_obj in bio_objs:
+        gathered.copy_rows(bio_obj.store, [bio_obj.row])
+    return gathered, np.arange(len(bio_objs))
+
+def gather_boxes(bio_objs):
+    """ Returns an (n, 4) array of the bounding boxes of bio_objs. """
+    store, rows = gather_rows(bio_objs)
+    return store.boxes[rows]
+
+
+def bbox_widths(boxes):
+    return boxes[:, 2] - boxes[:, 0]
+
+def bbox_heights(boxes):
+    return boxes[:, 3] - boxes[:, 1]
+
+def bbox_centers(boxes):
+    """ Returns an (n, 2) array of the centers of boxes. """
+    return np.stack((boxes[:, 0] + bbox_widths(boxes) / 2, boxes[:, 1] + bbox_heights(boxes) / 2), axis=1)
+
+def bbox_overlap_mask(boxes, other_boxes, tolerance):
+    """ Returns an (n, m) boolean array whose [i, j] entry is what BioObject.bbox_overlaps_with_other_bbox
+        would say for box i of boxes and box j of other_boxes. """
+    x1 = boxes[:, None, 0] - tolerance
+    y1 = boxes[:, None, 1] - tolerance
+    x2 = boxes[:, None, 2] + tolerance
+    y2 = boxes[:, None, 3] + tolerance
+    other_x1, other_y1, other_x2, other_y2 = (other_boxes[None, :, i] for i in range(4))
+
+    # An x side or y side of other is within the expanded box's range
+    x_side_is_in = ((x1 <= other_x1) & (other_x1 <= x2)) | ((x1 <= other_x2) & (other_x2 <= x2))
+    y_side_is_in = ((y1 <= other_y1) & (other_y1 <= y2)) | ((y1 <= other_y2) & (other_y2 <= y2))
+
+    # A corner of other is in the expanded box. (This also covers other being inside it.)
+    return (x_side_is_in & y_side_is_in) \
+         | (x_side_is_in & (other_y1 <= y1) & (y2 <= other_y2)) \
+         | (y_side_is_in & (other_x1 <= x1) & (x2 <= other_x2)) # other intersects through the sides
+
+def bbox_containment_mask(boxes, other_boxes):
+    """ Returns an (n, m) boolean array whose [i, j] entry is what BioObject.bbox_is_contained_in_other_bbox
+        would say for box i of boxes and box j of other_boxes. """
+    return (boxes[:, None, 0] < other_boxes[None, :, 2]) & (other_boxes[None, :, 0] < boxes[:, None, 2]) \
+         & (boxes[:, None, 1] < other_boxes[None, :, 3]) & (other_boxes[None, :, 1] < boxes[:, None, 3])
@@ -0,0 +1,218 @@
+""" detector_backend.py
+    The things that can find cells and nanowires in an image. ProgramManager hands a backend its tiles as arrays,
+    and gets back BioObjects, without caring how they were found:
+    - DarknetBackend runs darknet as a subprocess, so the tiles get written to files for it.
+    - OpenCVBackend loads the same model into this process with OpenCV's DNN module, and runs the tiles in batches.
+    - StubBackend doesn't use the model at all. It finds blobs by thresholding, which is quick and deterministic,
+      for trying out the rest of the pipeline.
+"""
+
+import importlib.util
+
+import numpy as np
+
+from crop_processing import TileHandoff, FOREGROUND_CONTRAST
+from image_loader import LoadedImage
+from yolo import DetectorSession, DetectorPool, iter_yolo_detections, bio_objects_from_arrays, relative_to_pixel_boxes, \
+                 CFG_PATH, WEIGHTS_PATH, NAMES_PATH
+from detection_store import class_id_for
+import tracing
+
+DARKNET_BACKEND = "darknet"
+OPENCV_BACKEND = "opencv"
+STUB_BACKEND = "stub"
+BACKEND_NAMES = (DARKNET_BACKEND, OPENCV_BACKEND, STUB_BACKEND)
+
+# These are darknet's defaults for `detector test`, so OpenCVBackend finds what darknet would.
+DETECTION_THRESHOLD = 0.25
+NMS_THRESHOLD = 0.45
+# How many tiles OpenCVBackend runs through the network at once.
+OPENCV_BATCH_SIZE = 8
+
+# StubBackend ignores blobs smaller than this (in px), and calls the ones thinner than this nanowires.
+STUB_MIN_AREA = 20
+STUB_MAX_NANOWIRE_WIDTH = 4 # px
+
+
+class DetectorBackend:
+    """ Finds cells and nanowires in images. Subclasses implement detect. """
+    name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def detect(self, images, update_progress_bar=None, paths=None):
+        """ images:              The images to look in, as NumPy arrays (usually tiles).
+            update_progress_bar: A function to update the progress bar.
+            paths:               The files images came from, if they came straight from files, so backends that read files
+                                 don't have to write them out again.
+            Yields (index, bio_objs) for each of images, in order, as soon as it's done with it (and every image before it).
+            The BioObjects' coordinates are relative to their image, and their ids count up from 1 across all the images. """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class DarknetBackend(DetectorBackend):
+    name = DARKNET_BACKEND
+
+    def __init__(self, session=None):
+        """ session: A DetectorSession (or DetectorPool) to reuse. If this is None, every call to detect starts a darknet
+                     just for its images. """
+        self.session = session
+
+    def detect(self, images, update_progress_bar=None, paths=None):
+        if paths is not None:
+            yield from iter_yolo_detections(paths, update_progress_bar, self.session)
+            return
+        with TileHandoff(images) as paths:
+            yield from iter_yolo_detections(paths, update_progress_bar, self.session)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+def read_network_size(cfg_path):
+    """ Returns the (width, height) that the network in a darknet .cfg file takes its input at. """
+    size = {}
+    section = None
+    with open(cfg_path) as cfg_file:
+        for line in cfg_file:
+            line = line.split("#")[0].strip()
+            if line.startswith("["):
+                section = line
+            elif section == "[net]" and "=" in line:
+                key, value = (part.strip() for part in line.split("=", 1))
+                if key in ("width", "height"):
+                    size[key] = int(value)
+    return size["width"], size["height"]
+
+def to_rgb(img):
+    """ Returns img as an 8-bit RGB array, which is what darknet turns every image into. """
+    if img.dtype != np.uint8:
+        img = (LoadedImage(img).gray() * 255).round().astype(np.uint8)
+    if img.ndim == 2:
+        return np.dstack((img, img, img))
+    return img[:, :, :3]
+
+
+class OpenCVBackend(DetectorBackend):
+    name = OPENCV_BACKEND
+
+    def __init__(self, threads=None, batch_size=OPENCV_BATCH_SIZE):
+        """ Runs the model in this process on the CPU, with OpenCV's DNN module. The model is loaded once, here.
+            threads:    How many threads OpenCV gets. None means OpenCV's default.
+            batch_size: How many tiles go through the network at once. """
+        check_backend(OPENCV_BACKEND)
+        # OpenCV takes a while to import, so only the runs that use it import it.
+        import cv2
+
+        with tracing.stage("opencv_load_model"):
+            self.net = cv2.dnn.readNetFromDarknet(CFG_PATH, WEIGHTS_PATH)
+            self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.output_names = self.net.getUnconnectedOutLayersNames()
+        self.input_size = read_network_size(CFG_PATH)
+        with open(NAMES_PATH) as names_file:
+            # Maps the network's class indices to DetectionStore class ids.
+            self.class_ids = np.array([class_id_for(line.strip()) for line in names_file if line.strip() != ""], dtype=np.int16)
+        self.batch_size = batch_size
+        if threads is not None:
+            cv2.setNumThreads(threads)
+
+    def detect(self, images, update_progress_bar=None, paths=None):
+        first_id = 1
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start:start + self.batch_size]
+            with tracing.stage("opencv_detect", tiles=len(batch)):
+                detections = self.detect_batch(batch)
+            for i, (boxes, class_ids, confidences) in enumerate(detections):
+                yield start + i, bio_objects_from_arrays(boxes, class_ids, confidences, first_id, start + i)
+                first_id += len(boxes)
+            if update_progress_bar is not None:
+                update_progress_bar(min(100, int((start + len(batch)) / len(images) * 100)))
+
+    def detect_batch(self, images):
+        """ Runs images through the network together, and returns (boxes, class_ids, confidences) for each of them,
+            like yolo.read_json_detections. """
+        import cv2
+
+        # Like darknet, this stretches each image to the network's size instead of letterboxing it.
+        blob = cv2.dnn.blobFromImages([to_rgb(img) for img in images], 1 / 255, self.input_size, swapRB=False, crop=False)
+        self.net.setInput(blob)
+        # Each output has a row for every anchor of every cell: center x, center y, width, height, objectness, class scores.
+        outputs = [output.reshape(len(images), -1, output.shape[-1]) for output in self.net.forward(self.output_names)]
+        rows = np.concatenate(outputs, axis=1)
+
+        detections = []
+        for img, img_rows in zip(images, rows):
+            # Like darknet, every class that scores above the threshold gets a detection of its own.
+            anchor_indices, class_indices = np.nonzero(img_rows[:, 5:] > DETECTION_THRESHOLD)
+            confidences = img_rows[anchor_indices, 5 + class_indices]
+            boxes = relative_to_pixel_boxes(img_rows[anchor_indices, :4], img.shape[1], img.shape[0])
+
+            keep = []
+            for class_index in np.unique(class_indices):
+                candidates = np.flatnonzero(class_indices == class_index)
+                widths_heights = boxes[candidates, 2:] - boxes[candidates, :2]
+                kept = cv2.dnn.NMSBoxes(np.hstack((boxes[candidates, :2], widths_heights)).tolist(), confidences[candidates].tolist(),
+                                        DETECTION_THRESHOLD, NMS_THRESHOLD)
+                keep += candidates[np.asarray(kept, dtype=int).reshape(-1)].tolist()
+            keep = np.sort(np.array(keep, dtype=int))
+            detections.append((boxes[keep], self.class_ids[class_indices[keep]], confidences[keep].astype(float)))
+        return detections
+
+
+class StubBackend(DetectorBackend):
+    name = STUB_BACKEND
+
+    def __init__(self, contrast=FOREGROUND_CONTRAST):
+        """ Calls every connected blob that's at least contrast away from the image's median a cell,
+            unless it's thin enough to be a nanowire. The same image always gets the same detections.
+            Pure black counts as background, since that's what tiles hanging off the edge of the image get padded with. """
+        self.contrast = contrast
+
+    def detect(self, images, update_progress_bar=None, paths=None):
+        from skimage import measure
+
+        first_id = 1
+        for i, img in enumerate(images):
+            gray = LoadedImage(img).gray()
+            labels = measure.label((np.abs(gray - np.median(gray)) >= self.contrast) & (gray > 0), connectivity=2)
+            regions = [region for region in measure.regionprops(labels) if region.area >= STUB_MIN_AREA]
+            boxes = np.array([(region.bbox[1], region.bbox[0], region.bbox[3], region.bbox[2]) for region in regions],
+                             dtype=np.int64).reshape(-1, 4)
+            class_ids = np.array([class_id_for("nanowire" if region.axis_minor_length < STUB_MAX_NANOWIRE_WIDTH else "cell")
+                                  for region in regions], dtype=np.int16)
+            yield i, bio_objects_from_arrays(boxes, class_ids, np.ones(len(regions)), first_id, i)
+            first_id += len(regions)
+            if update_progress_bar is not None:
+                update_progress_bar(int((i + 1) / len(images) * 100))
+
+
+def check_backend(backend):
+    """ Raises ImportError if backend needs something that isn't installed, and ValueError if there's no such backend. """
+    if backend not in BACKEND_NAMES:
+        raise ValueError(f"Unknown detector backend {backend!r}. It should be one of {', '.join(BACKEND_NAMES)}.")
+    # This only looks for OpenCV, without importing it.
+    if backend == OPENCV_BACKEND and importlib.util.find_spec("cv2") is None:
+        raise ImportError("The opencv backend needs OpenCV (pip install opencv-python-headless).")
+
+def make_detector(backend=DARKNET_BACKEND, threads=None, num_detectors=1):
+    """ Returns a DetectorBackend that stays loaded between images.
+        backend:       One of BACKEND_NAMES.
+        threads:       How many threads it gets in all. None means the backend's default.
+        num_detectors: How many darknets to split images' tiles (and threads) between. Only darknet uses this. """
+    check_backend(backend)
+    if backend == DARKNET_BACKEND:
+        if num_detectors > 1:
+            return DarknetBackend(DetectorPool(num_detectors, None if threads is None else max(1, threads // num_detectors)))
+        return DarknetBackend(DetectorSession(threads))
+    if backend == OPENCV_BACKEND:
+        return OpenCVBackend(threads)
+    return StubBackend()
@@ -1,6 +1,6 @@
 import numpy as np
-from skimage import morphology
-from bio_object import compute_contour, compute_cell_center
+from bio_object import compute_contour, compute_cell_center, contours_intersect, mask_windows
+from segmentation_executor import SegmentationExecutor
 
 CELL_CONTACT_EDGE = "cell_contact"
 CELL_TO_CELL_EDGE = "cell_to_cell"
@@ -8,6 +8,9 @@ CELL_TO_SURFACE_EDGE = "cell_to_surface"
 CELL_TO_SURFACE_CONECT = "cell_to_surface_contact" # for mccormick's extra request
 
 class NetworkEdge:
+    # Every edge is stored twice (once in each direction), so these don't get a __dict__.
+    __slots__ = ("tail", "head", "type", "nanowire")
+
     def __init__(self, tail, head, nanowire=None):
         self.tail = tail
         self.head = head
@@ -43,16 +46,42 @@ def add_edge(obj1, obj2, nanowire=None):
     obj2.edge_list.append(NetworkEdge(obj2, obj1, nanowire))
 
 
-def compute_cell_contact(bio_objects, image, update_progress_bar):
-    """ Computes all cell-to-cell contacts and adds to adj_list attribute of the cell objects"""
+def cells_are_in_contact(cell1, cell2):
+    """ Returns True if the contours of cell1 and cell2 touch. Both contours must already be computed. """
+    from skimage import morphology
 
-    # filter out non-cells and cells that don't have contours (no possible cell contact)
+    # The contour gets padded by a pixel so the dilation can grow past the edge of cell1's bounding box.
+    # The dilated contour covers the contour itself, so this also catches contours that overlap outright.
+    cell1_contour_dilated = morphology.dilation(np.pad(cell1.contour, 1))
+    x, y = cell1.contour_offset
+    # if the intersections of the np arrays has 1s then they overlap
+    window1, window2 = mask_windows(cell1_contour_dilated, (x - 1, y - 1), cell2.contour, cell2.contour_offset)
+    return np.logical_and(window1, window2).any()
+
+def compute_cell_contact(bio_objects, image, update_progress_bar, known_contacts=None, executor=None):
+    """ Computes all cell-to-cell contacts and adds to adj_list attribute of the cell objects
+        known_contacts: A dict mapping (cell1.id, cell2.id) to whether those cells are in contact,
+                        for pairs that have already been tested.
+        executor:       The SegmentationExecutor to compute contours and test pairs on. None means do it all on this thread. """
+    if executor is None:
+        executor = SegmentationExecutor(workers=1)
 
-    cells = []
-    for obj in bio_objects:
-        if obj.is_cell() and obj.overlapping_bboxes != []:
-            cells.append(obj)
-            compute_contour(obj, image)
+    # filter out non-cells and cells that don't have contours (no possible cell contact)
+    cells = [obj for obj in bio_objects if obj.is_cell() and obj.overlapping_bboxes != []]
+    executor.run(image, contours=cells)
+
+    # The pairs get tested in parallel, but the edges get added in the same order as always.
+    untested_pairs = [(cell1, cell2) for cell1 in cells for cell2 in cell1.overlapping_bboxes
+                      if cell2.id <= cell1.id and (known_contacts is None or (cell1.id, cell2.id) not in known_contacts)]
+    contacts = dict(known_contacts) if known_contacts is not None else {}
+    # Overlapping isn't symmetric (a cell whose box is inside another's can have no overlaps of its own),
+    # so cell2 might not have a contour. A cell without one has never been in contact with anything.
+    for cell1, cell2 in untested_pairs:
+        if not cell2.has_contour():
+            contacts[(cell1.id, cell2.id)] = False
+    untested_pairs = [(cell1, cell2) for cell1, cell2 in untested_pairs if cell2.has_contour()]
+    for (cell1, cell2), in_contact in zip(untested_pairs, executor.map(lambda pair: cells_are_in_contact(*pair), untested_pairs)):
+        contacts[(cell1.id, cell2.id)] = in_contact
 
     for i, cell1 in enumerate(cells):
         if update_progress_bar is not None:
@@ -60,10 +89,7 @@ def compute_cell_contact(bio_objects, image, update_progress_bar):
         for cell2 in cell1.overlapping_bboxes:
             if cell2.id > cell1.id:
                 continue
-            cell1_contour_dilated = morphology.dilation(cell1.contour)
-            # if the intersections of the np arrays has 1s then they overlap
-            if (np.logical_and(cell1.contour, cell2.contour, dtype=np.int8).any() or
-                    np.logical_and(cell1_contour_dilated, cell2.contour, dtype=np.int8).any()):
+            if contacts[(cell1.id, cell2.id)]:
                 add_edge(cell1, cell2)
                 cell1.edge_list[-1].set_type_as_cell_contact()
                 cell2.edge_list[-1].set_type_as_cell_contact()
@@ -83,7 +109,15 @@ def add_edge_based_on_intersection_set(surface, nanowire, intersection_set):
         return False
     return True
 
-def compute_nanowire_edges(bio_objects, image, update_progress_bar):
+def compute_nanowire_edges(bio_objects, image, update_progress_bar, executor=None):
+    """ executor: The SegmentationExecutor to compute contours on. None means do it all on this thread. """
+    if executor is None:
+        executor = SegmentationExecutor(workers=1)
+
+    # Nanowires touching more than two cells need their contour (and their cells' contours) to work out which cells they connect.
+    tangled_nanowires = [obj for obj in bio_objects if obj.is_nanowire() and len(obj.overlapping_bboxes) > 2]
+    executor.run(image, contours=tangled_nanowires + [cell for nanowire in tangled_nanowires for cell in nanowire.overlapping_bboxes])
+
     surface = bio_objects[0]
     num_cells = sum(bio_obj.is_cell() for bio_obj in bio_objects)
     nanowires = filter(lambda b: b.is_nanowire(), bio_objects)
@@ -93,13 +127,14 @@ def compute_nanowire_edges(bio_objects, image, update_progress_bar):
             update_progress_bar(int((num_cells + i) / len(bio_objects) * 100))
 
         if not add_edge_based_on_intersection_set(surface, nanowire, nanowire.overlapping_bboxes):
-            compute_contour(nanowire, image)
+            if not nanowire.has_contour():
+                compute_contour(nanowire, image)
 
             intersections = []
             for cell in nanowire.overlapping_bboxes:
                 if cell.contour is None:
                     compute_contour(cell, image)
-                if np.logical_and(cell.contour, nanowire.contour, dtype=np.uint8).any():
+                if contours_intersect(cell, nanowire):
                     intersections.append(cell)
 
             add_edge_based_on_intersection_set(surface, nanowire, intersections)
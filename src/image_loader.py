@@ -0,0 +1,163 @@
+""" image_loader.py
+    Loads images for the pipeline. Every file gets decoded once, and everything else (the grayscale version, regions)
+    is derived from that one decode. Uncompressed TIFFs get memory-mapped instead of read, so only the parts of them
+    we actually look at get paged in.
+"""
+
+import importlib.util
+
+from PIL import Image
+import numpy as np
+
+TIFF_EXTENSIONS = (".tif", ".tiff")
+# TIFFs that can't be memory-mapped directly and are bigger than this (decoded) get decoded into a temporary file instead of RAM.
+MAX_IN_MEMORY_TIFF_BYTES = 512 * 1024 * 1024
+# What TIFF calls storing each color channel as its own plane.
+PLANARCONFIG_SEPARATE = 2
+# The PIL modes whose pixels are already intensities in a layout gray() understands. Anything else (like palette images,
+# grayscale with alpha, or CMYK) gets converted to RGB first.
+DIRECT_MODES = ("L", "RGB", "RGBA", "I;16")
+
+
+class LoadedImage:
+    def __init__(self, pixels, path=None):
+        """ pixels: The image as decoded (or memory-mapped): a NumPy array with shape (height, width) or (height, width, channels).
+            path:   The file it came from, if it came from one. """
+        self.pixels = pixels
+        self.path = path
+        self.gray_pixels = None
+
+    def width(self):
+        return self.pixels.shape[1]
+
+    def height(self):
+        return self.pixels.shape[0]
+
+    def gray(self):
+        """ Returns this image in grayscale, as floats between 0 and 1. This only gets computed once. """
+        from skimage.color import rgb2gray, rgba2rgb
+        from skimage.util import img_as_float
+
+        if self.gray_pixels is None:
+            if self.pixels.ndim == 2: # It's already grayscale
+                self.gray_pixels = img_as_float(self.pixels)
+            elif self.pixels.shape[2] == 4:
+                self.gray_pixels = rgb2gray(rgba2rgb(self.pixels))
+            else:
+                self.gray_pixels = rgb2gray(self.pixels)
+        return self.gray_pixels
+
+    def region(self, x1, y1, x2, y2):
+        """ Returns a copy of the pixels in the box (x1, y1, x2, y2). If the image is memory-mapped, only those pixels get read. """
+        return np.array(self.pixels[y1:y2, x1:x2])
+
+
+def is_tiff(path):
+    return path.lower().endswith(TIFF_EXTENSIONS)
+
+def load_tiff(path):
+    """ Returns the first page of the TIFF at path, memory-mapped if possible, or None if tifffile isn't installed. """
+    try:
+        import tifffile
+    except ImportError:
+        return None
+
+    with tifffile.TiffFile(path) as tiff:
+        page = tiff.pages[0]
+        planarconfig = page.planarconfig
+        try:
+            pixels = tifffile.memmap(path, page=0, mode="r")
+        except ValueError: # It's compressed, or its pixels aren't stored contiguously
+            decoded_bytes = int(np.prod(page.shape)) * page.dtype.itemsize
+            pixels = page.asarray(out="memmap" if decoded_bytes > MAX_IN_MEMORY_TIFF_BYTES else None)
+
+    if pixels.ndim == 3 and planarconfig == PLANARCONFIG_SEPARATE:
+        pixels = np.moveaxis(pixels, 0, -1)
+    return pixels
+
+def check_region_loadable(path):
+    """ Raises ValueError if load_region can't read the image at path a region at a time, and ImportError if it needs
+        something that isn't installed. """
+    if not is_tiff(path):
+        raise ValueError(f"{path} can't be read a region at a time, since it isn't a TIFF. Convert it to one (tiled, ideally) first.")
+    # This only looks for tifffile, without importing it.
+    if importlib.util.find_spec("tifffile") is None:
+        raise ImportError("Reading an image a region at a time needs tifffile (pip install tifffile).")
+
+def load_region(path, x1, y1, x2, y2):
+    """ Returns a copy of the pixels in the box (x1, y1, x2, y2) of the first page of the TIFF at path, without decoding the rest:
+        uncompressed TIFFs get memory-mapped, and compressed ones only have the tiles (or strips) that overlap the box decoded.
+        Raises ValueError for anything but a TIFF, and ImportError without tifffile (see check_region_loadable). """
+    check_region_loadable(path)
+    import tifffile
+
+    try:
+        pixels = tifffile.memmap(path, page=0, mode="r")
+    except ValueError: # It's compressed, or its pixels aren't stored contiguously
+        return decode_tiff_region(path, x1, y1, x2, y2)
+    with tifffile.TiffFile(path) as tiff:
+        if pixels.ndim == 3 and tiff.pages[0].planarconfig == PLANARCONFIG_SEPARATE:
+            pixels = np.moveaxis(pixels, 0, -1)
+    return LoadedImage(pixels, path).region(x1, y1, x2, y2)
+
+def decode_tiff_region(path, x1, y1, x2, y2):
+    """ Returns the pixels in the box (x1, y1, x2, y2) of the first page of the TIFF at path, decoding only the tiles
+        (or strips) that overlap it. """
+    import tifffile
+
+    with tifffile.TiffFile(path) as tiff:
+        page = tiff.pages[0]
+        if page.is_tiled:
+            segment_height, segment_width = page.tilelength, page.tilewidth
+        else: # Strips are segments as wide as the image
+            segment_height, segment_width = min(page.rowsperstrip or page.imagelength, page.imagelength), page.imagewidth
+        segments_down = -(-page.imagelength // segment_height)
+        segments_across = -(-page.imagewidth // segment_width)
+        # With separate planes, every channel has its own full set of segments, one channel after another.
+        planes = page.samplesperpixel if page.planarconfig == PLANARCONFIG_SEPARATE else 1
+
+        pixels = np.zeros((y2 - y1, x2 - x1, page.samplesperpixel), dtype=page.dtype)
+        for plane in range(planes):
+            for row in range(y1 // segment_height, -(-y2 // segment_height)):
+                for column in range(x1 // segment_width, -(-x2 // segment_width)):
+                    index = (plane * segments_down + row) * segments_across + column
+                    if page.databytecounts[index] == 0: # Sparse TIFFs leave out segments that are all zeros
+                        continue
+                    tiff.filehandle.seek(page.dataoffsets[index])
+                    segment, _, _ = page.decode(tiff.filehandle.read(page.databytecounts[index]), index, jpegtables=page.jpegtables)
+                    segment = segment[0] # (depth, length, width, samples) -> (length, width, samples)
+                    top, left = row * segment_height, column * segment_width
+                    overlap_y1, overlap_y2 = max(y1, top), min(y2, top + segment.shape[0])
+                    overlap_x1, overlap_x2 = max(x1, left), min(x2, left + segment.shape[1])
+                    pixels[overlap_y1 - y1:overlap_y2 - y1, overlap_x1 - x1:overlap_x2 - x1, plane:plane + segment.shape[2]] = \
+                        segment[overlap_y1 - top:overlap_y2 - top, overlap_x1 - left:overlap_x2 - left]
+    return pixels[:, :, 0] if page.samplesperpixel == 1 else pixels
+
+def load_image(path, allow_huge=False):
+    """ Decodes (or memory-maps) the image at path, and returns a LoadedImage.
+        allow_huge: Whether to load images bigger than PIL's decompression bomb limit. """
+    if is_tiff(path):
+        pixels = load_tiff(path)
+        if pixels is not None:
+            return LoadedImage(pixels, path)
+
+    if allow_huge:
+        Image.MAX_IMAGE_PIXELS = None
+    with Image.open(path) as image:
+        if image.mode not in DIRECT_MODES:
+            image = image.convert("RGB")
+        return LoadedImage(np.asarray(image), path)
+
+def image_size(path):
+    """ Returns (width, height) of the image at path, without decoding it. """
+    if is_tiff(path):
+        try:
+            import tifffile
+            with tifffile.TiffFile(path) as tiff:
+                page = tiff.pages[0]
+                return page.imagewidth, page.imagelength
+        except ImportError:
+            pass
+
+    with Image.open(path) as image:
+        return image.size
@@ -2,9 +2,8 @@ from sys import path
 path.append("ui")
 
 from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.QtWidgets import QMainWindow, QFileDialog, QShortcut
+from PyQt5.QtWidgets import QMainWindow, QFileDialog, QShortcut, QApplication, QMessageBox
 from PyQt5.QtGui import QKeySequence
-from PyQt5.uic import loadUi
 
 import os
 import networkx as nx
@@ -13,7 +12,13 @@ from post_processing import PostProcessingManager
 from crop_processing import IMAGE_EXTENSIONS
 from toolbar import CustomToolbar, _Mode
 from program_manager import ProgramManager
+from yolo import DetectorPool, default_detector_count
+from detector_backend import DarknetBackend
+from detection_cache import DetectionCache
+from batch import run_batch, gexf_path_for
+import tracing
 from mplwidget import MplWidget
+from compiled_ui import setup_ui
 
 UI_FILE = "ui/main.ui"
 
@@ -21,8 +26,15 @@ class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
 
+        # This keeps darknet running between images, so we only load the model once.
+        # We only ever process one image at a time here, so its tiles get split between as many darknets as are worth running.
+        num_detectors = default_detector_count(os.cpu_count() or 1)
+        self.detector = DarknetBackend(DetectorPool(num_detectors, max(1, (os.cpu_count() or 1) // num_detectors)))
+        # This lets us skip darknet on images we've already run it on.
+        self.detection_cache = DetectionCache()
+
         # set up ProgramManager
-        self.program_manager = ProgramManager()
+        self.program_manager = ProgramManager(self.detector, self.detection_cache)
         self.post_processor = None
 
         # These are for batch processing. It feels wrong to put them in ProgramManager
@@ -36,7 +48,7 @@ class MainWindow(QMainWindow):
         # Whether to take into account the surface "node"
         self.surface_node_is_enabled = True
 
-        loadUi("ui/main.ui", self)
+        setup_ui(UI_FILE, self)
         self.menubar.setNativeMenuBar(False)
 
         # Set the default options
@@ -60,10 +72,12 @@ class MainWindow(QMainWindow):
 
         self.actionViewBoundingBoxes.triggered.connect(lambda: self.handle_cell_bounding_boxes_view_press())
         self.actionViewNetworkEdges.triggered.connect(lambda: self.handle_network_edges_view_press())
+        self.actionViewContour.triggered.connect(lambda: self.handle_contour_view_press())
         self.actionRunAll.triggered.connect(lambda: self.run_batch_processing() \
                                                     if self.is_batch_processing else \
                                                     self.run_yolo_and_edge_detection_and_display())
         self.actionManual.triggered.connect(lambda: self.allow_manual_labelling())
+        self.actionClearDetectionCache.triggered.connect(lambda: self.detection_cache.invalidate())
 
     def set_default_visibilities(self):
         self.progressBar.setVisible(False)
@@ -85,8 +99,12 @@ class MainWindow(QMainWindow):
         self.actionEnableSurfaceNode.setEnabled(True)
         self.actionEnableSurfaceNode.setChecked(True)
 
+    def closeEvent(self, event):
+        self.detector.close()
+        super().closeEvent(event)
+
     def clear_all_data_and_reset_window(self, reset_batch=True):
-        self.program_manager = ProgramManager()
+        self.program_manager = ProgramManager(self.detector, self.detection_cache)
         self.post_processor = None
 
         if reset_batch:
@@ -94,7 +112,7 @@ class MainWindow(QMainWindow):
             self.image_directory_path = ""
             self.batch_image_filenames = []
 
-        loadUi("ui/main.ui", self)
+        setup_ui(UI_FILE, self)
         self.menubar.setNativeMenuBar(False)
 
         self.set_default_enablements()
@@ -127,17 +145,22 @@ class MainWindow(QMainWindow):
             self.clear_all_data_and_reset_window()
             return
 
-        for i, path in enumerate(self.batch_image_filenames):
-            self.progressBar.setFormat(f"Processing {path}...")
-            image_path = os.path.join(self.image_directory_path, path)
-            self.program_manager = ProgramManager()
-            self.program_manager.open_image_file(image_path)
-            self.program_manager.compute_bounding_boxes()
-            self.program_manager.compute_bbox_overlaps_and_cell_centers()
-            self.program_manager.compute_cell_network_edges()
-            self.post_processor = PostProcessingManager(bio_objs=self.program_manager.bio_objs)
-            self.export_to_gephi(export_path=image_path[:image_path.rfind(".")] + ".gexf")
-            self.progressBar.setValue((i + 1) / len(self.batch_image_filenames) * 100)
+        def report_progress(result, num_done, num_images):
+            self.progressBar.setFormat(f"Processed {num_done} of {num_images} images...")
+            self.progressBar.setValue(num_done / num_images * 100)
+            # We're blocking the event loop while the workers run, so let the progress bar repaint.
+            QApplication.processEvents()
+
+        self.progressBar.setFormat("Processing images...")
+        image_paths = [os.path.join(self.image_directory_path, filename) for filename in self.batch_image_filenames]
+        results = run_batch(image_paths, surface_node_is_enabled=self.surface_node_is_enabled, report_progress=report_progress)
+
+        failures = [result for result in results if not result.succeeded()]
+        if failures != []:
+            QMessageBox.warning(self, "Batch Processing", f"Couldn't process {len(failures)} of {len(results)} images:\n" +
+                                "\n".join(f"{os.path.basename(result.image_path)}: {result.error}" for result in failures))
+        # Only the images that made it through have graphs to look at.
+        self.batch_image_filenames = [filename for filename, result in zip(self.batch_image_filenames, results) if result.succeeded()]
 
         self.progressBar.setVisible(False)
         self.load_batch_image(0)
@@ -153,7 +176,7 @@ class MainWindow(QMainWindow):
         image_path = os.path.join(self.image_directory_path, self.batch_image_filenames[self.batch_index])
         self.program_manager.open_image_file(image_path)
         self.MplWidget.draw_image(self.program_manager.image)
-        self.load_gexf(file_path=image_path[:image_path.rfind(".")] + ".gexf")
+        self.load_gexf(file_path=gexf_path_for(image_path))
 
         self.toolbar.add_file_navigation_buttons()
 
@@ -179,20 +202,32 @@ class MainWindow(QMainWindow):
         self.progressBar.setVisible(True)
         self.actionImportFromGephi.setEnabled(False)
 
-        # run yolo
-        self.progressBar.setFormat("Computing bounding boxes...")
-        self.program_manager.compute_bounding_boxes(self.progressBar.setValue)
-
-        self.program_manager.compute_bbox_overlaps_and_cell_centers()
+        with tracing.tracer.collect() as spans:
+            # run yolo, and segment cells as their tiles finish
+            self.progressBar.setFormat("Computing bounding boxes...")
+            self.program_manager.compute_bounding_boxes_overlaps_and_cell_centers(self.progressBar.setValue)
 
-        # run edge_detection
-        self.progressBar.setFormat("Computing cell network...")
-        self.program_manager.compute_cell_network_edges(self.progressBar.setValue)
+            # run edge_detection
+            self.progressBar.setFormat("Computing cell network...")
+            self.program_manager.compute_cell_network_edges(self.progressBar.setValue)
         self.toolbar.add_network_tools()
 
+        status = []
+        num_skipped_tiles = len(self.program_manager.skipped_tiles)
+        if num_skipped_tiles != 0:
+            num_tiles = len(self.program_manager.tiles) + num_skipped_tiles
+            status.append(f"Skipped {num_skipped_tiles} of {num_tiles} tiles as background.")
+        # This is empty unless we're tracing.
+        if spans != []:
+            status.append(tracing.summarize(spans))
+        if status != []:
+            self.statusbar.showMessage(" ".join(status))
+
         self.actionExportToGephi.setEnabled(True)
         self.actionViewBoundingBoxes.setEnabled(True)
         self.actionViewBoundingBoxes.setChecked(False)
+        self.actionViewContour.setEnabled(True)
+        self.actionViewContour.setChecked(False)
         self.progressBar.setVisible(False)
         self.actionViewNetworkEdges.setEnabled(True)
         self.actionViewNetworkEdges.setChecked(True)
@@ -230,6 +265,12 @@ class MainWindow(QMainWindow):
         else:
             self.MplWidget.remove_cell_bounding_boxes()
 
+    def handle_contour_view_press(self):
+        if self.actionViewContour.isChecked():
+            self.MplWidget.draw_contours(self.program_manager.bio_objs, self.program_manager.image.shape)
+        else:
+            self.MplWidget.remove_contours()
+
     def handle_network_edges_view_press(self):
         if self.actionViewNetworkEdges.isChecked():
             self.MplWidget.draw_network_edges(self.post_processor.graph, self.surface_node_is_enabled)
@@ -268,16 +309,7 @@ class MainWindow(QMainWindow):
             if not export_path.endswith('.gexf'):
                 export_path += '.gexf'
 
-        to_export = self.post_processor.graph.copy()
-        if self.surface_node_is_enabled:
-            for node in to_export.nodes():
-                if node != 0:
-                    to_export.add_edge(0, node, edge_type="cell_to_surface_contact")
-        else:
-            to_export.remove_node(0)
-
-
-        nx.write_gexf(to_export, export_path)
+        self.post_processor.export_to_gexf(export_path, self.surface_node_is_enabled)
 
     def load_gexf(self, file_path=None):
         if file_path is None:
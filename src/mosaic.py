@@ -0,0 +1,216 @@
+""" mosaic.py
+    Processes images too big to hold in memory at once (like stitched mosaics of a whole electrode) one region at a time.
+    Each region gets a halo of extra pixels around its core, so the objects near the core's edges are seen whole,
+    and the regions' networks get stitched back together into one network for the whole image.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import batch
+from bio_object import BioObject
+from crop_processing import load_tiling_config
+from detector_backend import DARKNET_BACKEND
+from detection_store import DetectionStore
+from image_loader import check_region_loadable, load_region, image_size
+from edge_detection import add_edge
+from post_processing import PostProcessingManager
+from program_manager import ProgramManager
+from spatial_index import BBoxGrid
+import tracing
+
+# Both of these are in tiles (really, the distance between the starts of two tiles), so every region's tiles line up
+# with the tiles the whole image would get. Then an object YOLO sees from two regions gets the same bounding box in both.
+REGION_SIZE_IN_TILES = 8
+# This has to be more than the size of the biggest object, so an object owned by a region is entirely in its window.
+REGION_HALO_IN_TILES = 2
+# An object seen from the halo of one region is the same as an object owned by another if their bounding boxes overlap this much.
+MIN_SEAM_IOU = 0.5
+
+
+class Region:
+    def __init__(self, core, window):
+        """ core:   (x1, y1, x2, y2) of the part of the image this region is responsible for.
+            window: (x1, y1, x2, y2) of the part of the image this region gets processed with, which is core plus a halo. """
+        self.core = core
+        self.window = window
+
+    def owns(self, point):
+        """ Returns True if point (in whole-image coordinates) is in this region's core. The cores don't overlap,
+            so every point in the image is owned by exactly one region. """
+        x1, y1, x2, y2 = self.core
+        return x1 <= point[0] < x2 and y1 <= point[1] < y2
+
+
+class RegionResult:
+    def __init__(self, objects, edges, peak_memory=None):
+        """ objects:     (bbox, classification, confidence, cell_center) for each object found in the region's window,
+                         in whole-image coordinates. The first one is the region's surface.
+            edges:       (index1, index2, edge_type, nanowire_index) for each edge, where the indices are into objects.
+                         nanowire_index is None for edges without a nanowire.
+            peak_memory: Each stage's peak memory (see tracing.peak_memory), or {} if memory wasn't tracked. """
+        self.objects = objects
+        self.edges = edges
+        self.peak_memory = peak_memory if peak_memory is not None else {}
+
+
+def plan_regions(width, height, region_size, halo):
+    """ Splits a width x height image into Regions, in row-major order. region_size and halo are in px. """
+    regions = []
+    for y1 in range(0, height, region_size):
+        for x1 in range(0, width, region_size):
+            core = (x1, y1, min(x1 + region_size, width), min(y1 + region_size, height))
+            window = (max(0, x1 - halo), max(0, y1 - halo), min(x1 + region_size + halo, width), min(y1 + region_size + halo, height))
+            regions.append(Region(core, window))
+    return regions
+
+def process_region(image_path, window):
+    """ Runs the whole pipeline on one window of the image at image_path, and returns a RegionResult.
+        This runs in a worker set up by batch.init_worker. """
+    with tracing.tracer.collect() as spans, tracing.stage("process_region", is_wrapper=True, image=image_path, window=list(window)):
+        with tracing.stage("read_region"):
+            region_image = load_region(image_path, *window)
+        filename = image_path[image_path.rfind("/") + 1:]
+        program_manager = ProgramManager(batch.worker_detector, None, batch.worker_segmentation_executor, batch.worker_tiling)
+        program_manager.open_image_region(region_image, f"{filename[:filename.rfind('.')]}_{window[0]}_{window[1]}")
+        program_manager.compute_bounding_boxes_overlaps_and_cell_centers()
+        program_manager.compute_cell_network_edges()
+    batch.worker_segmentation_executor.release_image()
+
+    dx, dy = window[:2]
+    index_of = {id(bio_obj): i for i, bio_obj in enumerate(program_manager.bio_objs)}
+    objects = [((bio_obj.x1 + dx, bio_obj.y1 + dy, bio_obj.x2 + dx, bio_obj.y2 + dy), bio_obj.classification, bio_obj.confidence,
+                (bio_obj.cell_center[0] + dx, bio_obj.cell_center[1] + dy))
+               for bio_obj in program_manager.bio_objs]
+    edges = [(index_of[id(bio_obj)], index_of[id(edge.head)], edge.type, None if edge.nanowire is None else index_of[id(edge.nanowire)])
+             for bio_obj in program_manager.bio_objs for edge in bio_obj.edge_list
+             if bio_obj.id < edge.head.id] # Every edge is in both of its ends' edge lists
+    return RegionResult(objects, edges, tracing.peak_memory(spans))
+
+def run_regions(image_path, regions, workers, threads_per_worker, report_progress=None, tiling=None, backend=DARKNET_BACKEND,
+                segment_on_processes=False):
+    """ Returns a RegionResult for each of regions, in the same order. """
+    if workers == 1 or len(regions) == 1:
+        batch.init_worker(threads_per_worker, False, tiling, 1, backend, segment_on_processes)
+        try:
+            results = []
+            for region in regions:
+                results.append(process_region(image_path, region.window))
+                if report_progress is not None:
+                    report_progress(len(results), len(regions))
+            return results
+        finally:
+            batch.worker_detector.close()
+            batch.worker_segmentation_executor.close()
+
+    results = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(regions)), mp_context=multiprocessing.get_context("spawn"),
+                             initializer=batch.init_worker, initargs=(threads_per_worker, False, tiling, 1, backend, segment_on_processes)) as executor:
+        for result in executor.map(process_region, [image_path] * len(regions), [region.window for region in regions]):
+            results.append(result)
+            if report_progress is not None:
+                report_progress(len(results), len(regions))
+    return results
+
+
+def bbox_center(bbox):
+    return (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+
+def iou(bbox1, bbox2):
+    width = min(bbox1[2], bbox2[2]) - max(bbox1[0], bbox2[0])
+    height = min(bbox1[3], bbox2[3]) - max(bbox1[1], bbox2[1])
+    if width <= 0 or height <= 0:
+        return 0
+    intersection = width * height
+    union = (bbox1[2] - bbox1[0]) * (bbox1[3] - bbox1[1]) + (bbox2[2] - bbox2[0]) * (bbox2[3] - bbox2[1]) - intersection
+    return intersection / union
+
+def merge_regions(width, height, regions, results):
+    """ Stitches the networks found in each region into one network for the whole image, and returns its BioObjects
+        (surface first), ready for a PostProcessingManager.
+        Each object comes from the region whose core has its center, and each edge comes from the region whose core has
+        its anchor: the nanowire's center for nanowire edges, or the midpoint of the cells' centers for cell contacts. """
+    store = DetectionStore()
+    surface = BioObject(0, 0, width, height, 0, "surface", store=store)
+    bio_objs = [surface]
+    by_bbox = {}
+    grid = BBoxGrid()
+
+    for region, result in zip(regions, results):
+        for bbox, classification, confidence, cell_center in result.objects[1:]:
+            if not region.owns(bbox_center(bbox)) or (classification, bbox) in by_bbox:
+                continue
+            bio_obj = BioObject(*bbox, len(bio_objs), classification, confidence, store)
+            bio_obj.cell_center = cell_center
+            bio_objs.append(bio_obj)
+            by_bbox[(classification, bbox)] = bio_obj
+            grid.insert(bio_obj)
+
+    def find_merged(bbox, classification):
+        """ Finds the merged object that a region saw at bbox, or None if nobody owns it.
+            Objects near the edge of a window can get slightly different boxes than their owner found. """
+        if (classification, bbox) in by_bbox:
+            return by_bbox[(classification, bbox)]
+        candidates = [(iou(bbox, other.bbox()), other) for other in grid.query(*bbox) if other.classification == classification]
+        best_iou, best = max(candidates, key=lambda candidate: candidate[0], default=(0, None))
+        return best if best_iou >= MIN_SEAM_IOU else None
+
+    for region, result in zip(regions, results):
+        merged = [surface] + [find_merged(bbox, classification) for bbox, classification, _, _ in result.objects[1:]]
+        for index1, index2, edge_type, nanowire_index in result.edges:
+            if nanowire_index is not None:
+                anchor = bbox_center(result.objects[nanowire_index][0])
+            else:
+                (x1, y1), (x2, y2) = bbox_center(result.objects[index1][0]), bbox_center(result.objects[index2][0])
+                anchor = ((x1 + x2) / 2, (y1 + y2) / 2)
+            if not region.owns(anchor):
+                continue
+
+            obj1, obj2 = merged[index1], merged[index2]
+            nanowire = None if nanowire_index is None else merged[nanowire_index]
+            if obj1 is None or obj2 is None or (nanowire_index is not None and nanowire is None):
+                continue
+            # Duplicate detections get merged into one object, so an edge between them goes away.
+            if obj1 is obj2:
+                continue
+            add_edge(obj1, obj2, nanowire)
+            obj1.edge_list[-1].type = edge_type
+            obj2.edge_list[-1].type = edge_type
+
+    return bio_objs
+
+def process_mosaic(image_path, workers=None, threads_per_worker=batch.DEFAULT_THREADS_PER_WORKER, report_progress=None, tiling=None,
+                   backend=DARKNET_BACKEND, segment_on_processes=False):
+    """ Runs the whole pipeline on the image at image_path one region at a time, and returns the BioObjects
+        of the whole image's network, and the regions' merged peak memory (see tracing.merge_peak_memory).
+        Peak memory depends on REGION_SIZE_IN_TILES, not the size of the image.
+        workers:         How many regions to process at once. Defaults to as many as fit in os.cpu_count().
+        report_progress: Called as report_progress(num_done, num_regions) each time a region finishes. """
+    if workers is None:
+        workers = batch.default_worker_count(threads_per_worker)
+    check_region_loadable(image_path)
+    tiling = tiling if tiling is not None else load_tiling_config()
+    width, height = image_size(image_path)
+    regions = plan_regions(width, height, REGION_SIZE_IN_TILES * tiling.crop_offset(), REGION_HALO_IN_TILES * tiling.crop_offset())
+    results = run_regions(image_path, regions, workers, threads_per_worker, report_progress, tiling, backend, segment_on_processes)
+    with tracing.stage("merge_regions", regions=len(regions)):
+        return merge_regions(width, height, regions, results), tracing.merge_peak_memory(result.peak_memory for result in results)
+
+def run_mosaics(image_paths, workers=None, threads_per_worker=batch.DEFAULT_THREADS_PER_WORKER, surface_node_is_enabled=True, report_progress=None,
+                tiling=None, backend=DARKNET_BACKEND, segment_on_processes=False):
+    """ Does the same thing as batch.run_batch, but processes the images one at a time, each one as a mosaic. """
+    results = []
+    for image_path in image_paths:
+        try:
+            export_path = batch.gexf_path_for(image_path)
+            bio_objs, peak_memory = process_mosaic(image_path, workers, threads_per_worker, tiling=tiling, backend=backend,
+                                                  segment_on_processes=segment_on_processes)
+            PostProcessingManager(bio_objs=bio_objs).export_to_gexf(export_path, surface_node_is_enabled)
+            result = batch.BatchResult(image_path, export_path=export_path, peak_memory=peak_memory)
+        except Exception as e:
+            result = batch.BatchResult(image_path, error=f"{type(e).__name__}: {e}")
+        results.append(result)
+        if report_progress is not None:
+            report_progress(result, len(results), len(image_paths))
+
+    return results
@@ -1,6 +1,8 @@
+import os
 import networkx as nx
-from scipy.spatial import KDTree
 from edge_detection import CELL_TO_CELL_EDGE, CELL_TO_SURFACE_EDGE, CELL_CONTACT_EDGE
+from spatial_index import NodeIndex
+import tracing
 
 NORMAL = "normal"
 SPHEROPLAST = "spheroplast"
@@ -38,11 +40,39 @@ class PostProcessingManager:
                         else:
                             self.graph.add_edge(bio_object.id, edge.head.id, key=key, edge_type=edge.type)
 
-        self.tree = self.build_KDTree()
+        # This gets built the first time someone looks for a node, since headless runs never do.
+        self.node_index = None
 
-    def build_KDTree(self):
-        self.tree = KDTree([(node[1]['x'], node[1]['y']) for node in self.graph.nodes(data=True)])
-        return self.tree
+    def export_to_gexf(self, export_path, surface_node_is_enabled=True):
+        """ Writes the graph to export_path in Gephi's format. """
+        with tracing.stage("export_to_gexf", nodes=self.graph.number_of_nodes(), edges=self.graph.number_of_edges()) as span:
+            to_export = self.graph.copy()
+            if surface_node_is_enabled:
+                for node in to_export.nodes():
+                    if node != 0:
+                        to_export.add_edge(0, node, edge_type="cell_to_surface_contact")
+            else:
+                to_export.remove_node(0)
+
+            nx.write_gexf(to_export, export_path)
+            if tracing.tracer.is_enabled():
+                span.count(bytes_written=os.path.getsize(export_path))
+
+    def build_node_index(self):
+        self.node_index = NodeIndex((node_id, node_data['x'], node_data['y']) for node_id, node_data in self.graph.nodes(data=True))
+        return self.node_index
+
+    def add_node(self, node_id, x, y, node_type=NORMAL):
+        """ Adds a node to the graph, and to the node index if there is one. """
+        self.graph.add_node(node_id, x=x, y=y, node_type=node_type)
+        if self.node_index is not None:
+            self.node_index.insert(node_id, x, y)
+
+    def remove_node(self, node_id):
+        """ Removes a node (and its edges) from the graph, and from the node index if there is one. """
+        self.graph.remove_node(node_id)
+        if self.node_index is not None:
+            self.node_index.remove(node_id)
 
     def get_cell_count(self):
         normal_count = 0
@@ -83,7 +113,9 @@ class PostProcessingManager:
         if x is None or y is None:
             return
 
-        dist, index = self.tree.query([x,y])
-        if dist > EDGE_RELEASE_DISTANCE_THRESHOLD:
+        if self.node_index is None:
+            self.build_node_index()
+        dist, node_id = self.node_index.nearest(x, y)
+        if node_id is None or dist > EDGE_RELEASE_DISTANCE_THRESHOLD:
             return
-        return list(self.graph.nodes(data=True))[int(index)]
+        return node_id, self.graph.nodes[node_id]
@@ -1,104 +1,258 @@
-from skimage.color import rgb2gray
-from PIL import Image
+from queue import Queue
+from threading import Thread
 import numpy as np
-import matplotlib.pyplot as plt
-import os
 
-from bio_object import BioObject, compute_all_cell_bbox_overlaps, compute_nanowire_to_cell_bbox_overlaps, compute_cell_center
-from crop_processing import Tile, make_tiles, IMAGE_EXTENSIONS, reunify_tiles
-from yolo import parse_yolo_output, run_yolo_on_images
-from edge_detection import compute_cell_contact, compute_nanowire_edges
+from bio_object import BioObject, compute_all_cell_bbox_overlaps, compute_nanowire_to_cell_bbox_overlaps, \
+                       find_cell_bbox_overlaps, find_nanowire_bbox_overlaps, copy_bio_objects, OVERLAP_TOLERANCE
+from detection_store import DetectionStore, gather_boxes
+from spatial_index import BBoxGrid
+from image_loader import LoadedImage, load_image
+from segmentation_executor import SegmentationExecutor
+from crop_processing import make_tiles, tile_image, skip_empty_tiles, reunify_tiles, make_full_tile, reunify_tile, \
+                            load_tiling_config, REUNIFY_BY_FUSION
+from detector_backend import DarknetBackend
+from tracing import traced, stage
+from edge_detection import compute_cell_contact, compute_nanowire_edges, cells_are_in_contact
+
+def detection_counts(program_manager):
+    """ The counts that get traced for ProgramManager's stages. """
+    return {"tiles": len(program_manager.tiles), "skipped_tiles": len(program_manager.skipped_tiles),
+            "cells": sum(obj.is_cell() for obj in program_manager.bio_objs),
+            "nanowires": sum(obj.is_nanowire() for obj in program_manager.bio_objs)}
+
+def edge_count(bio_objs):
+    return sum(len(obj.edge_list) for obj in bio_objs) // 2 # Every edge is in both of its ends' edge lists
 
-TILE_SIZE = 416
-CROP_DIR = ".crops"
 
 class ProgramManager:
-    def __init__(self):
+    def __init__(self, detector=None, detection_cache=None, segmentation_executor=None, tiling=None):
+        """ detector:              The DetectorBackend that finds objects, shared between runs so the model only gets loaded once.
+                                   None means a DarknetBackend that starts darknet for each image.
+            detection_cache:       A DetectionCache to look in before running darknet. None means always run darknet.
+                                   It should have been made with the same tiling.
+            segmentation_executor: The SegmentationExecutor that computes centers and contours. None means a default one.
+            tiling:                The TilingConfig to tile images with. None means the one in crop_processing.TILING_CONFIG_PATH. """
+        self.detector = detector if detector is not None else DarknetBackend()
+        self.detection_cache = detection_cache
+        self.segmentation_executor = segmentation_executor if segmentation_executor is not None else SegmentationExecutor()
+        self.tiling = tiling if tiling is not None else load_tiling_config()
         self.image = np.array([])
         self.original_image = np.array([])
         self.bio_objs = []
-        self.made_crops = False
+        # Where the data for everything in self.bio_objs lives.
+        self.store = DetectionStore()
+        # The tiles that get run through YOLO. If this and self.skipped_tiles are empty, we run YOLO on the whole image.
+        self.tiles = []
+        # The tiles that were only background, so they don't get run through YOLO.
+        self.skipped_tiles = []
         self.image_path = ""
+        # The image's key in detection_cache, worked out once when it's loaded. None if it doesn't get cached.
+        self.cache_key = None
+        # Maps (cell1.id, cell2.id) to whether those cells touch, for pairs the pipeline already tested.
+        self.known_contacts = {}
+        # The cells the pipeline has found so far, in the same order as in self.bio_objs.
+        self.cell_grid = BBoxGrid()
 
+    @traced("open_image", detection_counts)
     def open_image_file(self, image_path):
         self.image_path = image_path
-        self.image = rgb2gray(plt.imread(self.image_path)) # In the future, this will be incompatible with greyscale input images.
-        self.original_image = plt.imread(self.image_path)
+        # This is the only time the file gets decoded. Everything else works on these arrays.
+        loaded_image = load_image(self.image_path)
+        self.original_image = loaded_image.pixels
+        self.image = loaded_image.gray()
+        # Hashing the file right after decoding it means it's probably still in the page cache. And the detections get
+        # looked up and saved under the same key, even if the file changes while we work on it.
+        self.cache_key = self.detection_cache.key_for(self.image_path) if self.detection_cache is not None else None
 
-        self.bio_objs.append(BioObject(0, 0, len(self.image[0]), len(self.image), 0, "surface"))
+        self.bio_objs.append(BioObject(0, 0, len(self.image[0]), len(self.image), 0, "surface", store=self.store))
 
-        if self.image.shape[0] > TILE_SIZE or self.image.shape[1] > TILE_SIZE:
+        if self.image.shape[0] > self.tiling.tile_size or self.image.shape[1] > self.tiling.tile_size:
             self.crop()
 
+    @traced("open_image", detection_counts)
+    def open_image_region(self, original_image, name):
+        """ Sets up to process original_image, an array that didn't come straight from an image file (like one region of a mosaic).
+            It always gets tiled, and it's assumed not to have an information bar.
+            name: Identifies the region in its tiles' filenames. """
+        self.original_image = original_image
+        self.image = LoadedImage(self.original_image).gray()
+
+        self.bio_objs.append(BioObject(0, 0, len(self.image[0]), len(self.image), 0, "surface", store=self.store))
+
+        tiles = make_tiles(self.original_image, name, self.tiling.tile_size, self.tiling.crop_offset())
+        self.tiles, self.skipped_tiles = skip_empty_tiles(tiles, self.image, self.tiling.min_tile_foreground)
+
+    def load_cached_detections(self):
+        """ Adds the cached detections for this image to self.bio_objs. Returns False if there weren't any. """
+        if self.cache_key is None:
+            return False
+        cached_bio_objs = self.detection_cache.get(self.cache_key, self.store)
+        if cached_bio_objs is None:
+            return False
+        self.bio_objs += cached_bio_objs
+        for obj in filter(lambda obj: obj.is_cell(), cached_bio_objs):
+            self.cell_grid.insert(obj)
+        return True
+
+    def cache_detections(self):
+        if self.cache_key is not None:
+            self.detection_cache.put(self.cache_key, self.bio_objs[1:]) # bio_objs[0] is the surface
+
+    @traced("compute_bounding_boxes", detection_counts)
     def compute_bounding_boxes(self, update_progress_bar=None):
-        if not self.made_crops:
-            image_filename = self.image_path
-            slash_index = -1
-            if "/" in image_filename:
-                slash_index = image_filename.rfind("/")
-            image_filename = image_filename[slash_index + 1:]
-
-            filenames = [image_filename]
-            paths = [self.image_path]
-            top_left_corners = [(0, 0)]
-        else:
-            filenames = list(filter(lambda s: any(s.lower().endswith(ext) for ext in IMAGE_EXTENSIONS), os.listdir(CROP_DIR)))
-            paths = list(map(lambda filename: f"{CROP_DIR}/{filename}", filenames))
-            top_left_corners = list(map(int, path[:path.rfind(".")].split("_")[-2:]) for path in paths)
+        if self.load_cached_detections():
+            return
 
         # This is a list of lists of cells, each list corresponding to a crop.
-        yolo_output = run_yolo_on_images(paths, update_progress_bar)
-        cell_lists = parse_yolo_output(yolo_output)
-
-        if len(cell_lists) > 1:
-            tiles = []
-            for i in range(len(filenames)):
-                xmin, ymin = top_left_corners[i]
-                tile = Tile(Image.open(paths[i]), xmin, ymin, xmin + TILE_SIZE, ymin + TILE_SIZE, filenames[i])
-                tile.bio_objs = cell_lists[i]
-                tiles.append(tile)
-            full_tile = reunify_tiles(tiles, full_image=Image.fromarray(self.image))
+        images, paths = self.detector_inputs()
+        cell_lists = [bio_objs for _, bio_objs in self.detector.detect(images, update_progress_bar, paths)]
+
+        if self.is_tiled():
+            for tile, cell_list in zip(self.tiles, cell_lists):
+                tile.bio_objs = cell_list
+            full_tile = reunify_tiles(self.tiles, full_image=self.image, store=self.store, tiling=self.tiling)
             self.bio_objs += full_tile.bio_objs
         elif cell_lists == []:
             self.bio_objs += []
         else:
-            self.bio_objs += cell_lists[0]
+            self.bio_objs += copy_bio_objects(cell_lists[0], self.store)
+
+        self.cache_detections()
 
+    @traced("compute_bbox_overlaps_and_cell_centers", detection_counts)
     def compute_bbox_overlaps_and_cell_centers(self):
         compute_all_cell_bbox_overlaps(self.bio_objs)
         compute_nanowire_to_cell_bbox_overlaps(self.bio_objs)
-        for obj in self.bio_objs:
-            if obj.is_cell():
-                compute_cell_center(obj, self.image)
+        self.segmentation_executor.run(self.image, centers=[obj for obj in self.bio_objs if obj.is_cell()])
 
-    def crop(self):
-        # Make the crops directory
-        directory = self.image_path[:self.image_path.rfind("/")]
-        self.made_crops = True
+    @traced("compute_bounding_boxes_overlaps_and_cell_centers", detection_counts)
+    def compute_bounding_boxes_overlaps_and_cell_centers(self, update_progress_bar=None):
+        """ Does the same thing as compute_bounding_boxes followed by compute_bbox_overlaps_and_cell_centers,
+            but pipelined: once every tile that could affect an object is done, that object's overlaps,
+            center, contour and cell contacts get computed while darknet keeps working on the remaining tiles.
+            (When fusing tiles, nothing gets segmented until darknet is done with every tile.) """
+        if self.load_cached_detections():
+            self.segment_resolved_objects(self.bio_objs[1:])
+            return
+
+        results = Queue()
+        tiles = self.tiles if self.is_tiled() else [make_full_tile(self.image)]
+        images, paths = self.detector_inputs()
 
-        os.makedirs(CROP_DIR, exist_ok=True)
+        def run_detector():
+            try:
+                for result in self.detector.detect(images, None, paths):
+                    results.put(result)
+            except Exception as e:
+                results.put(e)
+            results.put(None)
 
-        # Remove any clutter in the crop directory
-        for file in os.listdir(CROP_DIR):
-            os.remove(f"{CROP_DIR}/{file}")
+        detector_thread = Thread(target=run_detector, daemon=True)
+        detector_thread.start()
 
+        tile_boxes = np.array([(tile.x1, tile.y1, tile.x2, tile.y2) for tile in tiles])
+        tile_is_done = np.zeros(len(tiles), dtype=bool)
+        full_tile = make_full_tile(self.image, self.store)
+        pending = []
+        while (result := results.get()) is not None:
+            if isinstance(result, Exception):
+                raise result
+
+            tile_index, bio_objs = result
+            tile_is_done[tile_index] = True
+            if self.is_tiled() and self.tiling.reunify_mode == REUNIFY_BY_FUSION:
+                # An object's detections can come from any of the tiles it's in, so fusing has to wait for every tile.
+                tiles[tile_index].bio_objs = bio_objs
+                bio_objs = []
+            elif self.is_tiled():
+                tiles[tile_index].bio_objs = bio_objs
+                bio_objs = reunify_tile(tiles[tile_index], full_tile, self.tiling.tile_overlap)
+            else:
+                bio_objs = copy_bio_objects(bio_objs, self.store)
+            self.bio_objs += bio_objs
+            pending += bio_objs
+            for obj in filter(lambda obj: obj.is_cell(), bio_objs):
+                self.cell_grid.insert(obj)
+
+            resolved = self.find_resolved_objects(pending, tile_boxes, tile_is_done)
+            self.segment_resolved_objects([obj for obj, is_resolved in zip(pending, resolved) if is_resolved])
+            pending = [obj for obj, is_resolved in zip(pending, resolved) if not is_resolved]
+
+            if update_progress_bar is not None:
+                update_progress_bar(int(tile_is_done.sum() / len(tiles) * 100))
+
+        detector_thread.join()
+        if self.is_tiled() and self.tiling.reunify_mode == REUNIFY_BY_FUSION:
+            pending = reunify_tiles(self.tiles, self.image, self.store, self.tiling).bio_objs
+            self.bio_objs += pending
+            for obj in filter(lambda obj: obj.is_cell(), pending):
+                self.cell_grid.insert(obj)
+        self.segment_resolved_objects(pending)
+        self.cache_detections()
+
+    def detector_inputs(self):
+        """ Returns (the images to hand the detector, the files they came from or None). """
+        if self.is_tiled():
+            # Tiles that hang off the edge of the image get padded to the full tile size, so the model sees them at the same scale.
+            return [tile.padded_img() for tile in self.tiles], None
+        return [self.original_image], [self.image_path]
+
+    def find_resolved_objects(self, bio_objs, tile_boxes, tile_is_done):
+        """ Returns a boolean array saying which of bio_objs don't depend on any tiles that darknet hasn't finished. """
+        if bio_objs == []:
+            return np.zeros(0, dtype=bool)
+        obj_boxes = gather_boxes(bio_objs)
+        # When pipelining, an object is segmented once every tile within margin of its bounding box is done.
+        # Darknet's boxes can hang off the edge of their tile a bit, so this is more than OVERLAP_TOLERANCE.
+        margin = self.tiling.tile_size // 2 + OVERLAP_TOLERANCE
+        # near[i, j] is True if tile j is within margin of object i
+        near = (obj_boxes[:, None, 0] - margin < tile_boxes[None, :, 2]) \
+             & (tile_boxes[None, :, 0] < obj_boxes[:, None, 2] + margin) \
+             & (obj_boxes[:, None, 1] - margin < tile_boxes[None, :, 3]) \
+             & (tile_boxes[None, :, 1] < obj_boxes[:, None, 3] + margin)
+        return ~(near & ~tile_is_done).any(axis=1)
+
+    def segment_resolved_objects(self, bio_objs):
+        """ Computes everything we can about bio_objs without waiting for the rest of the image.
+            All the cells that could overlap with bio_objs must already be in self.cell_grid. """
+        for obj in bio_objs:
+            if obj.is_cell():
+                obj.overlapping_bboxes = find_cell_bbox_overlaps(obj, self.cell_grid)
+            elif obj.is_nanowire():
+                obj.overlapping_bboxes = find_nanowire_bbox_overlaps(obj, self.cell_grid)
+
+        cells = [obj for obj in bio_objs if obj.is_cell()]
+        # Nanowires touching more than two cells need their contour to work out which cells they connect.
+        self.segmentation_executor.run(self.image, centers=cells,
+                                       contours=[obj for obj in bio_objs if (obj.is_cell() and obj.overlapping_bboxes != [])
+                                                                         or (obj.is_nanowire() and len(obj.overlapping_bboxes) > 2)])
+
+        # Test the cell pairs compute_cell_contact would test, if both contours are ready.
+        pairs = []
+        for cell1 in filter(lambda obj: obj.has_contour(), cells):
+            for cell2 in filter(lambda obj: obj.has_contour(), cell1.overlapping_bboxes):
+                if cell2.id < cell1.id:
+                    pairs.append((cell1, cell2))
+                elif cell2.id > cell1.id and cell1 in cell2.overlapping_bboxes:
+                    pairs.append((cell2, cell1))
+        for (cell1, cell2), in_contact in zip(pairs, self.segmentation_executor.map(lambda pair: cells_are_in_contact(*pair), pairs)):
+            self.known_contacts[(cell1.id, cell2.id)] = in_contact
+
+    def crop(self):
         # The image file we're going to crop
         filename = self.image_path[self.image_path.rfind("/") + 1:]
 
         # This assumes the image has the information bar on the bottom
-        image = Image.open(f"{directory}/{filename}")
-        min_row = image.height
-        for row in reversed(range(image.height)):
-            if all(image.getpixel((col, row)) in (0, 255) for col in range(0, image.width, image.width // 10)):
-                min_row = row
-
-        image = image.crop((0, 0, image.width, min_row))
-        image.save("out.jpg")
+        tiles = tile_image(self.original_image, filename[:filename.rfind(".")], self.tiling.tile_size, self.tiling.crop_offset())
+        self.tiles, self.skipped_tiles = skip_empty_tiles(tiles, self.image, self.tiling.min_tile_foreground)
 
-        # Crop the image, and save all the crops in CROP_DIR
-        for tile in make_tiles(image, filename[:filename.rfind(".")]):
-            tile.save(directory=CROP_DIR)
+    def is_tiled(self):
+        return self.tiles != [] or self.skipped_tiles != []
 
     def compute_cell_network_edges(self, update_progress_bar=None):
-        compute_cell_contact(self.bio_objs, self.image, update_progress_bar)
-        compute_nanowire_edges(self.bio_objs, self.image, update_progress_bar)
+        with stage("compute_cell_contact") as span:
+            compute_cell_contact(self.bio_objs, self.image, update_progress_bar, self.known_contacts, self.segmentation_executor)
+            span.count(edges=edge_count(self.bio_objs))
+        with stage("compute_nanowire_edges") as span:
+            compute_nanowire_edges(self.bio_objs, self.image, update_progress_bar, self.segmentation_executor)
+            span.count(edges=edge_count(self.bio_objs))
@@ -0,0 +1,177 @@
+""" segmentation_executor.py
+    Runs the per-object segmentation (thresholds, labels, centers and contours) on a pool of threads or processes.
+    Objects get split into spatially coherent chunks, so each task works on one neighbourhood of the image, and the
+    results get merged back in their original order, so the graph comes out the same as when everything runs serially.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from bio_object import BioObject, compute_cell_center, compute_contour
+
+# Objects whose centers are in the same CHUNK_SIZE x CHUNK_SIZE square of the image get segmented by the same task.
+CHUNK_SIZE = 256 # px
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# In each worker process, a view of the parent's current grayscale image, which lives in shared memory.
+worker_image = None
+worker_shared_memory = None
+worker_shared_memory_name = None
+
+
+def spatial_chunks(bio_objs, chunk_size=CHUNK_SIZE):
+    """ Splits bio_objs into lists of objects that are close together. Each list keeps the order of bio_objs. """
+    chunks = {}
+    for bio_obj in bio_objs:
+        x, y = bio_obj.center()
+        chunks.setdefault((int(y) // chunk_size, int(x) // chunk_size), []).append(bio_obj)
+    return [chunks[key] for key in sorted(chunks)]
+
+def segment_chunk(bio_objs, image, wants_center, wants_contour):
+    """ Computes the centers and contours of bio_objs that were asked for. """
+    for bio_obj, center_wanted, contour_wanted in zip(bio_objs, wants_center, wants_contour):
+        if center_wanted:
+            compute_cell_center(bio_obj, image)
+        if contour_wanted and not bio_obj.has_contour():
+            compute_contour(bio_obj, image)
+
+def attach_image(shared_memory_name, shape, dtype):
+    """ Makes worker_image a view of the image in shared memory, unless it already is. The pool outlives each image,
+        so a worker attaches again whenever the parent moves on to another one. """
+    global worker_image, worker_shared_memory, worker_shared_memory_name
+    if worker_shared_memory_name == shared_memory_name:
+        return
+    if worker_shared_memory is not None:
+        worker_image = None
+        worker_shared_memory.close()
+    # Workers share the parent's resource tracker, so attaching here doesn't make anyone else responsible for freeing it.
+    worker_shared_memory = SharedMemory(name=shared_memory_name)
+    worker_shared_memory_name = shared_memory_name
+    worker_image = np.ndarray(shape, dtype=dtype, buffer=worker_shared_memory.buf)
+
+def segment_chunk_in_worker(shared_image, chunk):
+    """ shared_image: (shared memory name, shape, dtype) of the image, as given by SharedImage.
+        chunk:        A list of (bbox, classification, overlapping bboxes, wants_center, wants_contour) for each object.
+        Returns (cell_center, contour, contour_offset) for each object. """
+    attach_image(*shared_image)
+    bio_objs = []
+    for bbox, classification, overlapping_bboxes, _, _ in chunk:
+        bio_obj = BioObject(*bbox, None, classification)
+        bio_obj.overlapping_bboxes = [BioObject(*overlap_bbox, None, "cell") for overlap_bbox in overlapping_bboxes]
+        bio_objs.append(bio_obj)
+
+    segment_chunk(bio_objs, worker_image, [entry[3] for entry in chunk], [entry[4] for entry in chunk])
+    return [(bio_obj.cell_center, bio_obj.contour, bio_obj.contour_offset) for bio_obj in bio_objs]
+
+
+class SharedImage:
+    def __init__(self, image):
+        """ Puts a copy of image in shared memory, so worker processes can read it without each getting a copy.
+            Use it in a with statement (or call open and close); the shared memory gets freed afterwards. """
+        self.image = image
+        self.shared_memory = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        """ Copies the image into shared memory, and returns (shared memory name, shape, dtype) for attach_image. """
+        self.shared_memory = SharedMemory(create=True, size=max(1, self.image.nbytes))
+        np.ndarray(self.image.shape, dtype=self.image.dtype, buffer=self.shared_memory.buf)[...] = self.image
+        return self.shared_memory.name, self.image.shape, self.image.dtype
+
+    def close(self):
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+
+class SegmentationExecutor:
+    def __init__(self, workers=DEFAULT_WORKERS, use_processes=False):
+        """ workers:       How many threads (or processes) to segment with. 1 means everything runs on the calling thread.
+            use_processes: Whether to use processes instead of threads. Processes sidestep the GIL, but they take a while
+                           to start, so they only pay off on big, dense images. They're started the first time they're
+                           needed and kept until close, and each image only gets copied into shared memory once. """
+        self.workers = workers
+        self.use_processes = use_processes
+        self.process_pool = None
+        # The image the worker processes can see, and its SharedImage.
+        self.shared_source = None
+        self.shared_image = None
+        self.shared_image_info = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def map(self, function, items):
+        """ Returns [function(item) for item in items], computed on the thread pool. """
+        if self.workers <= 1 or len(items) <= 1:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(function, items))
+
+    def run(self, image, centers=(), contours=()):
+        """ Computes the cell centers of the objects in centers and the contours of the objects in contours
+            (unless they already have one), just like compute_cell_center and compute_contour would. """
+        center_ids = {id(bio_obj) for bio_obj in centers}
+        contour_ids = {id(bio_obj) for bio_obj in contours if not bio_obj.has_contour()}
+        bio_objs = list({id(bio_obj): bio_obj for bio_obj in (*centers, *contours)}.values())
+        chunks = spatial_chunks(bio_objs)
+        flags = [([id(bio_obj) in center_ids for bio_obj in chunk], [id(bio_obj) in contour_ids for bio_obj in chunk])
+                 for chunk in chunks]
+
+        if self.use_processes and self.workers > 1 and len(chunks) > 1:
+            self.run_on_processes(image, chunks, flags)
+        else:
+            # Every task only writes to its own objects, so the threads don't need to coordinate.
+            self.map(lambda i: segment_chunk(chunks[i], image, *flags[i]), range(len(chunks)))
+
+    def share(self, image):
+        """ Returns where the worker processes can find image, copying it into shared memory unless it's already there.
+            Pipelined runs segment the same image once per tile, so it only gets copied the first time. """
+        if self.shared_source is not image:
+            self.release_image()
+            self.shared_image = SharedImage(image)
+            self.shared_image_info = self.shared_image.open()
+            self.shared_source = image
+        return self.shared_image_info
+
+    def release_image(self):
+        if self.shared_image is not None:
+            self.shared_image.close()
+        self.shared_source = self.shared_image = self.shared_image_info = None
+
+    def run_on_processes(self, image, chunks, flags):
+        payloads = [[(bio_obj.bbox(), bio_obj.classification, [overlap_box.bbox() for overlap_box in bio_obj.overlapping_bboxes],
+                      wants_center, wants_contour)
+                     for bio_obj, wants_center, wants_contour in zip(chunk, *chunk_flags)]
+                    for chunk, chunk_flags in zip(chunks, flags)]
+
+        shared_image = self.share(image)
+        if self.process_pool is None:
+            # Like in batch processing, we don't fork, because the GUI process has threads and Qt state.
+            self.process_pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        all_results = self.process_pool.map(segment_chunk_in_worker, [shared_image] * len(payloads), payloads)
+        for chunk, (wants_center, wants_contour), results in zip(chunks, flags, all_results):
+            for bio_obj, center_wanted, contour_wanted, (cell_center, contour, contour_offset) in zip(chunk, wants_center, wants_contour, results):
+                if center_wanted:
+                    bio_obj.cell_center = cell_center
+                if contour_wanted:
+                    bio_obj.contour = contour
+                    bio_obj.contour_offset = contour_offset
+
+    def close(self):
+        """ Stops the worker processes (if there are any) and frees the shared image. """
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+            self.process_pool = None
+        self.release_image()
@@ -0,0 +1,156 @@
+""" spatial_index.py
+    Spatial indexes, so we can find the objects near a point or box without looking at every object.
+"""
+
+from collections import defaultdict
+from math import floor
+import numpy as np
+
+# Most cells are a few dozen px across, so this keeps the number of grid cells each box touches small.
+GRID_CELL_SIZE = 64 # px
+# A NodeIndex searches this many new nodes by brute force before it rebuilds its tree to include them.
+MAX_BUFFERED_NODES = 256
+# A NodeIndex rebuilds its tree once more than this fraction of the nodes in it have been deleted.
+MAX_DELETED_FRACTION = 0.25
+
+
+class BBoxGrid:
+    def __init__(self, bio_objs=(), cell_size=GRID_CELL_SIZE):
+        """ A uniform grid over the bounding boxes of bio_objs. Each grid cell remembers which boxes touch it.
+            bio_objs:  Anything with x1, y1, x2, y2 attributes. More can be added later with insert.
+            cell_size: The side length of each grid cell, in px. """
+        self.cell_size = cell_size
+        self.bio_objs = []
+        # Maps (column, row) to the indices (in self.bio_objs) of the boxes that touch that grid cell.
+        self.grid = defaultdict(list)
+
+        for bio_obj in bio_objs:
+            self.insert(bio_obj)
+
+    def grid_cells_touching(self, x1, y1, x2, y2):
+        for col in range(floor(x1) // self.cell_size, floor(x2) // self.cell_size + 1):
+            for row in range(floor(y1) // self.cell_size, floor(y2) // self.cell_size + 1):
+                yield col, row
+
+    def insert(self, bio_obj):
+        index = len(self.bio_objs)
+        self.bio_objs.append(bio_obj)
+        for grid_cell in self.grid_cells_touching(bio_obj.x1, bio_obj.y1, bio_obj.x2, bio_obj.y2):
+            self.grid[grid_cell].append(index)
+
+    def query(self, x1, y1, x2, y2):
+        """ Returns the objects whose bounding boxes touch the box (x1, y1, x2, y2), including on its edges,
+            in the order they were inserted. """
+        indices = set()
+        for grid_cell in self.grid_cells_touching(x1, y1, x2, y2):
+            indices.update(self.grid.get(grid_cell, ()))
+
+        return [self.bio_objs[i] for i in sorted(indices)
+                if self.bio_objs[i].x1 <= x2 and x1 <= self.bio_objs[i].x2 and self.bio_objs[i].y1 <= y2 and y1 <= self.bio_objs[i].y2]
+
+    def near(self, bio_obj, distance):
+        """ Returns the objects whose bounding boxes come within distance of bio_obj's, in the order they were inserted.
+            bio_obj itself is included if it's in the grid. """
+        return self.query(bio_obj.x1 - distance, bio_obj.y1 - distance, bio_obj.x2 + distance, bio_obj.y2 + distance)
+
+
+class NodeIndex:
+    def __init__(self, nodes=(), max_buffered_nodes=MAX_BUFFERED_NODES, max_deleted_fraction=MAX_DELETED_FRACTION):
+        """ Finds the node closest to a point, while nodes get added and removed (like in the GUI's network editor).
+            Nodes are kept in a KDTree, but it isn't rebuilt every time a node changes: new nodes wait in a small buffer
+            that gets searched by brute force, and removed nodes are only marked as deleted, until there are enough of
+            either for a rebuild to be worth it.
+            nodes:                (node_id, x, y) for each node to start with.
+            max_buffered_nodes:   How many new nodes can wait outside the tree.
+            max_deleted_fraction: What fraction of the tree's nodes can be deleted before it's rebuilt without them. """
+        self.max_buffered_nodes = max_buffered_nodes
+        self.max_deleted_fraction = max_deleted_fraction
+        # Every node has a slot. The tree holds the first num_tree_slots of them, and the rest are the buffer.
+        # Slots only get renumbered when the tree is rebuilt. self.points and self.is_deleted have room for more slots
+        # than there are, so inserting doesn't have to copy them every time.
+        self.points = np.zeros((0, 2))
+        self.node_ids = []
+        self.is_deleted = np.zeros(0, dtype=bool)
+        # Maps node ids to their (live) slot.
+        self.slot_of = {}
+        self.tree = None
+        self.num_tree_slots = 0
+        self.num_deleted = 0
+
+        nodes = list(nodes)
+        self.node_ids = [node_id for node_id, _, _ in nodes]
+        self.points = np.array([(x, y) for _, x, y in nodes], dtype=float).reshape(-1, 2)
+        self.is_deleted = np.zeros(len(nodes), dtype=bool)
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, node_id):
+        return node_id in self.slot_of
+
+    def rebuild(self):
+        """ Rebuilds the tree out of every live node, which empties the buffer and forgets the deleted nodes. """
+        from scipy.spatial import KDTree
+
+        live = np.flatnonzero(~self.is_deleted[:len(self.node_ids)])
+        self.points = self.points[live]
+        self.node_ids = [self.node_ids[slot] for slot in live.tolist()]
+        self.is_deleted = np.zeros(len(self.node_ids), dtype=bool)
+        self.slot_of = {node_id: slot for slot, node_id in enumerate(self.node_ids)}
+        self.tree = KDTree(self.points) if len(self.node_ids) > 0 else None
+        self.num_tree_slots = len(self.node_ids)
+        self.num_deleted = 0
+
+    def insert(self, node_id, x, y):
+        """ Adds a node, or moves it to (x, y) if it's already here. """
+        if node_id in self.slot_of:
+            self.remove(node_id)
+        slot = len(self.node_ids)
+        if slot == len(self.points):
+            capacity = max(self.max_buffered_nodes, 2 * slot)
+            self.points = np.vstack((self.points, np.zeros((capacity - slot, 2))))
+            self.is_deleted = np.append(self.is_deleted, np.zeros(capacity - slot, dtype=bool))
+        self.slot_of[node_id] = slot
+        self.node_ids.append(node_id)
+        self.points[slot] = (x, y)
+        self.is_deleted[slot] = False
+        if len(self.node_ids) - self.num_tree_slots > self.max_buffered_nodes:
+            self.rebuild()
+
+    def remove(self, node_id):
+        """ Removes a node. Nodes that aren't here are ignored. """
+        slot = self.slot_of.pop(node_id, None)
+        if slot is None:
+            return
+        self.is_deleted[slot] = True
+        self.num_deleted += 1
+        if self.num_deleted > self.max_deleted_fraction * max(1, self.num_tree_slots):
+            self.rebuild()
+
+    def nearest(self, x, y):
+        """ Returns (distance, node_id) of the live node closest to (x, y), or (inf, None) if there aren't any. """
+        best_distance, best_slot = np.inf, None
+
+        if self.tree is not None:
+            # The closest nodes in the tree might have been deleted, so keep asking for more until we get past them.
+            k = 1
+            while True:
+                distances, slots = self.tree.query((x, y), k=min(k, self.num_tree_slots))
+                distances, slots = np.atleast_1d(distances), np.atleast_1d(slots)
+                live = np.flatnonzero(~self.is_deleted[slots])
+                if len(live) > 0:
+                    best_distance, best_slot = distances[live[0]], int(slots[live[0]])
+                    break
+                if k >= self.num_tree_slots:
+                    break
+                k *= 2
+
+        buffer = np.arange(self.num_tree_slots, len(self.node_ids))[~self.is_deleted[self.num_tree_slots:len(self.node_ids)]]
+        if len(buffer) > 0:
+            distances = np.hypot(*(self.points[buffer] - (x, y)).T)
+            closest = int(np.argmin(distances))
+            if distances[closest] < best_distance:
+                best_distance, best_slot = distances[closest], int(buffer[closest])
+
+        return (float(best_distance), self.node_ids[best_slot]) if best_slot is not None else (np.inf, None)
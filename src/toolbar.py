@@ -146,10 +146,9 @@ class CustomToolbar(NavigationToolbar2QT):
             return
 
         node_id = max([int(node) for node in self.post_processor.graph.nodes]) + 1
-        self.post_processor.graph.add_node(node_id, x=int(event.xdata), y=int(event.ydata), node_type=NORMAL)
+        self.post_processor.add_node(node_id, int(event.xdata), int(event.ydata), NORMAL)
         self.MplWidget.draw_node(node_id, self.post_processor.graph.nodes[node_id])
         self.MplWidget.canvas.draw()
-        self.post_processor.build_KDTree()
         self.main_window.update_cell_counters()
 
     def add_edge_button_press(self, mode):
@@ -285,9 +284,8 @@ class CustomToolbar(NavigationToolbar2QT):
         graph = self.post_processor.graph
         object_data = self.MplWidget.artist_data[event.artist._gid]
         if object_data["network_type"] == "node":
-            self.post_processor.graph.remove_node(object_data["node_id"])
+            self.post_processor.remove_node(object_data["node_id"])
             self.main_window.update_cell_counters()
-            self.post_processor.build_KDTree()
         elif object_data["network_type"] == "edge" and graph.has_edge(object_data["edge_head"], object_data["edge_tail"], key=object_data["edge_key"]):
             graph.remove_edge(object_data["edge_head"], object_data["edge_tail"], key=object_data["edge_key"])
             self.main_window.update_edge_counters()
@@ -0,0 +1,390 @@
+""" tracing.py
+    Records where the time goes in a run: each stage of the pipeline (and each darknet call) gets its wall and CPU time,
+    along with counts like how many tiles or objects it worked on and how many bytes it wrote.
+    Tracing is off unless BACTERIA_NETWORKS_TRACE names a log file (run.py process sets it with --trace). Then every
+    stage appends one JSON line to the log, from every process, since worker processes inherit the environment.
+    The log can be turned into a Chrome trace, to look at in chrome://tracing or Perfetto.
+    Setting BACTERIA_NETWORKS_PROFILE to a stage's name also runs that stage under cProfile, and saves its stats next to the log.
+    Setting BACTERIA_NETWORKS_TRACE_MEMORY (or --trace-memory) also records each stage's peak RSS, and how much it grew the RSS.
+    Stages running at the same time on different threads share their peaks, since memory is per process. Each stage also
+    logs when it starts, so if a worker gets killed for running out of memory, the log says which stage it was in.
+    Setting BACTERIA_NETWORKS_TRACE_ALLOCATIONS (or --trace-allocations) also runs tracemalloc, which slows everything down
+    a lot, and records the peak traced memory of each stage, and the biggest new allocation sites of each wrapper stage
+    (like one image's whole run).
+"""
+
+import cProfile
+import functools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+TRACE_ENV_VAR = "BACTERIA_NETWORKS_TRACE"
+PROFILE_ENV_VAR = "BACTERIA_NETWORKS_PROFILE"
+MEMORY_ENV_VAR = "BACTERIA_NETWORKS_TRACE_MEMORY"
+ALLOCATIONS_ENV_VAR = "BACTERIA_NETWORKS_TRACE_ALLOCATIONS"
+# How many allocation sites to record for each wrapper stage, and how many frames of each allocation's stack tracemalloc keeps.
+TOP_ALLOCATION_SITES = 5
+TRACEMALLOC_FRAMES = 1
+
+
+def current_rss_bytes():
+    """ Returns how much of this process is in RAM, or None if we can't tell on this platform. """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+def peak_rss_bytes():
+    """ Returns the most this process has had in RAM since the last reset_peak_rss (or since it started). """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    import resource
+    # ru_maxrss is in kB on Linux, but in bytes on macOS.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def reset_peak_rss():
+    """ Makes peak_rss_bytes start over from the current RSS. Returns False if this platform can't do that,
+        in which case peak_rss_bytes is the peak over the whole life of the process. """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def top_allocation_sites(snapshot):
+    """ Returns the lines that allocated the most memory (that's still allocated) since snapshot, apart from tracing itself. """
+    # Leaving tracing out of the stats, instead of out of the snapshots, is much quicker, since there are far fewer of them.
+    growth = [stat for stat in tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+              if stat.traceback[0].filename not in (tracemalloc.__file__, __file__)]
+    top_sites = sorted(growth, key=lambda stat: stat.size_diff, reverse=True)[:TOP_ALLOCATION_SITES]
+    return [{"site": str(stat.traceback), "new_bytes": stat.size_diff} for stat in top_sites if stat.size_diff > 0]
+
+def reset_peaks():
+    tracemalloc.reset_peak()
+    return reset_peak_rss()
+
+
+class MemoryFrame:
+    def __init__(self, parent, track_allocations=False):
+        """ The memory accounting for one Span that hasn't finished yet.
+            parent:            The MemoryFrame of the Span on the same thread that this one is part of, or None.
+            track_allocations: Whether tracemalloc is running, so there's traced memory to record. """
+        self.parent = parent
+        self.track_allocations = track_allocations
+        # How much the RSS grew during the Spans that are part of this one.
+        self.children_rss_growth_bytes = 0
+        self.start_traced_bytes = tracemalloc.get_traced_memory()[0]
+        self.peak_traced_bytes = self.start_traced_bytes
+        self.start_rss_bytes = current_rss_bytes()
+        self.peak_rss_bytes = self.start_rss_bytes or 0
+        self.peak_rss_is_lifetime = False
+
+    def to_counts(self, end_rss_bytes):
+        # Freed memory usually stays in the RSS, so how much a stage grew the RSS (apart from the stages that are part of it)
+        # says which stage needs the memory better than which stage was running at the peak.
+        rss_growth_bytes = (end_rss_bytes or 0) - (self.start_rss_bytes or 0)
+        if self.parent is not None:
+            self.parent.children_rss_growth_bytes += rss_growth_bytes
+        counts = {"peak_rss_bytes": self.peak_rss_bytes, "peak_rss_is_lifetime": self.peak_rss_is_lifetime,
+                  "start_rss_bytes": self.start_rss_bytes, "end_rss_bytes": end_rss_bytes,
+                  "own_rss_growth_bytes": rss_growth_bytes - self.children_rss_growth_bytes}
+        if self.track_allocations:
+            counts.update(peak_traced_bytes=self.peak_traced_bytes, start_traced_bytes=self.start_traced_bytes)
+        return counts
+
+
+class Span:
+    def __init__(self, name, counts):
+        """ One run of a stage. Stages can add to counts while they run (or the caller can, afterwards). """
+        self.name = name
+        self.counts = counts
+        self.start = time.time()
+        self.wall_seconds = 0
+        self.cpu_seconds = 0
+
+    def count(self, **counts):
+        self.counts.update(counts)
+
+    def to_dict(self):
+        return {"name": self.name, "start": self.start, "wall_seconds": self.wall_seconds, "cpu_seconds": self.cpu_seconds,
+                "pid": os.getpid(), "thread": threading.get_ident(), "counts": self.counts}
+
+
+class Tracer:
+    def __init__(self, log_path=None, profile_stage=None, track_memory=False, track_allocations=False):
+        """ log_path:          The file to append a JSON line to for each stage. None means no log.
+            profile_stage:     The name of a stage to run under cProfile, or None.
+            track_memory:      Whether to record each stage's peak memory. Tracing is on if this is True or there's a log.
+            track_allocations: Whether to also run tracemalloc, to find where the memory is allocated. Implies track_memory. """
+        self.log_path = log_path
+        self.profile_stage = profile_stage
+        self.track_memory = track_memory
+        self.track_allocations = False
+        self.lock = threading.Lock()
+        self.num_profiles = 0
+        # Lists that every finished Span gets appended to, for collect().
+        self.collectors = []
+        # The MemoryFrames of the Spans that haven't finished yet.
+        self.memory_frames = []
+        # Each thread's unfinished MemoryFrames, innermost last.
+        self.thread_state = threading.local()
+        if track_allocations:
+            self.start_tracking_allocations()
+
+    def is_enabled(self):
+        return self.log_path is not None or self.track_memory
+
+    def start_tracking_allocations(self):
+        self.track_memory = True
+        self.track_allocations = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    @contextmanager
+    def stage(self, name, is_wrapper=False, **counts):
+        """ Times the code in the with statement as one run of the stage called name, and yields its Span.
+            is_wrapper: Whether the stage only groups other stages (like one image's whole run). Wrappers don't track memory,
+                        so the memory their stages use (or leave behind) never gets blamed on them. Instead, if allocations
+                        are tracked, they record the biggest new allocation sites of everything in them. """
+        span = Span(name, counts)
+        if not self.is_enabled():
+            yield span
+            return
+
+        # Snapshots are slow, so they're only taken around whole wrappers. And since the snapshot is taken before any of the
+        # wrapper's stages start, and kept until they've all finished, the memory it takes up isn't in any of their RSS growth.
+        snapshot = tracemalloc.take_snapshot() if is_wrapper and self.track_allocations else None
+        memory_frame = self.open_memory_frame() if self.track_memory and not is_wrapper else None
+        if self.track_memory:
+            self.record_start(span)
+        profiler = self.start_profiler() if name == self.profile_stage else None
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield span
+        except BaseException as e:
+            span.count(error=type(e).__name__)
+            raise
+        finally:
+            # This is the whole process's CPU time, so it includes any threads working for the stage (and anything else running).
+            span.wall_seconds = time.perf_counter() - wall_start
+            span.cpu_seconds = time.process_time() - cpu_start
+            if profiler is not None:
+                span.count(profile=self.save_profile(profiler, name))
+            if memory_frame is not None:
+                span.count(**self.close_memory_frame(memory_frame))
+            if snapshot is not None:
+                span.count(top_allocation_sites=top_allocation_sites(snapshot))
+            self.record(span)
+
+    def update_memory_peaks(self):
+        """ Folds the peaks since the last update into every unfinished stage's peaks, and starts the peaks over,
+            so a stage that starts now doesn't see the peaks of the stages before it. """
+        peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+        peak_rss = peak_rss_bytes()
+        peak_rss_is_lifetime = not reset_peaks()
+        for memory_frame in self.memory_frames:
+            memory_frame.peak_traced_bytes = max(memory_frame.peak_traced_bytes, peak_traced_bytes)
+            memory_frame.peak_rss_bytes = max(memory_frame.peak_rss_bytes, peak_rss)
+            memory_frame.peak_rss_is_lifetime |= peak_rss_is_lifetime
+
+    def open_memory_frame(self):
+        if not hasattr(self.thread_state, "memory_frames"):
+            self.thread_state.memory_frames = []
+        thread_memory_frames = self.thread_state.memory_frames
+        with self.lock:
+            self.update_memory_peaks()
+            memory_frame = MemoryFrame(thread_memory_frames[-1] if thread_memory_frames != [] else None, self.track_allocations)
+            self.memory_frames.append(memory_frame)
+            # Setting up the frame shouldn't count towards anyone's peak.
+            memory_frame.peak_rss_is_lifetime = not reset_peaks()
+        thread_memory_frames.append(memory_frame)
+        return memory_frame
+
+    def close_memory_frame(self, memory_frame):
+        """ Returns memory_frame's counts. """
+        end_rss_bytes = current_rss_bytes()
+        self.thread_state.memory_frames.remove(memory_frame)
+        with self.lock:
+            self.update_memory_peaks()
+            self.memory_frames.remove(memory_frame)
+            counts = memory_frame.to_counts(end_rss_bytes)
+            reset_peaks()
+        return counts
+
+    def start_profiler(self):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError: # Only one profiler can run at a time.
+            return None
+        return profiler
+
+    def save_profile(self, profiler, name):
+        profiler.disable()
+        with self.lock:
+            self.num_profiles += 1
+            path = f"{self.log_path}.{name}.{os.getpid()}.{self.num_profiles}.prof"
+        profiler.dump_stats(path)
+        return path
+
+    def write_line(self, record):
+        # Each line is one write to a file opened for appending, so lines from different processes don't get mixed up.
+        if self.log_path is not None:
+            with open(self.log_path, "a") as log_file:
+                log_file.write(json.dumps(record) + "\n")
+
+    def record_start(self, span):
+        """ Logs that span has started, so if the process gets killed (say, for running out of memory),
+            the log still says what it was doing. """
+        with self.lock:
+            self.write_line({"name": span.name, "start": span.start, "pid": os.getpid(), "thread": threading.get_ident(),
+                             "started": True, "rss_bytes": current_rss_bytes(), "counts": span.counts})
+
+    def record(self, span):
+        with self.lock:
+            self.write_line(span.to_dict())
+            for collector in self.collectors:
+                collector.append(span)
+
+    @contextmanager
+    def collect(self):
+        """ Yields a list that every Span this process finishes during the with statement gets appended to. """
+        spans = []
+        with self.lock:
+            self.collectors.append(spans)
+        try:
+            yield spans
+        finally:
+            with self.lock:
+                self.collectors.remove(spans)
+
+    def darknet_stderr(self):
+        """ Returns where darknet's stderr should go: the end of a file next to the log if we're tracing, otherwise nowhere. """
+        if self.log_path is None:
+            return subprocess.DEVNULL
+        return open(self.log_path + ".darknet.log", "ab")
+
+
+tracer = Tracer(os.environ.get(TRACE_ENV_VAR) or None, os.environ.get(PROFILE_ENV_VAR) or None, bool(os.environ.get(MEMORY_ENV_VAR)),
+                bool(os.environ.get(ALLOCATIONS_ENV_VAR)))
+
+def enable(log_path, profile_stage=None):
+    """ Turns on tracing in this process and in the worker processes it starts from now on. """
+    tracer.log_path = os.path.abspath(log_path)
+    tracer.profile_stage = profile_stage
+    os.environ[TRACE_ENV_VAR] = tracer.log_path
+    if profile_stage is not None:
+        os.environ[PROFILE_ENV_VAR] = profile_stage
+
+def enable_memory_tracking(track_allocations=False):
+    """ Turns on memory tracking in this process and in the worker processes it starts from now on.
+        track_allocations: Whether to also run tracemalloc (see Tracer). """
+    tracer.track_memory = True
+    os.environ[MEMORY_ENV_VAR] = "1"
+    if track_allocations:
+        tracer.start_tracking_allocations()
+        os.environ[ALLOCATIONS_ENV_VAR] = "1"
+
+def peak_memory(spans):
+    """ Returns {stage name: {"peak_rss_bytes", "own_rss_growth_bytes", "peak_traced_bytes"}} for the spans that tracked
+        memory (which leaves out wrappers). The peaks are the highest of any of that stage's spans, and the growth is the
+        total of its spans. peak_traced_bytes is 0 unless allocations were tracked. """
+    peaks = {}
+    for span in spans:
+        if "peak_rss_bytes" in span.counts:
+            peak = peaks.setdefault(span.name, {"peak_rss_bytes": 0, "own_rss_growth_bytes": 0, "peak_traced_bytes": 0})
+            peak["peak_rss_bytes"] = max(peak["peak_rss_bytes"], span.counts["peak_rss_bytes"])
+            peak["own_rss_growth_bytes"] += span.counts["own_rss_growth_bytes"]
+            peak["peak_traced_bytes"] = max(peak["peak_traced_bytes"], span.counts.get("peak_traced_bytes", 0))
+    return peaks
+
+def merge_peak_memory(peak_memories):
+    """ Merges several results of peak_memory (like one per region of a mosaic) as if they came from one list of spans. """
+    merged = {}
+    for peaks in peak_memories:
+        for name, peak in peaks.items():
+            merged_peak = merged.setdefault(name, {"peak_rss_bytes": 0, "own_rss_growth_bytes": 0, "peak_traced_bytes": 0})
+            merged_peak["peak_rss_bytes"] = max(merged_peak["peak_rss_bytes"], peak["peak_rss_bytes"])
+            merged_peak["own_rss_growth_bytes"] += peak["own_rss_growth_bytes"]
+            merged_peak["peak_traced_bytes"] = max(merged_peak["peak_traced_bytes"], peak["peak_traced_bytes"])
+    return merged
+
+def describe_peak_memory(peaks):
+    """ Returns a short description of the highest peak RSS in peaks (from peak_memory), and which stage grew the RSS the most. """
+    peak_rss_bytes = max(peak["peak_rss_bytes"] for peak in peaks.values())
+    name = max(peaks, key=lambda name: peaks[name]["own_rss_growth_bytes"])
+    return f"peak RSS {format_bytes(peak_rss_bytes)}, mostly from {name} (+{format_bytes(peaks[name]['own_rss_growth_bytes'])})"
+
+def format_bytes(num_bytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if num_bytes < 1024 or unit == "GB":
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+def stage(name, is_wrapper=False, **counts):
+    return tracer.stage(name, is_wrapper, **counts)
+
+def traced(name, counts=None):
+    """ A decorator for methods that are a whole stage. counts is a function that takes self and returns the stage's counts
+        once it's done. """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with tracer.stage(name) as span:
+                result = method(self, *args, **kwargs)
+                if counts is not None and tracer.is_enabled():
+                    span.count(**counts(self))
+                return result
+        return wrapper
+    return decorator
+
+def read_log(log_path, since=0):
+    """ Returns the records in a trace log that started at or after since (in seconds since the epoch). """
+    with open(log_path) as log_file:
+        records = [json.loads(line) for line in log_file if line.strip() != ""]
+    return [record for record in records if record["start"] >= since]
+
+def unfinished_stages(records):
+    """ Returns the records (from read_log) of the stages that started but never finished, which means their process
+        died in them. There are only start records when memory is being tracked. """
+    unfinished = {}
+    for record in records:
+        key = (record["pid"], record["thread"], record["name"], record["start"])
+        if record.get("started"):
+            unfinished[key] = record
+        else:
+            unfinished.pop(key, None)
+    return list(unfinished.values())
+
+def write_chrome_trace(records, chrome_trace_path):
+    """ Writes records (from read_log) in Chrome's trace event format. """
+    events = [{"name": record["name"], "ph": "X", "ts": record["start"] * 1e6, "dur": record["wall_seconds"] * 1e6,
+               "pid": record["pid"], "tid": record["thread"], "args": {"cpu_seconds": record["cpu_seconds"], **record["counts"]}}
+              for record in records if not record.get("started")]
+    with open(chrome_trace_path, "w") as chrome_trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, chrome_trace_file)
+
+def summarize(spans):
+    """ Returns a short description of how long each stage in spans took in total, in the order they first finished. """
+    totals = {}
+    for span in spans:
+        wall_seconds, num_runs = totals.get(span.name, (0, 0))
+        totals[span.name] = (wall_seconds + span.wall_seconds, num_runs + 1)
+    summary = ", ".join(f"{name} {wall_seconds:.2f} s" + (f" ({num_runs}x)" if num_runs > 1 else "")
+                        for name, (wall_seconds, num_runs) in totals.items())
+    peaks = peak_memory(spans)
+    return summary + (f", {describe_peak_memory(peaks)}" if peaks != {} else "")
@@ -1,79 +1,330 @@
 import subprocess
+import numpy as np
 from bio_object import BioObject
+from detection_store import DetectionStore, NO_TILE, class_id_for
+from image_loader import image_size
+import json
 import os
+import re
+import select
+import tempfile
+import threading
+import time
+from queue import Queue, Empty
+import tracing
 
 DARKNET_BINARY_PATH = "darknet/darknet"
 DATA_PATH = "models/model_6/obj.data"
+NAMES_PATH = "models/model_6/obj.names"
 CFG_PATH = "models/model_6/test.cfg"
 WEIGHTS_PATH = "models/model_6/model_6.weights"
 YOLO_OPTIONS = ["-ext_output", "-dont_show"]
+# What darknet saves its detections as (with -out), when a session is only used for one batch of images.
+JSON_OUTPUT_FILENAME = "detections.json"
 
-def run_yolo_on_images(img_paths, update_progress_bar):
-    """ img_paths:           A list of image paths to be run through YOLO. These are probably crops
-        update_progress_bar: A function to update the progress bar. """
+# Darknet prints this (without a newline) whenever it's ready for the next image.
+PROMPT = b"Enter Image Path:"
+# One detection in darknet's output (with -ext_output), which looks like this:
+# cell: 98%	(left_x:   12   top_y:   34   width:   56   height:   78)
+DETECTION_PATTERN = re.compile(r"^(\S+): (\d+)%\s+\(left_x:\s*(-?\d+)\s+top_y:\s*(-?\d+)\s+width:\s*(-?\d+)\s+height:\s*(-?\d+)\)",
+                               re.MULTILINE)
+READ_SIZE = 65536
+SHUTDOWN_TIMEOUT = 5 # seconds
+MAX_DETECT_ATTEMPTS = 2 # We restart darknet once if it crashes (or hangs) on an image, then give up.
+# If darknet takes longer than this on one image, we assume it's stuck and restart it.
+TILE_TIMEOUT = 120 # seconds
+# A DetectorPool doesn't start more darknets than this unless asked to, since each one has its own copy of the model.
+MAX_DEFAULT_DETECTORS = 4
+# OpenMP stops paying off for darknet somewhere around here, so more cores are better spent on more darknets.
+THREADS_PER_DETECTOR = 4
 
+def check_model_files():
     for path in [DARKNET_BINARY_PATH, DATA_PATH, CFG_PATH, WEIGHTS_PATH]:
         if not os.path.exists(path):
             raise FileNotFoundError(f"Can't open {path}: No such file.")
 
-    proc = subprocess.Popen([DARKNET_BINARY_PATH, "detector", "test", DATA_PATH, CFG_PATH, WEIGHTS_PATH, *YOLO_OPTIONS],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.DEVNULL,
-                            stdin=subprocess.PIPE,
-                            encoding="UTF-8")
-
-    proc.stdin.write("\n".join(img_paths))
-    proc.stdin.close()
-
-    total_output = ""
-    total_images_processed = 0
-    while proc.poll() is None:
-        # We have to read it line by line because reading as many as we can amounts to waiting for the process to finish
-        current_output = proc.stdout.readline()
-        total_output += current_output
-        current_images_processed = current_output.count("Enter Image Path:")
-        if current_images_processed != 0:
-            total_images_processed += current_images_processed
-            if update_progress_bar is not None:
-                update_progress_bar(min(100, int(total_images_processed / len(img_paths) * 100)))
-        # It felt like I should put a sleep in here, but I timed it and it makes no difference.
-
-    total_output += "".join(proc.stdout.readlines())
-
-    # Remove the garbage files that yolo makes
+def remove_darknet_garbage():
+    """ Removes the garbage files that yolo makes. """
     if os.path.exists("bad.list"):
         os.remove("bad.list")
     if os.path.exists("predictions.jpg"):
         os.remove("predictions.jpg")
 
-    return total_output
 
-def parse_yolo_output(yolo_output):
-    """ Takes a string (probably stdout from running yolo) and returns a list of lists of BioObject objects.
-        Each sublist corresponds to one input file."""
+def default_detector_count(threads):
+    """ Returns how many darknets to split threads between. """
+    return max(1, min(MAX_DEFAULT_DETECTORS, threads // THREADS_PER_DETECTOR))
 
-    bio_objs = []
-    bio_obj_id = 1
-    in_an_image = False
-    for line in yolo_output.splitlines():
-        if line.endswith("milli-seconds."): # Starting a new image
-            bio_objs.append([])
-            in_an_image = True
-        elif line.startswith("Enter Image Path:"): # It's asking for another image, so this one is done
-            in_an_image = False
-        elif in_an_image:
-            tokens = line.split()
-            classification = tokens[0][:-1] # Slice because this will have a ':' stuck on the end
-            confidence = tokens[1] # Not used yet
-            # For some reason, yolo sometimes gives negative bounding box dimensions.
-            # We've only seen this happen when the images are really busy
-            xmin = int(tokens[3]) if int(tokens[3]) >= 0 else 0
-            ymin = int(tokens[5]) if int(tokens[5]) >= 0 else 0
-            width = int(tokens[7]) if int(tokens[7]) >= 0 else 0
-            # Slice because this will have a ')' stuck on the end
-            height = int(tokens[9][:-1]) if int(tokens[9][:-1]) >= 0 else 0
-
-            bio_objs[-1].append(BioObject(xmin, ymin, xmin + width, ymin + height, bio_obj_id, classification))
-            bio_obj_id += 1
 
+class DetectorSession:
+    def __init__(self, omp_threads=None, tile_timeout=TILE_TIMEOUT, json_output_path=None):
+        """ A darknet process that stays alive between images, so the model only gets loaded once.
+            Darknet is started the first time it's needed, and restarted if it crashes or takes longer than tile_timeout
+            (in seconds, or None for no limit) on an image.
+            omp_threads:      How many threads darknet gets. None means whatever OMP_NUM_THREADS says.
+            json_output_path: Where darknet saves every image's detections as JSON when the session closes, or None.
+                              Darknet only writes it once it exits, so this is for sessions that get used for one batch. """
+        self.omp_threads = omp_threads
+        self.tile_timeout = tile_timeout
+        self.json_output_path = json_output_path
+        self.proc = None
+        self.pending_output = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        """ Starts darknet and waits for it to finish loading the model. """
+        check_model_files()
+        with tracing.stage("darknet_start"):
+            # When we're tracing, darknet's stderr goes in a file next to the trace log.
+            stderr = tracing.tracer.darknet_stderr()
+            env = None if self.omp_threads is None else dict(os.environ, OMP_NUM_THREADS=str(self.omp_threads))
+            json_options = [] if self.json_output_path is None else ["-out", self.json_output_path]
+            self.proc = subprocess.Popen([DARKNET_BINARY_PATH, "detector", "test", DATA_PATH, CFG_PATH, WEIGHTS_PATH, *YOLO_OPTIONS, *json_options],
+                                         stdout=subprocess.PIPE,
+                                         stderr=stderr,
+                                         stdin=subprocess.PIPE,
+                                         env=env,
+                                         bufsize=0)
+            if stderr is not subprocess.DEVNULL:
+                stderr.close() # darknet has its own copy
+            self.pending_output = b""
+            self.read_until_prompt()
+
+    def read_until_prompt(self, timeout=None):
+        """ Reads darknet's output until it asks for another image, and returns everything it printed before that.
+            We can't use readline here, because the prompt doesn't end with a newline.
+            Raises TimeoutError if that takes more than timeout seconds. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        lines = []
+        while True:
+            *complete_lines, self.pending_output = self.pending_output.split(b"\n")
+            lines += complete_lines
+            if self.pending_output.startswith(PROMPT):
+                self.pending_output = b""
+                return "".join(line.decode("UTF-8") + "\n" for line in lines)
+
+            if deadline is not None and select.select([self.proc.stdout], [], [], max(0, deadline - time.monotonic()))[0] == []:
+                raise TimeoutError(f"darknet took more than {timeout} s on one image")
+            chunk = self.proc.stdout.read(READ_SIZE)
+            if not chunk:
+                raise ChildProcessError(f"darknet exited with status {self.proc.wait()}")
+            self.pending_output += chunk
+
+    def detect(self, img_path):
+        """ Runs darknet on one image and returns the part of its output that belongs to that image. """
+        with tracing.stage("darknet_detect") as span:
+            for attempt in range(MAX_DETECT_ATTEMPTS):
+                if not self.is_running():
+                    self.start()
+                try:
+                    self.proc.stdin.write(f"{img_path}\n".encode("UTF-8"))
+                    output = self.read_until_prompt(self.tile_timeout)
+                    span.count(attempts=attempt + 1, output_bytes=len(output))
+                    return output
+                except (BrokenPipeError, ChildProcessError, TimeoutError):
+                    self.kill()
+                    if attempt == MAX_DETECT_ATTEMPTS - 1:
+                        raise
+
+    def detect_all(self, img_paths, report_done=None):
+        """ Yields darknet's output for each of img_paths, in order.
+            report_done: Called as report_done(num_done) each time an image is done. """
+        for i, img_path in enumerate(img_paths):
+            output = self.detect(img_path)
+            if report_done is not None:
+                report_done(i + 1)
+            yield output
+
+    def kill(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def close(self):
+        """ Tells darknet we're out of images (by closing its stdin) and waits for it to exit. """
+        if self.is_running():
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(timeout=SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc = None
+        remove_darknet_garbage()
+
+
+class DetectorPool:
+    def __init__(self, num_detectors, threads_per_detector=None, tile_timeout=TILE_TIMEOUT):
+        """ Several darknet processes sharing the images they're given, for machines with more cores than one darknet
+            can use. It can be used anywhere a DetectorSession can.
+            threads_per_detector: How many threads each darknet gets. None means whatever OMP_NUM_THREADS says.
+            tile_timeout:         See DetectorSession. """
+        self.sessions = [DetectorSession(threads_per_detector, tile_timeout) for _ in range(num_detectors)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def detect(self, img_path):
+        return self.sessions[0].detect(img_path)
+
+    def detect_all(self, img_paths, report_done=None):
+        """ Yields darknet's output for each of img_paths, in order, while the darknets work through the images
+            in whatever order they get to them.
+            report_done: Called as report_done(num_done) each time any darknet finishes an image. """
+        if len(self.sessions) == 1 or len(img_paths) <= 1:
+            yield from self.sessions[0].detect_all(img_paths, report_done)
+            return
+
+        work = Queue()
+        for i, img_path in enumerate(img_paths):
+            work.put((i, img_path))
+        results = Queue()
+        stop = threading.Event()
+
+        def run_session(session):
+            while not stop.is_set():
+                try:
+                    i, img_path = work.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results.put((i, session.detect(img_path)))
+                except Exception as e:
+                    results.put((i, e))
+                    return
+
+        threads = [threading.Thread(target=run_session, args=(session,), daemon=True)
+                   for session in self.sessions[:len(img_paths)]]
+        for thread in threads:
+            thread.start()
+
+        # Outputs that came back before the ones ahead of them.
+        finished = {}
+        try:
+            for next_index in range(len(img_paths)):
+                while next_index not in finished:
+                    i, output = results.get()
+                    if isinstance(output, Exception):
+                        raise output
+                    finished[i] = output
+                    if report_done is not None:
+                        report_done(len(finished) + next_index)
+                yield finished.pop(next_index)
+        finally:
+            # Let the darknets finish the images they're on, so their output doesn't end up attached to the next image.
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+
+def iter_yolo_detections(img_paths, update_progress_bar=None, session=None):
+    """ img_paths:           A list of image paths to be run through YOLO. These are probably crops
+        update_progress_bar: A function to update the progress bar.
+        session:             A DetectorSession (or DetectorPool) to reuse. If this is None, we make one just for these images.
+        Yields (tile_index, bio_objs) for each image in img_paths as soon as darknet is done with it
+        (and every image before it). """
+
+    def report_done(num_done):
+        if update_progress_bar is not None:
+            update_progress_bar(min(100, int(num_done / len(img_paths) * 100)))
+
+    if session is None:
+        yield from enumerate(run_yolo_once(img_paths, report_done))
+        return
+
+    first_id = 1
+    try:
+        for tile_index, output in enumerate(session.detect_all(img_paths, report_done)):
+            boxes, class_ids, confidences = read_output_detections(output)
+            yield tile_index, bio_objects_from_arrays(boxes, class_ids, confidences, first_id, tile_index)
+            first_id += len(boxes)
+    finally:
+        remove_darknet_garbage()
+
+def run_yolo_once(img_paths, report_done=None):
+    """ Runs img_paths through a darknet of their own, and returns a list of BioObjects for each of them.
+        Since darknet exits afterwards anyway, it saves its detections as JSON, which we read instead of its output.
+        If it couldn't (say, because it was restarted partway through), we read its output like a long-lived session's. """
+    with tempfile.TemporaryDirectory(prefix="bacteria-networks-") as directory:
+        session = DetectorSession(json_output_path=os.path.join(directory, JSON_OUTPUT_FILENAME))
+        try:
+            outputs = list(session.detect_all(img_paths, report_done))
+        finally:
+            session.close()
+
+        try:
+            with tracing.stage("read_json_detections", images=len(img_paths)):
+                detections = read_json_detections(session.json_output_path, img_paths)
+        except (OSError, ValueError, KeyError, TypeError):
+            detections = [read_output_detections(output) for output in outputs]
+
+    bio_objs = []
+    first_id = 1
+    for tile_index, (boxes, class_ids, confidences) in enumerate(detections):
+        bio_objs.append(bio_objects_from_arrays(boxes, class_ids, confidences, first_id, tile_index))
+        first_id += len(boxes)
     return bio_objs
+
+def read_json_detections(json_path, img_paths):
+    """ Reads the detections darknet saved (with -out) for img_paths, and returns (boxes, class_ids, confidences) for
+        each of them, where boxes is an (n, 4) array of x1, y1, x2, y2 in px, and class_ids are DetectionStore class ids.
+        Raises ValueError if the file doesn't have exactly one result for each image. """
+    with open(json_path) as json_file:
+        frames = json.load(json_file)
+    if len(frames) != len(img_paths):
+        raise ValueError(f"{json_path} has {len(frames)} results for {len(img_paths)} images")
+
+    detections = []
+    for frame, img_path in zip(sorted(frames, key=lambda frame: frame["frame_id"]), img_paths):
+        objects = frame["objects"]
+        coordinates = np.array([(obj["relative_coordinates"]["center_x"], obj["relative_coordinates"]["center_y"],
+                                 obj["relative_coordinates"]["width"], obj["relative_coordinates"]["height"]) for obj in objects],
+                               dtype=float)
+        detections.append((relative_to_pixel_boxes(coordinates, *image_size(img_path)),
+                           np.array([class_id_for(obj["name"]) for obj in objects], dtype=np.int16),
+                           np.array([obj["confidence"] for obj in objects], dtype=float)))
+    return detections
+
+def relative_to_pixel_boxes(coordinates, width, height):
+    """ coordinates: An (n, 4) array of center x, center y, width, height, as fractions of a width x height image's size,
+                     which is how YOLO gives its boxes.
+        Returns an (n, 4) array of x1, y1, x2, y2 in px. """
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 4) * (width, height, width, height)
+    # These get rounded the same way darknet rounds the boxes it prints, and negative ones become 0 like in read_output_detections.
+    left_top = np.maximum(0, np.round(coordinates[:, :2] - coordinates[:, 2:] / 2)).astype(np.int64)
+    sizes = np.maximum(0, np.round(coordinates[:, 2:])).astype(np.int64)
+    return np.hstack((left_top, left_top + sizes))
+
+def bio_objects_from_arrays(boxes, class_ids, confidences, first_id=1, tile_index=NO_TILE):
+    """ Returns a BioObject for each row of the arrays (as returned by read_json_detections), all sharing one new store. """
+    store = DetectionStore(capacity=len(boxes))
+    rows = store.extend(boxes, class_ids, confidences, tile_index)
+    return [BioObject.view(store, row, first_id + i) for i, row in enumerate(rows.tolist())]
+
+def read_output_detections(output):
+    """ Reads the detections in darknet's output for one image (see DetectorSession.detect), and returns
+        (boxes, class_ids, confidences) like read_json_detections. """
+    matches = DETECTION_PATTERN.findall(output)
+    numbers = np.array([match[1:] for match in matches], dtype=np.int64).reshape(-1, 5)
+    # For some reason, yolo sometimes gives negative bounding box dimensions.
+    # We've only seen this happen when the images are really busy
+    left_top = np.maximum(0, numbers[:, 1:3])
+    boxes = np.hstack((left_top, left_top + np.maximum(0, numbers[:, 3:])))
+    class_ids = np.array([class_id_for(match[0]) for match in matches], dtype=np.int16)
+    return boxes, class_ids, numbers[:, 0] / 100
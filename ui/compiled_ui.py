@@ -0,0 +1,48 @@
+""" compiled_ui.py
+    Turns .ui files into Python modules (like pyuic5 does) the first time they're needed, and again
+    whenever the .ui file changes. Building a window from a compiled module is much faster than having
+    loadUi parse the XML every time.
+"""
+
+import importlib.util
+import os
+
+COMPILED_UI_DIR = "ui/compiled"
+
+# The Ui_* classes we've already imported, by .ui path.
+ui_classes = {}
+
+def setup_ui(ui_path, widget):
+    """ Builds the interface described by ui_path onto widget. This does the same thing as loadUi(ui_path, widget). """
+    ui = load_ui_class(ui_path)()
+    ui.setupUi(widget)
+    # setupUi puts the child widgets on ui, but everything else expects them on widget.
+    for name, child in vars(ui).items():
+        setattr(widget, name, child)
+
+def load_ui_class(ui_path):
+    """ Returns the Ui_* class that pyuic5 would generate for ui_path. """
+    if ui_path in ui_classes:
+        return ui_classes[ui_path]
+
+    module_name = os.path.splitext(os.path.basename(ui_path))[0] + "_ui"
+    module_path = os.path.join(COMPILED_UI_DIR, module_name + ".py")
+    if not os.path.exists(module_path) or os.path.getmtime(module_path) < os.path.getmtime(ui_path):
+        compile_ui_file(ui_path, module_path)
+
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    ui_classes[ui_path] = next(getattr(module, name) for name in dir(module) if name.startswith("Ui_"))
+    return ui_classes[ui_path]
+
+def compile_ui_file(ui_path, module_path):
+    # Only the GUI needs PyQt5, so we don't import it until we have to.
+    from PyQt5.uic import compileUi
+
+    os.makedirs(os.path.dirname(module_path), exist_ok=True)
+    # Write somewhere else first so a half-written module never gets imported.
+    with open(module_path + ".tmp", "w") as module_file:
+        compileUi(ui_path, module_file)
+    os.replace(module_path + ".tmp", module_path)
@@ -1,10 +1,12 @@
 from PyQt5.QtWidgets import QWidget
-from PyQt5.uic import loadUi
+from compiled_ui import setup_ui
+
+UI_FILE = "ui/legend_and_counts.ui"
 
 class LegendAndCounts(QWidget):
     def __init__(self, parent):
         QWidget.__init__(self, parent)
-        loadUi("ui/legend_and_counts.ui", self)
+        setup_ui(UI_FILE, self)
 
     def update_normal_count(self, count):
         self.normal_count.setText(str(count))
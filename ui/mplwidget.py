@@ -3,6 +3,7 @@ path.append("src")
 
 from PyQt5.QtWidgets import *
 from matplotlib.backends.backend_qt5agg import FigureCanvas
+from matplotlib.colors import to_rgba
 from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 from matplotlib.patches import Rectangle
@@ -21,10 +22,13 @@ NORMAL_COLOR = "red"
 SPHEROPLAST_COLOR = "purple"
 CURVED_COLOR = "green"
 FILAMENT_COLOR = "cyan"
+CONTOUR_COLOR = "magenta"
+CONTOUR_ALPHA = 0.4
 
 BBOX_GID = "bbox"
 NETWORK_NODE_GID = "node"
 NETWORK_EDGE_GID = "edge"
+CONTOUR_GID = "contour"
 
 class MplWidget(QWidget):
     def __init__(self, parent):
@@ -53,6 +57,7 @@ class MplWidget(QWidget):
         self.remove_network_nodes()
         self.remove_network_edges()
         self.remove_cell_bounding_boxes()
+        self.remove_contours()
         self.artist_data = {}
         self.current_gid = 0
         self.canvas.axes.cla()
@@ -90,6 +95,22 @@ class MplWidget(QWidget):
 
         self.canvas.draw()
 
+    def draw_contours(self, bio_objects, image_shape):
+        """ Draws the contours that have been computed for bio_objects over an image of shape image_shape. """
+        # The contours all go into one overlay, so matplotlib only has to draw one image however many there are.
+        overlay = np.zeros((*image_shape[:2], 4))
+        for obj in bio_objects:
+            if obj.is_surface() or not obj.has_contour():
+                continue
+            x, y = obj.contour_offset
+            height, width = obj.contour.shape
+            overlay[y:y + height, x:x + width][obj.contour] = to_rgba(CONTOUR_COLOR, CONTOUR_ALPHA)
+
+        self.artist_data[str(self.current_gid)] = {"network_type": CONTOUR_GID}
+        self.canvas.axes.imshow(overlay, gid=str(self.current_gid))
+        self.current_gid += 1
+        self.canvas.draw()
+
     def update_node_color(self, artist, cell_classification):
         color = NORMAL_COLOR if cell_classification == NORMAL else \
                 FILAMENT_COLOR if cell_classification == FILAMENT else \
@@ -152,6 +173,12 @@ class MplWidget(QWidget):
                 child.remove()
         self.canvas.draw()
 
+    def remove_contours(self):
+        for child in self.canvas.axes.get_children():
+            if hasattr(child, "_gid") and child._gid is not None and self.artist_data[child._gid]["network_type"] == CONTOUR_GID:
+                child.remove()
+        self.canvas.draw()
+
     def remove_network_edges(self):
         for child in self.canvas.axes.get_children():
             if hasattr(child, "_gid") and child._gid is not None and self.artist_data[child._gid]["network_type"] == NETWORK_EDGE_GID: